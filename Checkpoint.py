@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from typing import Callable, Final, Optional
+
+CHECKPOINT_DIR: Final[str] = "checkpoint"
+MANIFEST: Final[str] = "manifest.jsonl"
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Checkpoint:
+    """
+    Durable record of how far every assembly of a run got.
+
+    After each stage the work item of the assembly is written to a spool file that atomically
+    replaces the previous one, so a restarted run continues from the last finished stage with its outputs.
+    Writing the rows of an assembly is bracketed by begin/done events in an append only manifest:
+    an assembly whose commit began but never finished is written again on recovery,
+    which the primary key dedupe of handled.write_* makes idempotent.
+
+    Pipeline stages of different assemblies complete and commit from several threads at once,
+    the manifest is appended to under a lock.
+
+    :ivar stages: stage names in run order, the last one is the commit
+    """
+
+    def __init__(self, stages: list[str], directory: str = CHECKPOINT_DIR,
+                 encode: Optional[Callable] = None, decode: Optional[Callable[[dict], object]] = None):
+        """
+        :param stages: stage names in the order they are run
+        :param directory: directory of the manifest and the spool files, created if missing
+        :param encode: json default hook for objects of the work items json can not write, e.g. Model.encode_record
+        :param decode: json object hook turning what encode wrote back into objects, e.g. Model.decode_record
+        """
+        self.stages: list[str] = list(stages)
+        self.directory: str = directory
+        self._encode: Optional[Callable] = encode
+        self._decode: Optional[Callable[[dict], object]] = decode
+        os.makedirs(os.path.join(directory, 'spool'), exist_ok=True)
+        self._manifest_path: str = os.path.join(directory, MANIFEST)
+        self.committed: set[str] = set()
+        self._open_commits: set[str] = set()
+        self._lock = threading.Lock()
+        self._load()
+        self._manifest = open(self._manifest_path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self._manifest_path):
+            return
+        with open(self._manifest_path, 'r') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line from a crash, the event it held never completed
+                    continue
+                if event['event'] == 'begin':
+                    self._open_commits.add(event['accession'])
+                elif event['event'] == 'done':
+                    self._open_commits.discard(event['accession'])
+                    self.committed.add(event['accession'])
+
+    def _log(self, accession: str, event: str, stage: Optional[str] = None):
+        entry = {'accession': accession, 'event': event}
+        if stage is not None:
+            entry['stage'] = stage
+        with self._lock:
+            self._manifest.write(json.dumps(entry) + '\n')
+            self._manifest.flush()
+            os.fsync(self._manifest.fileno())
+            if event == 'begin':
+                self._open_commits.add(accession)
+            elif event == 'done':
+                self._open_commits.discard(accession)
+                self.committed.add(accession)
+
+    def _spool_path(self, accession: str) -> str:
+        return os.path.join(self.directory, 'spool', f"{accession}.json")
+
+    def resume(self, accession: str) -> Optional[dict]:
+        """
+        :return: the work item saved after the last finished stage of accession, None if it has none
+        """
+        try:
+            with open(self._spool_path(accession), 'r') as f:
+                return json.load(f, object_hook=self._decode)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def reached(self, item: dict, stage: str) -> bool:
+        """
+        :return: True when the item already went through stage
+        """
+        return item.get('stage') is not None and self.stages.index(item['stage']) >= self.stages.index(stage)
+
+    def complete(self, accession: str, stage: str, item: dict):
+        """
+        Durably records that stage finished for accession along with the work item it produced.
+        """
+        item['stage'] = stage
+        path = self._spool_path(accession)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(item, f, default=self._encode)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(os.path.dirname(path))
+        self._log(accession, 'stage', stage)
+
+    def commit(self, accession: str, item: dict, write: Callable[[dict], object]):
+        """
+        Writes the rows of an assembly with write and marks the assembly as finished.
+        The item must have been completed for the stage before the commit so it can be replayed,
+        and write must only return once its rows are on disk, e.g. through handled.sync_tables,
+        or a crash could lose rows of an assembly the manifest already marks as done.
+        """
+        self._log(accession, 'begin')
+        write(item)
+        self._log(accession, 'done')
+        try:
+            os.remove(self._spool_path(accession))
+        except FileNotFoundError:
+            pass
+
+    def recover(self, write: Callable[[dict], object]) -> list[str]:
+        """
+        Finishes the commits a crash interrupted by writing their spooled items again.
+
+        :return: accessions that were recovered
+        """
+        recovered = []
+        for accession in sorted(self._open_commits):
+            item = self.resume(accession)
+            if item is None:
+                continue
+            self.commit(accession, item, write)
+            recovered.append(accession)
+        return recovered
+
+    def close(self):
+        with self._lock:
+            self._manifest.close()
@@ -0,0 +1,307 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final, Iterator, Optional
+
+import numpy
+import pandas
+import scipy.cluster.hierarchy
+
+import Repertoire
+
+METRICS: Final[tuple] = ('jaccard', 'cosine')
+BLOCK_ROWS: Final[int] = 512  # rows of each side of a distance block, bounds the memory of one block
+HIERARCHY_LIMIT: Final[int] = 20000  # distinct profiles hierarchical clustering accepts, its distances are n^2 / 2
+MEDOID_SAMPLE: Final[int] = 2000  # candidates tried when updating the medoid of a large cluster
+
+# arrays of the running DistanceEngine in worker processes, set by _init_worker
+_worker: dict = dict()
+
+
+class Profiles:
+    """
+    Distinct repertoire profiles of a Repertoire, genomes sharing a profile are clustered once.
+
+    :ivar bits: presence of every column, bit packed, one row per distinct profile (jaccard)
+    :ivar ones: set bits per row
+    :ivar unit: counts scaled to unit length, one row per distinct profile (cosine)
+    :ivar weights: genomes per distinct profile
+    :ivar inverse: distinct profile of every row of the repertoire
+    """
+
+    def __init__(self, repertoire: Repertoire.Repertoire):
+        counts = repertoire.matrix.toarray()
+        unique, inverse, weights = numpy.unique(counts, axis=0, return_inverse=True, return_counts=True)
+        presence = unique > 0
+        self.bits: numpy.ndarray = numpy.packbits(presence, axis=1)
+        self.ones: numpy.ndarray = presence.sum(axis=1).astype(numpy.int32)
+        norms = numpy.linalg.norm(unique, axis=1).astype(numpy.float32)
+        self.unit: numpy.ndarray = (unique / numpy.where(norms == 0, 1, norms)[:, None]).astype(numpy.float32)
+        self.empty: numpy.ndarray = norms == 0
+        self.weights: numpy.ndarray = weights.astype(numpy.int64)
+        self.inverse: numpy.ndarray = inverse.ravel()
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+
+def jaccard_block(bits_a, ones_a, bits_b, ones_b) -> numpy.ndarray:
+    """
+    Jaccard distances between two blocks of bit packed presence rows, two empty profiles are at distance 0.
+    """
+    inter = numpy.bitwise_count(bits_a[:, None, :] & bits_b[None, :, :]).sum(axis=2, dtype=numpy.int32)
+    union = ones_a[:, None] + ones_b[None, :] - inter
+    return numpy.where(union == 0, 0, 1 - inter / numpy.maximum(union, 1)).astype(numpy.float32)
+
+
+def cosine_block(unit_a, empty_a, unit_b, empty_b) -> numpy.ndarray:
+    """
+    Cosine distances between two blocks of unit rows, two empty profiles are at distance 0.
+    """
+    distances = numpy.clip(1 - unit_a @ unit_b.T, 0, 2)
+    distances[empty_a[:, None] & empty_b[None, :]] = 0
+    return distances
+
+
+def _block(arrays: dict, rows: numpy.ndarray, columns: numpy.ndarray) -> numpy.ndarray:
+    if arrays['metric'] == 'jaccard':
+        return jaccard_block(arrays['bits'][rows], arrays['ones'][rows], arrays['bits'][columns], arrays['ones'][columns])
+    return cosine_block(arrays['unit'][rows], arrays['empty'][rows], arrays['unit'][columns], arrays['empty'][columns])
+
+
+def _init_worker(arrays: dict):
+    _worker.update(arrays)
+
+
+def _worker_min(rows: numpy.ndarray, columns: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    return _nearest(_worker, rows, columns)
+
+
+def _worker_tail(start: int, stop: int) -> numpy.ndarray:
+    return _tail(_worker, start, stop)
+
+
+def _tail(arrays: dict, start: int, stop: int) -> numpy.ndarray:
+    """
+    :return: distances of rows start..stop-1 to every row from start on, one block of columns at a time
+    """
+    size = len(arrays['ones'])
+    rows = numpy.arange(start, stop)
+    outp = numpy.empty((len(rows), size - start), dtype=numpy.float32)
+    for column in range(start, size, BLOCK_ROWS):
+        outp[:, column - start:column - start + BLOCK_ROWS] = _block(
+            arrays, rows, numpy.arange(column, min(column + BLOCK_ROWS, size)))
+    return outp
+
+
+def _nearest(arrays: dict, rows: numpy.ndarray, columns: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    best = numpy.full(len(rows), numpy.inf, dtype=numpy.float32)
+    where = numpy.zeros(len(rows), dtype=numpy.int64)
+    for start in range(0, len(columns), BLOCK_ROWS):
+        distances = _block(arrays, rows, columns[start:start + BLOCK_ROWS])
+        position = distances.argmin(axis=1)
+        value = distances[numpy.arange(len(rows)), position]
+        better = value < best
+        best[better], where[better] = value[better], position[better] + start
+    return best, where
+
+
+class DistanceEngine:
+    """
+    Computes distances between profiles one BLOCK_ROWS x BLOCK_ROWS block at a time,
+    so memory stays fixed whatever the number of genomes. With workers > 1 row blocks are spread over processes.
+    """
+
+    def __init__(self, profiles: Profiles, metric: str = 'jaccard', workers: int = 1):
+        """
+        :param metric: 'jaccard' on presence or 'cosine' on counts
+        :param workers: processes, 0 for one per core
+        """
+        if metric not in METRICS:
+            raise ValueError(f"{metric} is not one of {METRICS}")
+        self.size: int = len(profiles)
+        self.arrays: dict = {'metric': metric, 'bits': profiles.bits, 'ones': profiles.ones,
+                             'unit': profiles.unit, 'empty': profiles.empty}
+        self.workers: int = (os.cpu_count() or 1) if workers == 0 else workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self):
+        if self.workers > 1:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.arrays,))
+        return self
+
+    def __exit__(self, *exc):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _row_blocks(self, rows: numpy.ndarray) -> Iterator[numpy.ndarray]:
+        for start in range(0, len(rows), BLOCK_ROWS):
+            yield rows[start:start + BLOCK_ROWS]
+
+    def block(self, rows: numpy.ndarray, columns: numpy.ndarray) -> numpy.ndarray:
+        """
+        :return: distances of rows x columns, in the calling process
+        """
+        return _block(self.arrays, rows, columns)
+
+    def nearest(self, rows: numpy.ndarray, columns: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :return: distance to, and position in columns of, the closest column of every row
+        """
+        blocks = list(self._row_blocks(rows))
+        if self._pool is None:
+            results = [_nearest(self.arrays, block, columns) for block in blocks]
+        else:
+            results = list(self._pool.map(_worker_min, blocks, [columns] * len(blocks)))
+        if not results:
+            return numpy.zeros(0, dtype=numpy.float32), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate([best for best, _ in results]), numpy.concatenate([where for _, where in results])
+
+    def condensed(self) -> numpy.ndarray:
+        """
+        :return: every pairwise distance in the condensed form of scipy.spatial.distance.pdist
+        """
+        n = self.size
+        outp = numpy.empty(n * (n - 1) // 2, dtype=numpy.float64)
+        starts = list(range(0, n, BLOCK_ROWS))
+        if self._pool is None:
+            tails = (_tail(self.arrays, start, min(start + BLOCK_ROWS, n)) for start in starts)
+        else:
+            tails = self._pool.map(_worker_tail, starts, [min(start + BLOCK_ROWS, n) for start in starts])
+        for start, tail in zip(starts, tails):
+            for offset, row in enumerate(tail):
+                i = start + offset
+                first = n * i - i * (i + 1) // 2
+                outp[first:first + n - i - 1] = row[offset + 1:]
+        return outp
+
+
+class Clustering:
+    """
+    Cluster of every genome of a Repertoire.
+
+    :ivar rows: taxon id of each genome
+    :ivar labels: cluster of each genome, from 0
+    :ivar medoids: taxon id of the medoid of each cluster, k-medoids only
+    :ivar linkage: scipy linkage matrix over the distinct profiles, hierarchical only
+    :ivar cost: summed distance of the genomes to their medoid, k-medoids only
+    """
+
+    def __init__(self, rows: numpy.ndarray, labels: numpy.ndarray, medoids: Optional[numpy.ndarray] = None,
+                 linkage: Optional[numpy.ndarray] = None, cost: Optional[float] = None):
+        self.rows: numpy.ndarray = rows
+        self.labels: numpy.ndarray = labels
+        self.medoids: Optional[numpy.ndarray] = medoids
+        self.linkage: Optional[numpy.ndarray] = linkage
+        self.cost: Optional[float] = cost
+
+    def __len__(self) -> int:
+        return int(self.labels.max()) + 1 if len(self.labels) else 0
+
+    def members(self, label: int) -> numpy.ndarray:
+        """
+        :return: taxon ids of the genomes of a cluster
+        """
+        return self.rows[self.labels == label]
+
+    def sizes(self) -> numpy.ndarray:
+        return numpy.bincount(self.labels, minlength=len(self))
+
+    def to_frame(self) -> pandas.DataFrame:
+        return pandas.DataFrame({'taxon_id': self.rows, 'cluster': self.labels})
+
+
+def _update_medoid(engine: DistanceEngine, members: numpy.ndarray, weights: numpy.ndarray,
+                   rng: numpy.random.Generator) -> tuple[int, float]:
+    candidates = members if len(members) <= MEDOID_SAMPLE else rng.choice(members, MEDOID_SAMPLE, replace=False)
+    totals = numpy.zeros(len(candidates), dtype=numpy.float64)
+    for start in range(0, len(members), BLOCK_ROWS):
+        chunk = members[start:start + BLOCK_ROWS]
+        for offset in range(0, len(candidates), BLOCK_ROWS):
+            rows = candidates[offset:offset + BLOCK_ROWS]
+            totals[offset:offset + len(rows)] += engine.block(rows, chunk) @ weights[chunk]
+    best = int(totals.argmin())
+    return int(candidates[best]), float(totals[best])
+
+
+def kmedoids(repertoire: Repertoire.Repertoire, k: int, metric: str = 'jaccard', workers: int = 1,
+             max_iter: int = 50, seed: int = 0) -> Clustering:
+    """
+    Weighted k-medoids of the genome profiles: k-medoids++ seeding, then alternating assignment and medoid update.
+    Identical profiles are clustered once with their genome count as weight.
+    Medoids of clusters larger than MEDOID_SAMPLE are picked among a sample of their members.
+
+    :param k: clusters, fewer when there are fewer distinct profiles
+    :param metric: 'jaccard' on presence or 'cosine' on counts
+    :param workers: processes computing distances, 0 for one per core
+    """
+    profiles = Profiles(repertoire)
+    k = min(k, len(profiles))
+    if k < 1:
+        raise ValueError("kmedoids needs k >= 1 and a non empty repertoire")
+    rng = numpy.random.default_rng(seed)
+    everyone = numpy.arange(len(profiles))
+    weights = profiles.weights.astype(numpy.float64)
+    with DistanceEngine(profiles, metric, workers) as engine:
+        medoids = [int(weights.argmax())]
+        closest, _ = engine.nearest(everyone, numpy.array(medoids))
+        while len(medoids) < k:
+            chance = weights * closest.astype(numpy.float64) ** 2
+            if chance.sum() == 0:
+                break
+            medoids.append(int(rng.choice(everyone, p=chance / chance.sum())))
+            distances, _ = engine.nearest(everyone, numpy.array(medoids[-1:]))
+            closest = numpy.minimum(closest, distances)
+        medoids = numpy.array(medoids)
+        cost = numpy.inf
+        for _ in range(max_iter):
+            distances, labels = engine.nearest(everyone, medoids)
+            cost = float(distances @ weights)
+            updated = medoids.copy()
+            for label in range(len(medoids)):
+                members = everyone[labels == label]
+                if len(members):
+                    updated[label], _ = _update_medoid(engine, members, weights, rng)
+            if numpy.array_equal(updated, medoids):
+                break
+            medoids = updated
+        distances, labels = engine.nearest(everyone, medoids)
+        cost = float(distances @ weights)
+    # the medoid of a cluster is reported as the first genome having the medoid profile
+    _, first_row = numpy.unique(profiles.inverse, return_index=True)
+    return Clustering(repertoire.rows, labels[profiles.inverse], repertoire.rows[first_row[medoids]], cost=cost)
+
+
+def hierarchical(repertoire: Repertoire.Repertoire, k: Optional[int] = None, threshold: Optional[float] = None,
+                 method: str = 'average', metric: str = 'jaccard', workers: int = 1) -> Clustering:
+    """
+    Agglomerative clustering of the distinct genome profiles, cut into k clusters or at a distance threshold.
+    The pairwise distances are built block by block, possibly by several processes,
+    straight into the condensed array scipy takes.
+
+    :param method: scipy linkage method, e.g. 'average', 'complete' or 'single'
+    :param workers: processes computing distances, 0 for one per core
+    :raises ValueError: with more than HIERARCHY_LIMIT distinct profiles, use kmedoids then
+    """
+    if (k is None) == (threshold is None):
+        raise ValueError("Give either k or threshold")
+    profiles = Profiles(repertoire)
+    if len(profiles) > HIERARCHY_LIMIT:
+        raise ValueError(f"{len(profiles):,} distinct profiles is over the {HIERARCHY_LIMIT:,} of hierarchical, "
+                         f"use kmedoids")
+    if len(profiles) < 2:
+        return Clustering(repertoire.rows, numpy.zeros(len(repertoire.rows), dtype=numpy.int64))
+    with DistanceEngine(profiles, metric, workers) as engine:
+        condensed = engine.condensed()
+    linkage = scipy.cluster.hierarchy.linkage(condensed, method=method)
+    if k is not None:
+        labels = scipy.cluster.hierarchy.fcluster(linkage, t=k, criterion='maxclust')
+    else:
+        labels = scipy.cluster.hierarchy.fcluster(linkage, t=threshold, criterion='distance')
+    return Clustering(repertoire.rows, (labels - 1)[profiles.inverse], linkage=linkage)
+
+
+if __name__ == "__main__":
+    import sys
+    _clusters = kmedoids(Repertoire.repertoire('cdd'), int(sys.argv[1]) if len(sys.argv) > 1 else 8, workers=0)
+    print(_clusters.to_frame().groupby('cluster').size())
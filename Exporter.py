@@ -0,0 +1,144 @@
+import os
+from typing import Final, Optional, Sequence
+
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+from pyarrow.fs import LocalFileSystem
+
+import SymbolTable
+import handled
+
+EXPORT_DIR: Final[str] = "dataset"
+PARTITION_COLUMNS: Final[tuple] = ('phylum', 'class')
+
+ARROW_TYPES = {
+    'int': pyarrow.int64(),
+    'str': pyarrow.string(),
+    'category': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+}
+
+
+def arrow_schema(table: str) -> pyarrow.Schema:
+    """
+    Builds the arrow schema of one of the tables declared in handled.TABLES
+
+    :param table: key of the table in handled.TABLES
+    :return: schema with typed, dictionary encoded columns
+    """
+    columns = handled.TABLES[table]['columns']
+    return pyarrow.schema([(column, ARROW_TYPES[kind]) for column, kind in columns.items()])
+
+
+def read_table(table: str, directory: str = '.') -> pyarrow.Table:
+    """
+    Reads one of the csv tables with its declared types instead of untyped strings.
+
+    :param table: key of the table in handled.TABLES
+    :param directory: directory holding the csv files
+    :return: typed arrow table, the category columns encoded with the stable codes of SymbolTable
+    """
+    schema = arrow_schema(table)
+    convert = pcsv.ConvertOptions(
+        column_types=schema,
+        null_values=handled.NULL_VALUES,
+        strings_can_be_null=True
+    )
+    arrow_table = pcsv.read_csv(os.path.join(directory, handled.TABLES[table]['file']), convert_options=convert)
+    return SymbolTable.encode_arrow(table, arrow_table)
+
+
+def attach_partitions(table: pyarrow.Table, taxon: pyarrow.Table) -> pyarrow.Table:
+    """
+    Adds the phylum and class of each row by its taxon_id so the table can be partitioned by taxonomy.
+    Rows whose taxon is unknown keep null partition values.
+    """
+    if all(column in table.column_names for column in PARTITION_COLUMNS):
+        return _decode_partitions(table)
+    lookup = _decode_partitions(taxon.select(['taxon_id', *PARTITION_COLUMNS]))
+    return table.join(lookup, keys='taxon_id', join_type='left outer')
+
+
+def _decode_partitions(table: pyarrow.Table) -> pyarrow.Table:
+    # partition values end up in directory names so they are stored as plain strings
+    for column in PARTITION_COLUMNS:
+        index = table.column_names.index(column)
+        table = table.set_column(index, column, pc.cast(table[column], pyarrow.string()))
+    return table
+
+
+def export_tables(out_dir: str = EXPORT_DIR, directory: str = '.',
+                  tables: Sequence[str] = ('assembly', 'gene', 'protein', 'taxon'),
+                  compression: str = 'zstd') -> dict[str, str]:
+    """
+    Writes each csv table as a zstd compressed parquet dataset, hive partitioned by phylum/class.
+    Dictionary encoding is kept for the categorical columns.
+    Existing partitions of a table are replaced.
+
+    :param out_dir: root directory of the exported datasets, one sub directory per table
+    :param directory: directory holding the csv files
+    :param tables: tables of handled.TABLES to export
+    :param compression: parquet compression codec
+    :return: mapping of table name to the directory it was written to
+    """
+    taxon = read_table('taxon', directory)
+    partitioning = ds.partitioning(
+        pyarrow.schema([(column, pyarrow.string()) for column in PARTITION_COLUMNS]),
+        flavor='hive'
+    )
+    file_format = ds.ParquetFileFormat()
+    options = file_format.make_write_options(compression=compression, use_dictionary=True)
+    outp = dict()
+    for name in tables:
+        table = taxon if name == 'taxon' else read_table(name, directory)
+        table = attach_partitions(table, taxon)
+        base_dir = os.path.join(out_dir, name)
+        ds.write_dataset(
+            table,
+            base_dir=base_dir,
+            format=file_format,
+            file_options=options,
+            partitioning=partitioning,
+            existing_data_behavior='delete_matching'
+        )
+        outp[name] = base_dir
+    return outp
+
+
+def open_dataset(table: str, out_dir: str = EXPORT_DIR) -> ds.Dataset:
+    """
+    Opens an exported table as a memory mapped dataset.
+    Filters on phylum/class only touch the matching partition directories.
+    """
+    return ds.dataset(
+        os.path.join(out_dir, table),
+        format='parquet',
+        partitioning='hive',
+        filesystem=LocalFileSystem(use_mmap=True)
+    )
+
+
+def load(table: str, columns: Optional[list[str]] = None, out_dir: str = EXPORT_DIR, **where):
+    """
+    Loads only the requested columns of the rows matching where.
+
+    load('protein', columns=['protein_id', 'poly_type'], phylum='Proteobacteria', poly_type='A')
+
+    :param table: exported table to read
+    :param columns: columns to read, all when None
+    :param out_dir: root directory of the exported datasets
+    :param where: column=value equality filters pushed down to the partitions and row groups
+    :return: pandas DataFrame
+    """
+    predicate = None
+    for column, value in where.items():
+        term = ds.field(column) == value
+        predicate = term if predicate is None else predicate & term
+    return open_dataset(table, out_dir).to_table(columns=columns, filter=predicate).to_pandas()
+
+
+if __name__ == "__main__":
+    import sys
+    for _name, _path in export_tables(*sys.argv[1:2]).items():
+        print(f"{_name} -> {_path}")
@@ -0,0 +1,241 @@
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, Iterable, Iterator, Optional
+
+import NCBIJobPacket
+import NCBIQueries
+import handled
+from Model import NCBIIdBatch
+from QueryDriver import QueryDriver
+from SearchFactory import NCBICompositeJob
+
+FASTA_PATH: Final[str] = "protein.fa.gz"
+BLOCK_BYTES: Final[int] = 64 * 2 ** 10  # uncompressed bytes per gzip member, the unit of a random read
+LINE_BASES: Final[int] = 60
+# TSeq xml gives the uid of every sequence, plain FASTA headers only have the accession
+FETCH_TAGS: Final[dict] = {'rettype': 'fasta', 'retmode': 'xml'}
+
+
+class FastaStore:
+    """
+    Protein sequences in a block compressed FASTA file with an offset index for random access by protein_id.
+
+    The file is a series of independent gzip members of about BLOCK_BYTES each, so it still reads with zcat,
+    and the index (path + '.fai') gives per record, like samtools faidx does:
+    protein_id, sequence length, offset and size of its block in the file, offset of the record in the block,
+    bases per line and bytes per line. A lookup is one seek and one block inflate.
+
+    Blocks are appended before their index lines, and a block without index lines is cut off on open,
+    so an interrupted download only loses the records of its last block.
+    """
+
+    def __init__(self, path: str = FASTA_PATH):
+        """
+        :param path: FASTA file, created when missing. Its index is path + '.fai'
+        """
+        self.path: str = path
+        self.index_path: str = path + '.fai'
+        self._index: dict[str, tuple[int, int, int, int, int]] = dict()
+        self._pending: list[tuple[str, int, bytes]] = []
+        self._pending_ids: set[str] = set()
+        self._pending_bytes: int = 0
+        self._lock = threading.Lock()
+        self._cached_block: tuple[int, bytes] = (-1, b'')
+        end = 0
+        try:
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if not line.endswith('\n') or len(fields) != 7:
+                        break  # torn last line, cut off by repair_table below
+                    name, length, block, size, offset, line_bases, line_width = fields
+                    self._index[name] = (int(length), int(block), int(size), int(offset), int(line_width))
+                    end = max(end, int(block) + int(size))
+        except FileNotFoundError:
+            pass
+        handled.repair_table(self.index_path)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > end:
+            with open(self.path, 'rb+') as f:
+                f.truncate(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, protein_id) -> bool:
+        return str(protein_id) in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def add(self, protein_id, header: str, sequence: str):
+        """
+        Queues a record, full blocks are written as they fill up.
+
+        :param header: FASTA header without the leading '>' and the protein_id
+        """
+        protein_id = str(protein_id)
+        lines = [sequence[start:start + LINE_BASES] for start in range(0, len(sequence), LINE_BASES)]
+        record = f">{protein_id} {header}\n" + ''.join(f"{line}\n" for line in lines)
+        with self._lock:
+            if protein_id in self._index or protein_id in self._pending_ids:
+                return
+            self._pending_ids.add(protein_id)
+            self._pending.append((protein_id, len(sequence), record.encode('ascii')))
+            self._pending_bytes += len(self._pending[-1][2])
+            if self._pending_bytes >= BLOCK_BYTES:
+                self._write_block()
+
+    def _write_block(self):
+        # called with _lock held
+        if not self._pending:
+            return
+        data, entries = bytearray(), []
+        for protein_id, length, record in self._pending:
+            entries.append((protein_id, length, len(data)))
+            data += record
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        block = compressor.compress(bytes(data)) + compressor.flush()
+        with open(self.path, 'ab') as f:
+            start = f.tell()
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        lines = []
+        for protein_id, length, offset in entries:
+            self._index[protein_id] = (length, start, len(block), offset, LINE_BASES + 1)
+            lines.append(f"{protein_id}\t{length}\t{start}\t{len(block)}\t{offset}\t{LINE_BASES}\t{LINE_BASES + 1}\n")
+        with open(self.index_path, 'a') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending, self._pending_bytes, self._pending_ids = [], 0, set()
+
+    def flush(self):
+        """
+        Writes the records queued so far as a last, smaller block.
+        """
+        with self._lock:
+            self._write_block()
+
+    def close(self):
+        self.flush()
+
+    def _block(self, start: int, size: int) -> bytes:
+        if self._cached_block[0] == start:
+            return self._cached_block[1]
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = zlib.decompress(f.read(size), 31)
+        self._cached_block = (start, data)
+        return data
+
+    def record(self, protein_id) -> str:
+        """
+        :return: the FASTA record of protein_id, header and wrapped sequence
+        :raises KeyError: when the protein was not downloaded, or is still queued
+        """
+        length, start, size, offset, line_width = self._index[str(protein_id)]
+        data = self._block(start, size)
+        end = data.find(b'\n>', offset)
+        return data[offset:len(data) if end < 0 else end + 1].decode('ascii')
+
+    def sequence(self, protein_id) -> str:
+        """
+        :return: the sequence of protein_id on one line
+        """
+        return ''.join(self.record(protein_id).split('\n')[1:])
+
+    def sequences(self, protein_ids: Iterable) -> list[str]:
+        """
+        Reads many sequences in the order of the file, so every block is inflated once.
+
+        :return: the sequence of every protein_id, in the order of protein_ids
+        """
+        protein_ids = [str(protein_id) for protein_id in protein_ids]
+        outp = [''] * len(protein_ids)
+        for position in sorted(range(len(protein_ids)), key=lambda i: self._index[protein_ids[i]][1:4:2]):
+            outp[position] = self.sequence(protein_ids[position])
+        return outp
+
+    def missing(self, protein_ids: Iterable) -> list[str]:
+        """
+        :return: the ids of protein_ids not in the store yet, without repeats
+        """
+        return [protein_id for protein_id in OrderedDict.fromkeys(str(_id) for _id in protein_ids)
+                if protein_id not in self._index]
+
+
+def _sequences_of(result: OrderedDict) -> list[OrderedDict]:
+    sequences = (result.get('TSeqSet') or dict()).get('TSeq') or []
+    return sequences if isinstance(sequences, list) else [sequences]
+
+
+def _fetch_chunk(store: FastaStore, chunk: NCBIIdBatch) -> int:
+    driver = QueryDriver()
+    driver.submit(NCBICompositeJob(
+        f"fasta {chunk!r}",
+        [NCBIJobPacket.NCBIMonoJobPacket(NCBIQueries.EntrezFetch(db='protein', id=chunk, html_tags=FETCH_TAGS))],
+        streaming=True
+    ))
+    added = 0
+    for results in driver.run_query():
+        for sequence in _sequences_of(results):
+            try:
+                header = f"{sequence['TSeq_accver']} {sequence.get('TSeq_defline', '')}".strip()
+                store.add(sequence['TSeq_gi'], header, sequence['TSeq_sequence'])
+                added += 1
+            except KeyError:
+                print(f"Sequence without uid or residues - skipping {sequence.get('TSeq_accver')}")
+    return added
+
+
+def download(protein_ids: Optional[Iterable] = None, store: Optional[FastaStore] = None, workers: int = 3) -> int:
+    """
+    Fetches the FASTA of every protein not in the store yet, by default every protein of protein.csv.
+    Batches are sized by the efetch batcher of the query factory, up to EntrezFetch.max_ids, and several are
+    in flight at once. Each still waits on the rate limit shared by every query, and its sequences are
+    written as soon as it returns. A rerun skips proteins already stored.
+
+    :param workers: batches requested at the same time
+    :return: sequences added
+    """
+    store = FastaStore() if store is None else store
+    if protein_ids is None:
+        protein_ids = handled.load_table('protein')['protein_id'].dropna().astype('int64').tolist()
+    missing = store.missing(protein_ids)
+    if not missing:
+        return 0
+    chunks = QueryDriver().factory.list_chunker(NCBIIdBatch('protein', missing), endpoint='efetch')
+    chunks_lock = threading.Lock()
+
+    def worker() -> int:
+        added = 0
+        while True:
+            with chunks_lock:
+                chunk = next(chunks, None)
+            if chunk is None:
+                return added
+            added += _fetch_chunk(store, chunk)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            added = sum(future.result() for future in [executor.submit(worker) for _ in range(workers)])
+    finally:
+        store.flush()
+    print(f"{added} sequences added, {len(missing) - added} not returned")
+    return added
+
+
+if __name__ == "__main__":
+    with FastaStore() as _store:
+        download(store=_store)
+        print(f"{len(_store)} sequences in {_store.path}")
@@ -0,0 +1,237 @@
+import os
+import sqlite3
+import threading
+from typing import Final, Optional
+
+import handled
+from Repertoire import table_versions
+
+VIEW_PATH: Final[str] = "polymerase_view.sqlite"
+RANKS: Final[tuple] = ('phylum', 'class', 'order', 'family', 'genus', 'species')
+
+# Columns of the denormalized view and the table each one is taken from
+VIEW_COLUMNS: Final[dict] = {
+    'protein': ['protein_id', 'protein_title', 'cdd_id', 'gene_id', 'taxon_id', 'poly_type'],
+    'gene': ['gene_symbol', 'proteins_for_gene', 'assembly', 'description'],
+    'taxon': ['name',
+              'species_id', 'species',
+              'genus_id', 'genus',
+              'family_id', 'family',
+              'order_id', 'order',
+              'class_id', 'class',
+              'phylum_id', 'phylum'],
+    'assembly': ['organism', 'gc_count', 'seq_length', 'chromosomes', 'gene_total'],
+}
+_ALIASES: Final[dict] = {'protein': 'p', 'gene': 'g', 'taxon': 't', 'assembly': 'a'}
+
+
+def _quote(column: str) -> str:
+    # 'order' and 'class' are sql keywords
+    return f'"{column}"'
+
+
+class JoinedView:
+    """
+    Materialized protein ⋈ gene ⋈ taxon ⋈ assembly view kept in an indexed sqlite file.
+
+    The base tables are mirrored in the same file and every row written through handled.write_*
+    only refreshes the view rows it touches, so the full join is never rebuilt.
+    The file also keeps the size and modification time of the csv tables it mirrors, see table_versions,
+    as of the last rebuild or of closing an attached view. stale tells when rows reached the csv files
+    some other way, e.g. MergeTables output or merged shards, and a rebuild is needed.
+
+    :ivar path: location of the sqlite database
+    """
+
+    def __init__(self, path: str = VIEW_PATH, directory: str = '.'):
+        """
+        :param path: sqlite file backing the view, created if missing.
+        :param directory: directory of the csv tables the view mirrors
+        """
+        self.path: str = path
+        self.directory: str = directory
+        self._attached: bool = False
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._create()
+
+    def _create(self):
+        sql_types = {'int': 'INTEGER', 'str': 'TEXT', 'category': 'TEXT'}
+        with self._connection:
+            for name in VIEW_COLUMNS:
+                spec = handled.TABLES[name]
+                columns = ', '.join(
+                    f"{_quote(column)} {sql_types[kind]}" + (' PRIMARY KEY' if column == spec['primary_key'] else '')
+                    for column, kind in spec['columns'].items()
+                )
+                self._connection.execute(f"CREATE TABLE IF NOT EXISTS {name} ({columns})")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS protein_gene ON protein (gene_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS protein_taxon ON protein (taxon_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS gene_assembly ON gene (assembly)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            view_columns = []
+            for table, columns in VIEW_COLUMNS.items():
+                kinds = handled.TABLES[table]['columns']
+                view_columns += [f"{_quote(column)} {sql_types[kinds[column]]}" for column in columns]
+            view_columns[0] += ' PRIMARY KEY'
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS poly_view ({', '.join(view_columns)})")
+            for column in ('poly_type', 'gene_id', 'taxon_id', 'assembly', 'cdd_id', *RANKS):
+                self._connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS poly_view_{column} ON poly_view ({_quote(column)})"
+                )
+
+    def _select_join(self, where: str) -> str:
+        selected = ', '.join(
+            f"{_ALIASES[table]}.{_quote(column)}" for table, columns in VIEW_COLUMNS.items() for column in columns
+        )
+        return (f"INSERT OR REPLACE INTO poly_view SELECT {selected} FROM protein p "
+                f"LEFT JOIN gene g ON g.gene_id = p.gene_id "
+                f"LEFT JOIN taxon t ON t.taxon_id = p.taxon_id "
+                f"LEFT JOIN assembly a ON a.accession = g.assembly "
+                f"WHERE {where}")
+
+    @staticmethod
+    def _clean(table: str, row: dict) -> list:
+        values = []
+        for column in handled.TABLES[table]['columns']:
+            value = row.get(column)
+            values.append(None if value is None or str(value) in handled.NULL_VALUES else str(value))
+        return values
+
+    def _upsert(self, table: str, rows: list[dict]):
+        columns = handled.TABLES[table]['columns']
+        self._connection.executemany(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(_quote(column) for column in columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})",
+            [self._clean(table, row) for row in rows]
+        )
+
+    def add(self, table: str, row: dict):
+        """
+        Adds one row of a base table and refreshes the view rows that join with it.
+        Matches the handled.add_write_listener signature.
+
+        :param table: key of the table in handled.TABLES
+        :param row: row as given to handled.write_*
+        """
+        if table not in VIEW_COLUMNS:
+            return
+        key = self._clean(table, row)[list(handled.TABLES[table]['columns']).index(handled.TABLES[table]['primary_key'])]
+        refresh = {
+            'protein': "p.protein_id = ?",
+            'gene': "p.gene_id = ?",
+            'taxon': "p.taxon_id = ?",
+            'assembly': "g.assembly = ?",
+        }[table]
+        with self._lock, self._connection:
+            self._upsert(table, [row])
+            self._connection.execute(self._select_join(refresh), (key,))
+
+    def _table_paths(self) -> list[str]:
+        return [os.path.join(self.directory, handled.TABLES[table]['file']) for table in VIEW_COLUMNS]
+
+    def _record_versions(self):
+        # called with _lock held
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('table_versions', ?)",
+                                     (table_versions(self._table_paths()),))
+
+    def stale(self) -> bool:
+        """
+        :return: True when a csv table changed since the view last saw it, or the view was never built
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'table_versions'").fetchone()
+        return row is None or row[0] != table_versions(self._table_paths())
+
+    def rebuild(self):
+        """
+        Loads every csv table into the store and recomputes the whole view.
+        Needed for data written before the view was attached or outside handled.write_*, see stale.
+        """
+        with self._lock:
+            with self._connection:
+                for table, path in zip(VIEW_COLUMNS, self._table_paths()):
+                    self._connection.execute(f"DELETE FROM {table}")
+                    if os.path.exists(path) and os.path.getsize(path) > 0:
+                        self._upsert(table, handled.load_to_dict(path))
+                self._connection.execute("DELETE FROM poly_view")
+                self._connection.execute(self._select_join("1"))
+            self._record_versions()
+
+    def attach(self):
+        """
+        Keeps the view updated from now on by listening to handled.write_*
+        """
+        handled.add_write_listener(self.add)
+        self._attached = True
+
+    def detach(self):
+        handled.remove_write_listener(self.add)
+        self._attached = False
+
+    def query(self, where: Optional[dict] = None, columns: Optional[list[str]] = None) -> list[dict]:
+        """
+        :param where: column=value equality filters, all of them must match
+        :param columns: columns of the view to return, all when None
+        :return: list of matching rows as dicts
+        """
+        where = where or dict()
+        selected = '*' if not columns else ', '.join(_quote(column) for column in columns)
+        clause = ' AND '.join(f"{_quote(column)} = ?" for column in where) or '1'
+        with self._lock:
+            cursor = self._connection.execute(
+                f"SELECT {selected} FROM poly_view WHERE {clause}", tuple(where.values())
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+    def by_rank(self, rank: str, name: str, poly_type: Optional[str] = None) -> list[dict]:
+        """
+        All polymerase rows under the taxon named name at the given rank, e.g. by_rank('class', 'Gammaproteobacteria')
+        """
+        if rank not in RANKS:
+            raise ValueError(f"{rank} is not one of {RANKS}")
+        where = {rank: name}
+        if poly_type is not None:
+            where['poly_type'] = poly_type
+        return self.query(where)
+
+    def by_poly_type(self, poly_type: str) -> list[dict]:
+        return self.query({'poly_type': poly_type})
+
+    def repertoire(self, rank: str) -> dict[str, dict[str, int]]:
+        """
+        Counts the polymerase types found under every taxon of the given rank.
+
+        :return: {rank name: {poly_type: count}}
+        """
+        if rank not in RANKS:
+            raise ValueError(f"{rank} is not one of {RANKS}")
+        outp = dict()
+        with self._lock:
+            cursor = self._connection.execute(
+                f"SELECT {_quote(rank)}, poly_type, COUNT(*) FROM poly_view GROUP BY {_quote(rank)}, poly_type"
+            )
+            for name, poly_type, count in cursor.fetchall():
+                outp.setdefault(name, dict())[poly_type] = count
+        return outp
+
+    def close(self):
+        """
+        Detaches the view. An attached view saw every row written since, so the current versions are recorded.
+        """
+        if self._attached:
+            with self._lock:
+                self._record_versions()
+        self.detach()
+        self._connection.close()
+
+
+if __name__ == "__main__":
+    view = JoinedView()
+    view.rebuild()
+    print(view.repertoire('class'))
@@ -0,0 +1,235 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final, Optional
+
+import numpy
+import pandas
+import scipy.sparse
+import scipy.sparse.csgraph
+
+import handled
+from FastaStore import FastaStore
+from MinHashIndex import EMPTY, PRIME
+
+ALPHABET: Final[str] = "ACDEFGHIKLMNPQRSTVWY"  # any other residue is coded as one extra letter, like X
+K: Final[int] = 5
+MAX_K: Final[int] = 7  # 21 ** 7 is still under PRIME, so a k-mer is its own hash input
+NUM_PERM: Final[int] = 64
+BANDS: Final[int] = 16  # 16 bands of 4 rows: pairs with a Jaccard similarity over ~0.5 are likely candidates
+THRESHOLD: Final[float] = 0.5
+SIMILARITIES: Final[tuple] = ('jaccard', 'containment')
+KMER_BLOCK: Final[int] = 2 ** 16  # k-mers hashed at once, bounds the memory of a block to KMER_BLOCK x NUM_PERM
+CHUNK_SEQUENCES: Final[int] = 2000  # sequences per task given to a worker process
+SMALL_BUCKET: Final[int] = 32  # buckets up to this size have all their pairs compared, larger ones a linear number
+
+_CODES: Final[numpy.ndarray] = numpy.full(256, len(ALPHABET), dtype=numpy.uint64)
+_CODES[numpy.frombuffer(ALPHABET.encode('ascii'), dtype=numpy.uint8)] = numpy.arange(len(ALPHABET))
+_CODES[numpy.frombuffer(ALPHABET.lower().encode('ascii'), dtype=numpy.uint8)] = numpy.arange(len(ALPHABET))
+
+
+def kmers(sequence: str, k: int = K) -> numpy.ndarray:
+    """
+    :return: sorted distinct k-mers of a protein sequence, each as a base 21 integer, empty when shorter than k
+    """
+    codes = _CODES[numpy.frombuffer(sequence.encode('ascii', 'replace'), dtype=numpy.uint8)]
+    if len(codes) < k:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    windows = numpy.lib.stride_tricks.sliding_window_view(codes, k)
+    weights = numpy.uint64(len(ALPHABET) + 1) ** numpy.arange(k - 1, -1, -1, dtype=numpy.uint64)
+    return numpy.unique(windows @ weights)
+
+
+def hash_functions(num_perm: int = NUM_PERM, seed: int = 1) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    :return: a and b of the num_perm hash functions (a * x + b) % PRIME
+    """
+    rng = numpy.random.default_rng(seed)
+    return rng.integers(1, PRIME, num_perm, dtype=numpy.uint64), rng.integers(0, PRIME, num_perm, dtype=numpy.uint64)
+
+
+def _hash_block(sets: list[numpy.ndarray], a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    # every set of the block is non empty, the minimum of each set is taken over its segment of the rows
+    values = numpy.concatenate(sets)
+    starts = numpy.concatenate([[0], numpy.cumsum([len(values) for values in sets[:-1]])]).astype(numpy.int64)
+    hashes = (values[:, None] * a[None, :] + b[None, :]) % numpy.uint64(PRIME)
+    return numpy.minimum.reduceat(hashes, starts, axis=0).astype(numpy.uint32)
+
+
+def signatures(sequences: list[str], k: int, a: numpy.ndarray, b: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    MinHash signatures of the k-mer sets of sequences, the k-mers of many sequences are hashed in one block.
+
+    :return: (len(sequences), len(a)) signatures, EMPTY for sequences shorter than k, and the size of every set
+    """
+    outp = numpy.full((len(sequences), len(a)), EMPTY, dtype=numpy.uint32)
+    sizes = numpy.zeros(len(sequences), dtype=numpy.int64)
+    block, rows, total = [], [], 0
+    for row, sequence in enumerate(sequences):
+        values = kmers(sequence, k)
+        sizes[row] = len(values)
+        if not len(values):
+            continue
+        block.append(values)
+        rows.append(row)
+        total += len(values)
+        if total >= KMER_BLOCK:
+            outp[rows] = _hash_block(block, a, b)
+            block, rows, total = [], [], 0
+    if block:
+        outp[rows] = _hash_block(block, a, b)
+    return outp, sizes
+
+
+def _worker_signatures(sequences: list[str], k: int, num_perm: int, seed: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+    return signatures(sequences, k, *hash_functions(num_perm, seed))
+
+
+def _bucket_pairs(members: numpy.ndarray, starts: numpy.ndarray, sizes: numpy.ndarray) -> list[numpy.ndarray]:
+    """
+    :param members: positions of the sequences of the buckets, bucket after bucket
+    :param starts: offset of every bucket in members
+    :param sizes: sequences of every bucket, at least 2
+    :return: pair arrays of the buckets. Every pair of a bucket of at most SMALL_BUCKET sequences;
+             in larger buckets every sequence with the first of its bucket and with the next one,
+             so the pairs stay linear in the sequences even for thousands of identical proteins
+    """
+    pairs = []
+    for size in numpy.unique(sizes[sizes <= SMALL_BUCKET]).tolist():
+        first, second = numpy.triu_indices(size, k=1)
+        offsets = starts[sizes == size][:, None]
+        pairs.append(numpy.stack([members[offsets + first].ravel(), members[offsets + second].ravel()], axis=1))
+    for start, size in zip(starts[sizes > SMALL_BUCKET].tolist(), sizes[sizes > SMALL_BUCKET].tolist()):
+        bucket = members[start:start + size]
+        pairs.append(numpy.stack([numpy.full(size - 1, bucket[0]), bucket[1:]], axis=1))
+        pairs.append(numpy.stack([bucket[1:-1], bucket[2:]], axis=1))
+    return pairs
+
+
+def candidate_pairs(signatures_: numpy.ndarray, bands: int = BANDS, seed: int = 1) -> numpy.ndarray:
+    """
+    Pairs of sequences sharing a band of their signatures, see _bucket_pairs for the pairs taken from a bucket.
+    Pairs are filtered by similarity afterwards, so comparing only neighbours in a bucket would let one
+    dissimilar member keep two similar ones apart.
+
+    :return: (pairs, 2) positions, each pair once
+    """
+    count, num_perm = signatures_.shape
+    if num_perm % bands:
+        raise ValueError(f"{bands} bands do not divide {num_perm} hash functions")
+    rows = num_perm // bands
+    mix = numpy.random.default_rng(seed).integers(1, 1 << 63, rows, dtype=numpy.uint64) | numpy.uint64(1)
+    keys = (signatures_.reshape(count, bands, rows).astype(numpy.uint64) * mix[None, None, :]).sum(axis=2)
+    empty = (signatures_ == EMPTY).all(axis=1)
+    pairs = []
+    for band in range(bands):
+        order = numpy.argsort(keys[:, band], kind='stable')
+        order = order[~empty[order]]
+        band_keys = keys[order, band]
+        starts = numpy.flatnonzero(numpy.concatenate([[True], band_keys[1:] != band_keys[:-1]]))
+        sizes = numpy.diff(numpy.append(starts, len(order)))
+        pairs.extend(_bucket_pairs(order, starts[sizes > 1], sizes[sizes > 1]))
+    pairs = numpy.concatenate(pairs) if pairs else numpy.zeros((0, 2), dtype=numpy.int64)
+    return numpy.unique(numpy.sort(pairs, axis=1), axis=0)
+
+
+def similarity(signatures_: numpy.ndarray, sizes: numpy.ndarray, pairs: numpy.ndarray,
+               kind: str = 'jaccard') -> numpy.ndarray:
+    """
+    Similarity of every pair estimated from the signatures, without going back to the sequences.
+    The Jaccard similarity is the share of equal signature values, the containment of the smaller set
+    in the larger one follows from it and the exact set sizes: |A & B| = J (|A| + |B|) / (1 + J).
+
+    :param kind: 'jaccard', or 'containment' to also join fragments to their full length protein
+    """
+    if kind not in SIMILARITIES:
+        raise ValueError(f"{kind} is not one of {SIMILARITIES}")
+    jaccard = (signatures_[pairs[:, 0]] == signatures_[pairs[:, 1]]).mean(axis=1)
+    if kind == 'jaccard':
+        return jaccard
+    size_a, size_b = sizes[pairs[:, 0]], sizes[pairs[:, 1]]
+    shared = jaccard * (size_a + size_b) / (1 + jaccard)
+    return numpy.minimum(shared / numpy.maximum(numpy.minimum(size_a, size_b), 1), 1.0)
+
+
+def cluster(sequences: list[str], k: int = K, threshold: float = THRESHOLD, kind: str = 'jaccard',
+            num_perm: int = NUM_PERM, bands: int = BANDS, workers: int = 1, seed: int = 1) -> numpy.ndarray:
+    """
+    Single linkage clusters of protein sequences by k-mer similarity: pairs found by banding the MinHash
+    signatures and estimated at threshold or more are joined, and the connected components are the clusters.
+    Signatures are computed by CHUNK_SEQUENCES at a time, spread over processes with workers > 1.
+
+    :param k: residues per k-mer, at most MAX_K
+    :param threshold: least similarity of a joined pair
+    :param kind: 'jaccard' or 'containment', see similarity
+    :param workers: processes, 0 for one per core
+    :return: cluster of every sequence, from 0
+    """
+    if not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be between 1 and {MAX_K}")
+    if not sequences:
+        return numpy.zeros(0, dtype=numpy.int64)
+    workers = (os.cpu_count() or 1) if workers == 0 else workers
+    chunks = [sequences[start:start + CHUNK_SEQUENCES] for start in range(0, len(sequences), CHUNK_SEQUENCES)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = [future.result() for future in
+                       [executor.submit(_worker_signatures, chunk, k, num_perm, seed) for chunk in chunks]]
+    else:
+        results = [_worker_signatures(chunk, k, num_perm, seed) for chunk in chunks]
+    signatures_ = numpy.concatenate([result[0] for result in results])
+    sizes = numpy.concatenate([result[1] for result in results])
+    pairs = candidate_pairs(signatures_, bands, seed)
+    pairs = pairs[similarity(signatures_, sizes, pairs, kind) >= threshold]
+    graph = scipy.sparse.coo_matrix((numpy.ones(len(pairs), dtype=numpy.int8), (pairs[:, 0], pairs[:, 1])),
+                                    shape=(len(sequences), len(sequences)))
+    return scipy.sparse.csgraph.connected_components(graph, directed=False)[1].astype(numpy.int64)
+
+
+def cluster_proteins(store: Optional[FastaStore] = None, out_file: Optional[str] = None,
+                     **kwargs) -> pandas.DataFrame:
+    """
+    Clusters the stored sequence of every protein of protein.csv, separately within each poly type,
+    and writes protein_cluster.csv. Cluster ids are the poly type and a number, e.g. 'B-17', numbered from the
+    largest cluster down, and the representative of a cluster is its longest sequence.
+    Proteins without a downloaded sequence are left out, see FastaStore.download.
+
+    :param kwargs: given to cluster
+    :return: the rows written
+    """
+    store = FastaStore() if store is None else store
+    out_file = handled.table_file('protein_cluster') if out_file is None else out_file
+    proteins = handled.load_table('protein')[['protein_id', 'poly_type']].dropna(subset=['protein_id'])
+    proteins = proteins.drop_duplicates('protein_id', keep='last')
+    proteins = proteins[[str(protein_id) in store for protein_id in proteins['protein_id']]]
+    frames = []
+    for poly_type, group in proteins.groupby(proteins['poly_type'].astype(object).fillna(''), sort=True):
+        ids = group['protein_id'].astype('int64').to_numpy()
+        sequences = store.sequences(ids)
+        labels = cluster(sequences, **kwargs)
+        lengths = numpy.array([len(sequence) for sequence in sequences], dtype=numpy.int64)
+        # number from the largest cluster, the representative is the first sequence of its cluster once
+        # sorted by length descending
+        sizes = numpy.bincount(labels)
+        rank = numpy.empty_like(sizes)
+        rank[numpy.argsort(-sizes, kind='stable')] = numpy.arange(len(sizes))
+        order = numpy.lexsort((-lengths, labels))
+        first = order[numpy.concatenate([[True], labels[order][1:] != labels[order][:-1]])]
+        representative = numpy.empty_like(sizes)
+        representative[labels[first]] = ids[first]
+        frames.append(pandas.DataFrame({
+            'protein_id': ids,
+            'poly_type': poly_type or None,
+            'cluster_id': [f"{poly_type or '-'}-{label}" for label in rank[labels].tolist()],
+            'representative': representative[labels],
+        }))
+    columns = list(handled.TABLES['protein_cluster']['columns'])
+    outp = pandas.concat(frames, ignore_index=True) if frames else pandas.DataFrame(columns=columns)
+    tmp_file = out_file + '.tmp'
+    outp[columns].to_csv(tmp_file, index=False)
+    os.replace(tmp_file, out_file)
+    return outp
+
+
+if __name__ == "__main__":
+    _clusters = cluster_proteins(workers=0)
+    print(_clusters.groupby('poly_type')['cluster_id'].nunique())
@@ -0,0 +1,223 @@
+import glob
+import heapq
+import os
+import tempfile
+from itertools import groupby
+from typing import Callable, Final, Iterator, Optional, Sequence
+
+import handled
+
+RUN_ROWS: Final[int] = 200000  # rows sorted in memory at a time
+FAN_IN: Final[int] = 128  # runs merged at once, bounds the open files
+
+
+def find_fragments(table: str, directory: str = '.') -> list[str]:
+    """
+    Every file holding rows of table in directory: the table file itself and the files of each shard.
+    Ordered from the oldest to the most recently modified, the order last writer wins resolves in.
+    """
+    stem, ext = os.path.splitext(handled.TABLES[table]['file'])
+    paths = glob.glob(os.path.join(directory, f"{stem}{ext}")) + \
+        glob.glob(os.path.join(directory, f"{stem}.shard-*-of-*{ext}"))
+    return sorted(paths, key=os.path.getmtime)
+
+
+class _Fragment:
+    """
+    Reads the rows of one fragment in the declared column order of its table.
+    """
+
+    def __init__(self, path: str, columns: list[str]):
+        self.path: str = path
+        self.columns: list[str] = columns
+
+    def rows(self) -> Iterator[list[str]]:
+        with open(self.path, 'r') as f:
+            header = f.readline().rstrip('\n').split(',')
+            missing = set(self.columns) - set(header)
+            if missing:
+                raise ValueError(f"{self.path} is missing the columns {sorted(missing)}")
+            order = [header.index(column) for column in self.columns]
+            for line in f:
+                values = line.rstrip('\n').split(',')
+                if len(values) != len(header):
+                    print(f"Skipping malformed row of {self.path}: {line!r}")
+                    continue
+                yield [values[index] for index in order]
+
+
+class TableMerger:
+    """
+    External sort/merge of any number of fragments of one table on its primary key.
+
+    Rows are sorted in runs of at most run_rows rows that are spilled to temporary files,
+    the runs are then merged FAN_IN at a time so memory stays bounded for any input size.
+    Of the rows sharing a key the one with the highest version is kept. The version is the
+    version column when one is given, then the position of the fragment and of the row in it,
+    so without a version column the last writer wins.
+    """
+
+    def __init__(self, table: str, version_column: Optional[str] = None, run_rows: int = RUN_ROWS,
+                 tmp_dir: Optional[str] = None, fan_in: int = FAN_IN):
+        """
+        :param table: key of the table in handled.TABLES
+        :param version_column: column deciding which duplicate is kept, highest wins
+        :param run_rows: rows held in memory while sorting
+        :param tmp_dir: directory for the sorted runs, the system default when None
+        :param fan_in: runs merged at once, at least 2
+        """
+        if fan_in < 2:
+            raise ValueError(f"fan_in must be at least 2, not {fan_in}")
+        spec = handled.TABLES[table]
+        self.table: str = table
+        self.columns: list[str] = list(spec['columns'])
+        if version_column is not None and version_column not in self.columns:
+            raise ValueError(f"{version_column} is not a column of {table}")
+        self.version_column: Optional[str] = version_column
+        self.run_rows: int = run_rows
+        self.tmp_dir: Optional[str] = tmp_dir
+        self.fan_in: int = fan_in
+        self._key_index: int = self.columns.index(spec['primary_key'])
+        self._key: Callable[[str], tuple] = self._sort_value(spec['columns'][spec['primary_key']])
+        self._version_index: Optional[int] = None if version_column is None else self.columns.index(version_column)
+        self._version: Optional[Callable[[str], tuple]] = None if version_column is None else \
+            self._sort_value(spec['columns'][version_column])
+        self.rows_read: int = 0
+        self.rows_written: int = 0
+
+    @staticmethod
+    def _sort_value(kind: str) -> Callable[[str], tuple]:
+        # nulls sort first, ints sort numerically
+        def sort_value(value: str) -> tuple:
+            if value in handled.NULL_VALUES:
+                return (0, 0)
+            if kind == 'int':
+                try:
+                    return (1, int(value))
+                except ValueError:
+                    return (2, value)
+            return (2, value)
+        return sort_value
+
+    def _order(self, record: tuple) -> tuple:
+        # record is (fragment index, row index, values)
+        values = record[2]
+        version = () if self._version is None else self._version(values[self._version_index])
+        return self._key(values[self._key_index]), version, record[0], record[1]
+
+    def _spill(self, records: list[tuple]) -> str:
+        records.sort(key=self._order)
+        fd, path = tempfile.mkstemp(prefix=f"{self.table}-run-", suffix='.tsv', dir=self.tmp_dir)
+        with os.fdopen(fd, 'w') as out:
+            for fragment, row, values in records:
+                out.write(f"{fragment}\t{row}\t{','.join(values)}\n")
+        return path
+
+    @staticmethod
+    def _read_run(path: str) -> Iterator[tuple]:
+        with open(path, 'r') as f:
+            for line in f:
+                fragment, row, values = line.rstrip('\n').split('\t', 2)
+                yield int(fragment), int(row), values.split(',')
+
+    def _merge_runs(self, runs: list[str], created: list[str]) -> Iterator[tuple]:
+        """
+        :param created: the runs merged into intermediate files are appended to it, for merge to delete
+        """
+        while len(runs) > self.fan_in:
+            merged = []
+            for start in range(0, len(runs), self.fan_in):
+                group = runs[start:start + self.fan_in]
+                merged.append(self._spill_merged(group, created))
+                for path in group:
+                    os.remove(path)
+            runs = merged
+        return heapq.merge(*(self._read_run(path) for path in runs), key=self._order)
+
+    def _spill_merged(self, runs: list[str], created: list[str]) -> str:
+        fd, path = tempfile.mkstemp(prefix=f"{self.table}-run-", suffix='.tsv', dir=self.tmp_dir)
+        created.append(path)
+        with os.fdopen(fd, 'w') as out:
+            for fragment, row, values in heapq.merge(*(self._read_run(run) for run in runs), key=self._order):
+                out.write(f"{fragment}\t{row}\t{','.join(values)}\n")
+        return path
+
+    def merge(self, fragments: Sequence[str], out_file: str) -> int:
+        """
+        Merges the fragments into a single deduplicated table sorted by primary key.
+        out_file may be one of the fragments, it is only replaced once the merge finished.
+
+        :param fragments: csv files of the table, later files win ties of last writer wins
+        :param out_file: csv to write
+        :return: number of rows written
+        """
+        runs: list[str] = []
+        created: list[str] = []  # merged runs of the intermediate levels
+        tmp_out = out_file + '.merging'
+        try:
+            records: list[tuple] = []
+            for fragment_index, path in enumerate(fragments):
+                for row_index, values in enumerate(_Fragment(path, self.columns).rows()):
+                    if values[self._key_index] in handled.NULL_VALUES:
+                        continue
+                    records.append((fragment_index, row_index, values))
+                    self.rows_read += 1
+                    if len(records) >= self.run_rows:
+                        runs.append(self._spill(records))
+                        records = []
+            if records:
+                runs.append(self._spill(records))
+            del records
+
+            self.rows_written = 0
+            with open(tmp_out, 'w') as out:
+                out.write(f"{','.join(self.columns)}\n")
+                ordered = self._merge_runs(runs, created)
+                for _, duplicates in groupby(ordered, key=lambda record: self._key(record[2][self._key_index])):
+                    *_, newest = duplicates
+                    out.write(f"{','.join(newest[2])}\n")
+                    self.rows_written += 1
+            os.replace(tmp_out, out_file)
+        finally:
+            for path in runs + created + [tmp_out]:
+                if os.path.exists(path):
+                    os.remove(path)
+        return self.rows_written
+
+
+def merge_tables(directory: str = '.', out_dir: Optional[str] = None,
+                 tables: Sequence[str] = ('gene', 'protein', 'taxon', 'node'),
+                 version_column: Optional[str] = None, extra: Optional[dict[str, list[str]]] = None) -> dict[str, int]:
+    """
+    Merges the shard and partial files of each table into one canonical table set.
+
+    :param directory: directory searched for fragments
+    :param out_dir: directory of the merged tables, defaults to directory so the table files are replaced
+    :param tables: tables of handled.TABLES to merge
+    :param version_column: column deciding which duplicate is kept, tables without it use last writer wins
+    :param extra: more fragments per table, e.g. copied over from other machines. They rank after the found ones.
+    :return: rows written per table
+    """
+    out_dir = directory if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    outp = dict()
+    for table in tables:
+        fragments = find_fragments(table, directory) + list((extra or dict()).get(table, []))
+        if not fragments:
+            continue
+        column = version_column if version_column in handled.TABLES[table]['columns'] else None
+        merger = TableMerger(table, version_column=column)
+        outp[table] = merger.merge(fragments, os.path.join(out_dir, handled.TABLES[table]['file']))
+        print(f"{table}: {merger.rows_read:,} rows in {len(fragments)} fragments -> {outp[table]:,} rows")
+    return outp
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge and deduplicate shard or partial output tables")
+    parser.add_argument('--dir', default='.', help="directory holding the fragments")
+    parser.add_argument('--out', default=None, help="directory of the merged tables, defaults to --dir")
+    parser.add_argument('--tables', nargs='*', default=['gene', 'protein', 'taxon', 'node'])
+    parser.add_argument('--version-column', default=None, help="keep the duplicate with the highest value")
+    args = parser.parse_args()
+    merge_tables(args.dir, args.out, args.tables, args.version_column)
@@ -0,0 +1,258 @@
+import os
+from typing import Final, Iterable, Optional
+
+import numpy
+
+import handled
+from Repertoire import table_versions
+
+INDEX_PATH: Final[str] = "minhash_index.npz"
+NUM_PERM: Final[int] = 128
+BANDS: Final[int] = 32  # 32 bands of 4 rows: sets with a Jaccard similarity over ~0.42 are likely candidates
+PRIME: Final[int] = (1 << 31) - 1  # small enough that a * x + b stays in uint64
+EMPTY: Final[int] = PRIME  # signature value of an empty set
+
+
+def _stored_version(stored) -> Optional[str]:
+    # index files saved before versions were kept have none, and are rebuilt
+    return (str(stored['version']) if 'version' in stored.files else '') or None
+
+
+class MinHashIndex:
+    """
+    Locality sensitive index of the CDD domains of every organism, to find genomes with a similar polymerase
+    complement without comparing against the whole catalog.
+
+    Each organism's set of CDD uids gets a MinHash signature of NUM_PERM values. The signature is cut into bands,
+    and organisms sharing a band land in the same bucket. A query only looks at the organisms it shares a bucket with,
+    then ranks them by their exact Jaccard similarity. Signatures can be updated in place as the sets grow,
+    so new proteins are inserted without rebuilding. save writes the signatures and sets to one npz file,
+    and the buckets are rebuilt from it when loading.
+
+    >>> index = MinHashIndex.build()
+    >>> index.similar(208964)
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, bands: int = BANDS, seed: int = 1):
+        """
+        :param num_perm: hash functions per signature
+        :param bands: bands the signature is cut into, must divide num_perm
+        :param seed: seed of the hash functions, kept in the index file
+        """
+        if num_perm % bands:
+            raise ValueError(f"{bands} bands do not divide {num_perm} hash functions")
+        self.num_perm: int = num_perm
+        self.bands: int = bands
+        self.rows: int = num_perm // bands
+        self.seed: int = seed
+        rng = numpy.random.default_rng(seed)
+        self._a: numpy.ndarray = rng.integers(1, PRIME, num_perm, dtype=numpy.uint64)
+        self._b: numpy.ndarray = rng.integers(0, PRIME, num_perm, dtype=numpy.uint64)
+        self._mix: numpy.ndarray = rng.integers(1, 1 << 63, self.rows, dtype=numpy.uint64) | numpy.uint64(1)
+        self.ids: list[int] = []
+        self._position: dict[int, int] = dict()
+        self._signatures: list[numpy.ndarray] = []
+        self._sets: list[set[int]] = []
+        self._keys: list[numpy.ndarray] = []
+        self._buckets: list[dict[int, list[int]]] = [dict() for _ in range(bands)]
+        self.version: Optional[str] = None  # table_versions of the protein.csv the index was built from
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, taxon_id) -> bool:
+        return int(taxon_id) in self._position
+
+    def signature(self, values: Iterable) -> numpy.ndarray:
+        """
+        :return: MinHash signature of a set of CDD uids
+        """
+        values = numpy.fromiter((int(value) % PRIME for value in values), dtype=numpy.uint64)
+        if not len(values):
+            return numpy.full(self.num_perm, EMPTY, dtype=numpy.uint32)
+        hashes = (values[:, None] * self._a[None, :] + self._b[None, :]) % numpy.uint64(PRIME)
+        return hashes.min(axis=0).astype(numpy.uint32)
+
+    def _band_keys(self, signature: numpy.ndarray) -> numpy.ndarray:
+        bands = signature.reshape(self.bands, self.rows).astype(numpy.uint64)
+        return (bands * self._mix[None, :]).sum(axis=1)
+
+    def _bucket(self, position: int):
+        for band, key in enumerate(self._keys[position].tolist()):
+            self._buckets[band].setdefault(key, []).append(position)
+
+    def _unbucket(self, position: int):
+        for band, key in enumerate(self._keys[position].tolist()):
+            members = self._buckets[band][key]
+            members.remove(position)
+            if not members:
+                del self._buckets[band][key]
+
+    def add(self, taxon_id, values: Iterable):
+        """
+        Inserts an organism or adds CDD uids to its set, it is only moved between buckets when its signature changes.
+        """
+        taxon_id = int(taxon_id)
+        values = {int(value) for value in values}
+        position = self._position.get(taxon_id)
+        if position is None:
+            position = len(self.ids)
+            self.ids.append(taxon_id)
+            self._position[taxon_id] = position
+            self._sets.append(set())
+            self._signatures.append(numpy.full(self.num_perm, EMPTY, dtype=numpy.uint32))
+            self._keys.append(self._band_keys(self._signatures[position]))
+            self._bucket(position)
+        new_values = values - self._sets[position]
+        if not new_values:
+            return
+        self._sets[position] |= new_values
+        signature = numpy.minimum(self._signatures[position], self.signature(new_values))
+        if numpy.array_equal(signature, self._signatures[position]):
+            return
+        self._unbucket(position)
+        self._signatures[position] = signature
+        self._keys[position] = self._band_keys(signature)
+        self._bucket(position)
+
+    def add_many(self, sets: dict):
+        """
+        Inserts many organisms at once, signatures are computed a block of organisms at a time.
+
+        :param sets: taxon id -> CDD uids
+        """
+        fresh = {int(taxon_id): {int(value) for value in values} for taxon_id, values in sets.items()
+                 if int(taxon_id) not in self._position}
+        for taxon_id, values in sets.items():
+            if int(taxon_id) in self._position:
+                self.add(taxon_id, values)
+        if not fresh:
+            return
+        start = len(self.ids)
+        signatures = numpy.stack([self.signature(values) for values in fresh.values()])
+        self._signatures.extend(signatures)
+        bands = signatures.reshape(len(fresh), self.bands, self.rows).astype(numpy.uint64)
+        keys = (bands * self._mix[None, None, :]).sum(axis=2)
+        for offset, (taxon_id, values) in enumerate(fresh.items()):
+            self.ids.append(taxon_id)
+            self._position[taxon_id] = start + offset
+            self._sets.append(values)
+            self._keys.append(keys[offset])
+            self._bucket(start + offset)
+
+    def candidates(self, signature: numpy.ndarray) -> set[int]:
+        """
+        :return: positions of the organisms sharing at least one band with signature
+        """
+        outp = set()
+        for band, key in enumerate(self._band_keys(signature).tolist()):
+            outp.update(self._buckets[band].get(key, ()))
+        return outp
+
+    def similar(self, query, k: int = 10, threshold: float = 0.0) -> list[tuple[int, float]]:
+        """
+        Approximate nearest neighbours of an organism of the index or of a set of CDD uids.
+
+        :param query: taxon id in the index, or an iterable of CDD uids
+        :param k: neighbours returned at most
+        :param threshold: least Jaccard similarity returned
+        :return: (taxon id, exact Jaccard similarity), most similar first, without the queried organism
+        """
+        if isinstance(query, (int, str, numpy.integer)):
+            position = self._position[int(query)]
+            values, signature, skip = self._sets[position], self._signatures[position], position
+        else:
+            values = {int(value) for value in query}
+            signature, skip = self.signature(values), None
+        scored = []
+        for position in self.candidates(signature):
+            if position == skip:
+                continue
+            other = self._sets[position]
+            union = len(values | other)
+            similarity = len(values & other) / union if union else 1.0
+            if similarity >= threshold:
+                scored.append((self.ids[position], similarity))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:k]
+
+    def listen(self, table: str, row: dict):
+        """
+        Adds the domain of every new protein row, matches the handled.add_write_listener signature.
+        """
+        if table != 'protein' or str(row.get('taxon_id')) in handled.NULL_VALUES or \
+                str(row.get('cdd_id')) in handled.NULL_VALUES:
+            return
+        self.add(row['taxon_id'], [row['cdd_id']])
+
+    def attach(self):
+        """
+        Keeps the index updated from now on by listening to handled.write_*
+        """
+        handled.add_write_listener(self.listen)
+
+    def detach(self):
+        handled.remove_write_listener(self.listen)
+
+    def save(self, path: str = INDEX_PATH):
+        sizes = numpy.array([len(values) for values in self._sets], dtype=numpy.int64)
+        members = numpy.fromiter((value for values in self._sets for value in sorted(values)), dtype=numpy.int64,
+                                 count=int(sizes.sum()))
+        tmp_path = path + '.tmp.npz'
+        signatures = numpy.zeros((0, self.num_perm), dtype=numpy.uint32)
+        if self._signatures:
+            signatures = numpy.stack(self._signatures)
+        numpy.savez(tmp_path, ids=numpy.array(self.ids, dtype=numpy.int64), signatures=signatures,
+                    offsets=numpy.concatenate([[0], numpy.cumsum(sizes)]), members=members,
+                    params=numpy.array([self.num_perm, self.bands, self.seed], dtype=numpy.int64),
+                    version=numpy.array(self.version or ''))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "MinHashIndex":
+        with numpy.load(path, allow_pickle=False) as stored:
+            num_perm, bands, seed = (int(value) for value in stored['params'])
+            index = cls(num_perm, bands, seed)
+            offsets, members = stored['offsets'], stored['members']
+            index.ids = stored['ids'].tolist()
+            signatures = stored['signatures']
+            index.version = _stored_version(stored)
+        index._position = {taxon_id: position for position, taxon_id in enumerate(index.ids)}
+        index._sets = [set(members[offsets[i]:offsets[i + 1]].tolist()) for i in range(len(index.ids))]
+        index._signatures = list(signatures)
+        keys = (signatures.reshape(len(index.ids), index.bands, index.rows).astype(numpy.uint64)
+                * index._mix[None, None, :]).sum(axis=2)
+        index._keys = list(keys)
+        for position in range(len(index.ids)):
+            index._bucket(position)
+        return index
+
+    @classmethod
+    def build(cls, path: Optional[str] = INDEX_PATH, **kwargs) -> "MinHashIndex":
+        """
+        Loads the index file when it was built from the current protein.csv, else indexes protein.csv
+        and saves the index to path. protein.csv is compared by size and modification time, see table_versions,
+        so proteins collected since the file was saved are never missed.
+        """
+        protein_file = handled.table_file('protein')
+        version = table_versions([protein_file])
+        if path is not None and os.path.exists(path):
+            with numpy.load(path, allow_pickle=False) as stored:
+                current = _stored_version(stored) == version
+            if current:
+                return cls.load(path)
+        frame = handled.load_table('protein', protein_file)[['taxon_id', 'cdd_id']].dropna()
+        sets = frame.groupby('taxon_id')['cdd_id'].agg(lambda values: set(values.astype('int64').tolist()))
+        index = cls(**kwargs)
+        index.add_many(sets.to_dict())
+        index.version = version
+        if path is not None:
+            index.save(path)
+        return index
+
+
+if __name__ == "__main__":
+    import sys
+    _index = MinHashIndex.build()
+    for _taxon_id, _similarity in _index.similar(int(sys.argv[1]) if len(sys.argv) > 1 else 208964):
+        print(_taxon_id, f"{_similarity:.3f}")
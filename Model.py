@@ -1,5 +1,13 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, asdict
+from collections.abc import Sequence
+from dataclasses import dataclass, asdict, fields, is_dataclass
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, ClassVar, Iterable, Iterator, Optional, Union
+
+import numpy
+
+import SymbolTable
 
 # TODO make Taxon and CDD both inherit a TreeNCBIData class that
 #      will allow for easy construction of their Linage
@@ -28,6 +36,52 @@ def flatten_with_ids(inp: dict, second=False):
     inp.update(new_values)
     return inp
 
+def _flatten_plan(record, prefix: str = '', second: bool = False) -> dict[str, str]:
+    """
+    Column -> attribute path of the values flatten_with_ids(asdict(record)) gives,
+    in the same column order and with nested columns overwriting top level ones the same way.
+    """
+    plan, new_values = dict(), dict()
+    for item in fields(record):
+        value = getattr(record, item.name)
+        path = prefix + item.name
+        if isinstance(value, NCBIId):
+            if not second:
+                plan[item.name] = path + '.uid'
+            else:
+                new_values[value.db + "_id"] = path + '.uid'
+        elif is_dataclass(value):
+            new_values.update(_flatten_plan(value, path + '.', second=True))
+        else:
+            plan[item.name] = path
+    plan.update(new_values)
+    return plan
+
+
+def _plan_shape(plan: dict[str, str]) -> Callable[[object], tuple]:
+    """
+    :return: function giving what the plan of a record depends on: the id, and its database, behind every uid
+             column and whether every other column holds a plain value. Records with the same shape as the
+             record the plan was made from flatten to the same columns.
+    """
+    paths = list(dict.fromkeys(path[:-len('.uid')] if path.endswith('.uid') else path for path in plan.values()))
+    getter = attrgetter(*paths)
+
+    def shape(record) -> tuple:
+        values = getter(record) if len(paths) > 1 else (getter(record),)
+        return tuple(value.db if isinstance(value, NCBIId) else is_dataclass(value) for value in values)
+    return shape
+
+
+def _column_array(values: tuple, numeric: bool) -> numpy.ndarray:
+    if numeric:
+        try:
+            return numpy.array(values, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return numpy.array(values, dtype=object)
+
+
 @dataclass(slots=True, frozen=True, order=True)
 class NCBIId:
     """
@@ -37,6 +91,144 @@ class NCBIId:
     uid: str
 
 
+class NCBIIdBatch(Sequence):
+    """
+    Ids of one NCBI database stored as a single int64 array instead of one NCBIId per id.
+    Slices and chunks are views of the same array.
+
+    Indexing gives an NCBIId so a batch can stand in for a list of NCBIId.
+
+    :ivar db: database of every id
+    :ivar uids: the numeric uids
+    """
+    __slots__ = ('db', 'uids')
+
+    def __init__(self, db: str, uids: Union[Iterable, numpy.ndarray]):
+        """
+        :param db: database of the ids
+        :param uids: numeric uids as ints or strings
+        :raises ValueError: when a uid is not numeric, e.g. an accession
+        """
+        self.db: str = db
+        if isinstance(uids, numpy.ndarray):
+            self.uids: numpy.ndarray = uids.astype(numpy.int64, copy=False)
+        else:
+            self.uids = numpy.array([int(uid) for uid in uids], dtype=numpy.int64)
+
+    @classmethod
+    def coerce(cls, db: str, ids: Iterable) -> Union["NCBIIdBatch", list[NCBIId]]:
+        """
+        Batch of ids when they are all numeric, else the list of NCBIId the factory used so far.
+        """
+        if isinstance(ids, cls):
+            return ids
+        ids = [getattr(_id, 'uid', _id) for _id in ids]
+        try:
+            return cls(db, ids)
+        except (ValueError, TypeError, OverflowError):
+            return [NCBIId(db, str(_id)) for _id in ids]
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return NCBIIdBatch(self.db, self.uids[index])
+        return NCBIId(self.db, str(int(self.uids[index])))
+
+    def __iter__(self) -> Iterator[NCBIId]:
+        return (NCBIId(self.db, uid) for uid in self.tolist())
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, NCBIId):
+            if item.db != self.db:
+                return False
+            item = item.uid
+        try:
+            return bool((self.uids == int(item)).any())
+        except (ValueError, TypeError):
+            return False
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, NCBIIdBatch) and self.db == other.db and numpy.array_equal(self.uids, other.uids)
+
+    def __hash__(self):
+        return hash((self.db, self.uids.tobytes()))
+
+    def __repr__(self) -> str:
+        return f"NCBIIdBatch({self.db!r}, {len(self)} ids)"
+
+    def tolist(self) -> list[str]:
+        """
+        :return: the uids as strings
+        """
+        return [str(uid) for uid in self.uids.tolist()]
+
+    def join(self, sep: str = ',') -> str:
+        """
+        :return: the uids joined by sep, as placed in a request
+        """
+        return sep.join(map(str, self.uids.tolist()))
+
+    def encoded_lengths(self) -> numpy.ndarray:
+        """
+        :return: characters of every uid once written out
+        """
+        digits = numpy.ones(len(self.uids), dtype=numpy.int64)
+        values = numpy.abs(self.uids)
+        while True:
+            values = values // 10
+            more = values > 0
+            if not more.any():
+                break
+            digits += more
+        return digits + (self.uids < 0)
+
+    def chunks(self, size: int) -> Iterator["NCBIIdBatch"]:
+        """
+        :return: views of at most size ids each
+        """
+        for start in range(0, len(self), size):
+            yield self[start:start + size]
+
+    def _check_db(self, other: "NCBIIdBatch"):
+        if self.db != other.db:
+            raise ValueError(f"Cannot combine ids of {self.db} and {other.db}")
+
+    def unique(self) -> "NCBIIdBatch":
+        """
+        :return: the batch without repeated uids, in first seen order
+        """
+        _, first = numpy.unique(self.uids, return_index=True)
+        return NCBIIdBatch(self.db, self.uids[numpy.sort(first)])
+
+    def union(self, other: "NCBIIdBatch") -> "NCBIIdBatch":
+        """
+        :return: the ids of both batches without repeats, those of this batch first, in first seen order
+        """
+        self._check_db(other)
+        return NCBIIdBatch(self.db, numpy.concatenate([self.uids, other.uids])).unique()
+
+    def intersection(self, other: "NCBIIdBatch") -> "NCBIIdBatch":
+        """
+        :return: the ids also in other without repeats, in the order of this batch
+        """
+        self._check_db(other)
+        unique = self.unique().uids
+        return NCBIIdBatch(self.db, unique[numpy.isin(unique, other.uids)])
+
+    def difference(self, other: "NCBIIdBatch") -> "NCBIIdBatch":
+        """
+        :return: the ids not in other, in the order of this batch
+        """
+        self._check_db(other)
+        return NCBIIdBatch(self.db, self.uids[~numpy.isin(self.uids, other.uids)])
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
 @dataclass(slots=True, frozen=True, eq=True)
 class NCBIData(ABC):
     """
@@ -48,6 +240,43 @@ class NCBIData(ABC):
         results_data = asdict(self)
         return flatten_with_ids(results_data)
 
+    @classmethod
+    def flatten_batch(cls, records: Sequence["NCBIData"]) -> dict[str, numpy.ndarray]:
+        """
+        flatten_results of many records of the same class at once, as one array per column.
+        Nothing is copied per record: the columns are read straight off the records in a single pass,
+        uids and int fields become int64 arrays and everything else object arrays.
+        The columns are planned from the first record, so every record must have the same shape:
+        ids, and the databases of nested ids, at the same places, e.g. cdd_id, and no nested record
+        where the first has a plain value or None. Int columns are the uids and the fields holding an int
+        in every record, any other mix of values stays an object column.
+
+        :param records: Assembly, Taxon, Protein or Domain records all of one class
+        :return: column name -> values, in the column order of flatten_results
+        :raises ValueError: when a record is not shaped like the first one
+        """
+        if not records:
+            return dict()
+        record_type = type(records[0])
+        if not issubclass(record_type, cls) or any(type(record) is not record_type for record in records):
+            raise TypeError(f"flatten_batch needs records of a single {cls.__name__} class")
+        plan = _flatten_plan(records[0])
+        shape = _plan_shape(plan)
+        expected = shape(records[0])
+        for position, record in enumerate(records):
+            try:
+                matches = shape(record) == expected
+            except AttributeError:
+                matches = False
+            if not matches:
+                raise ValueError(f"Record {position} of flatten_batch is not shaped like the first one, "
+                                 f"use flatten_results: {record!r}")
+        getter = attrgetter(*plan.values())
+        rows = [getter(record) for record in records]
+        columns = zip(*rows) if len(plan) > 1 else [tuple(rows)]
+        return {column: _column_array(values, path.endswith('.uid') or all(type(value) is int for value in values))
+                for (column, path), values in zip(plan.items(), columns)}
+
     def __post_init__(self):
         self.verify()
 
@@ -121,15 +350,152 @@ class Protein(NCBIData):
     def verify(self):
         assert self.id.db == 'protein'
 
-# TODO implement gene dataclass
-# @dataclass(slots=True)
-# class Gene:
-#     Uuid: NCBIId
-#     name: Optional[str]
-#     symbol: Optional[str]
-#     size: Optional[int]
-#     Taxon: Optional[Taxon]
-#     Assemblies: Optional[List[NCBIId]]
+class TableRecord:
+    """
+    Base of the typed rows carried through main.run, one subclass per output table.
+
+    Values keep their types (ints stay ints) and are checked once, when the record is made.
+    They only become strings at the csv boundary through to_row or columns.
+    A trailing underscore in a field name is dropped from its column, e.g. class_ is the class column.
+    """
+    __slots__ = ()
+    table: ClassVar[str] = ''
+
+    def __post_init__(self):
+        # repeated strings, e.g. assemblies and taxon names, are kept once through their symbol table
+        for name, column in _symbol_fields(type(self)):
+            setattr(self, name, SymbolTable.symbols_of(column).intern(getattr(self, name)))
+        self.verify()
+
+    def verify(self) -> None:
+        pass
+
+    @classmethod
+    def column_names(cls) -> list[tuple[str, str]]:
+        """
+        :return: (field, column) of every field
+        """
+        return [(item.name, item.name.rstrip('_')) for item in fields(cls)]
+
+    @classmethod
+    def from_row(cls, row: dict):
+        """
+        Builds a record from a row dict as read from a table or the server.
+        Columns missing from row become None, int fields are parsed from strings.
+        """
+        kwargs = dict()
+        for item in fields(cls):
+            value = row.get(item.name.rstrip('_'))
+            if value is not None and str(value) in ('', 'None'):
+                value = None
+            if value is not None and item.type in (int, Optional[int]):
+                value = int(value)
+            elif value is not None and item.type in (str, Optional[str]):
+                value = str(value)
+            kwargs[item.name] = value
+        return cls(**kwargs)
+
+    def to_row(self) -> dict[str, Optional[str]]:
+        """
+        :return: the record in the enforce_str_dict format, a dict of str or None per column
+        """
+        return {column: None if getattr(self, name) is None else str(getattr(self, name))
+                for name, column in self.column_names()}
+
+    @classmethod
+    def columns(cls, records: Sequence["TableRecord"]) -> dict[str, list[str]]:
+        """
+        Converts records to csv cells a column at a time, None is written as 'None' like write_to_table does.
+        """
+        outp = dict()
+        for name, column in cls.column_names():
+            outp[column] = [str(value).replace(',', ' ') for value in (getattr(record, name) for record in records)]
+        return outp
+
+
+@lru_cache(maxsize=None)
+def _symbol_fields(record_type: type) -> tuple[tuple[str, str], ...]:
+    categories = SymbolTable.category_columns(record_type.table)
+    return tuple((name, column) for name, column in record_type.column_names() if column in categories)
+
+
+@dataclass(slots=True)
+class GeneRecord(TableRecord):
+    """
+    Row of gene.csv
+    """
+    table: ClassVar[str] = 'gene'
+    gene_id: int
+    taxon_id: Optional[int]
+    assembly: str
+    gene_symbol: Optional[str] = None
+    proteins_for_gene: Optional[int] = 0
+    description: Optional[str] = None
+
+    def verify(self):
+        assert self.gene_id > 0, f"Bad gene id {self.gene_id}"
+        assert self.proteins_for_gene is None or self.proteins_for_gene >= 0
+
+
+@dataclass(slots=True)
+class ProteinRecord(TableRecord):
+    """
+    Row of protein.csv, made once a protein matched a polymerase domain and completed by its summary
+    """
+    table: ClassVar[str] = 'protein'
+    protein_id: int
+    cdd_id: int
+    gene_id: Optional[int] = None
+    taxon_id: Optional[int] = None
+    protein_title: Optional[str] = None
+    poly_type: Optional[str] = None
+
+    def verify(self):
+        assert self.protein_id > 0, f"Bad protein id {self.protein_id}"
+        assert self.poly_type is None or self.poly_type in ['A', 'B', 'C', 'X', 'Y']
+
+
+@dataclass(slots=True)
+class TaxonRecord(TableRecord):
+    """
+    Row of taxon.csv
+    """
+    table: ClassVar[str] = 'taxon'
+    taxon_id: int
+    name: Optional[str] = None
+    species_id: Optional[int] = None
+    species: Optional[str] = None
+    genus_id: Optional[int] = None
+    genus: Optional[str] = None
+    family_id: Optional[int] = None
+    family: Optional[str] = None
+    order_id: Optional[int] = None
+    order: Optional[str] = None
+    class_id: Optional[int] = None
+    class_: Optional[str] = None
+    phylum_id: Optional[int] = None
+    phylum: Optional[str] = None
+
+
+RECORD_TYPES: dict[str, type] = {cls.__name__: cls for cls in (GeneRecord, ProteinRecord, TaxonRecord)}
+
+
+def encode_record(obj):
+    """
+    json.dump default hook writing records as tagged rows, see decode_record
+    """
+    if isinstance(obj, TableRecord):
+        return {'__record__': type(obj).__name__, **obj.to_row()}
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def decode_record(inp: dict):
+    """
+    json.load object_hook rebuilding the records written by encode_record
+    """
+    if '__record__' in inp:
+        return RECORD_TYPES[inp.pop('__record__')].from_row(inp)
+    return inp
 
 
 if __name__ == "__main__":
@@ -31,6 +31,12 @@ class NCBIBaseJobPacket(ABC):
     def is_finished(self) -> bool:
         return self._finished
 
+    def split(self, size: int) -> list["NCBIBaseJobPacket"]:
+        """
+        :return: packets doing the work of this one with at most size ids per request, [] when it cannot be split
+        """
+        return []
+
     def get_last_request_time(self) -> datetime:
         assert self._last_ping_timestamp is not None, "A job must be run to make a request"
         return self._last_ping_timestamp
@@ -52,6 +58,9 @@ class NCBIMonoJobPacket(NCBIBaseJobPacket):
     def progress(self):
         self._finished = True
 
+    def split(self, size: int) -> list["NCBIMonoJobPacket"]:
+        return [NCBIMonoJobPacket(query, extractor=self.__result_extractor) for query in self.__query.split(size)]
+
     def generate_results(self) -> OrderedDict:
         assert self.__result is not None, \
             "Job must finish running before results are available"
@@ -1,16 +1,97 @@
+import copy
 import json
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 from typing import Callable, Optional, Final
+from urllib.parse import parse_qsl, urlsplit
 
 import xmltodict as x2d
-from requests import get, Response
+from requests import get, post, Response, RequestException
+
+from Model import NCBIIdBatch
 
 
 def clean_orderdict_to_json(inp: OrderedDict) -> str:
     return json.dumps(inp, indent=4)
 
 
+def join_ids(ids, sep: str = ',') -> str:
+    """
+    Writes a list of uid strings or an NCBIIdBatch out as placed in a request.
+    """
+    if isinstance(ids, NCBIIdBatch):
+        return ids.join(sep)
+    return sep.join(ids)
+
+
+class ResponseCache:
+    """
+    Shares the responses of identical queries.
+
+    A query whose fingerprint is already being requested waits for that request instead of sending its own,
+    and successful responses are kept for ttl seconds in an LRU of at most size entries.
+    Only failed requests are sent again.
+    """
+
+    def __init__(self, size: int = 256, ttl: float = 600.0):
+        """
+        :param size: responses kept, the least recently used is dropped first
+        :param ttl: seconds a response is reused for
+        """
+        self.size: int = size
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict = OrderedDict()  # fingerprint -> (time stored, status code, result)
+        self._in_flight: dict[str, threading.Event] = dict()
+        self._lock = threading.Lock()
+
+    def claim(self, fingerprint: str) -> Optional[tuple]:
+        """
+        Looks a query up, waiting for an identical query in flight.
+
+        :return: (status code, result) of the stored response, or None when the caller must send the request
+                 and then call release
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                if entry is not None and time.time() - entry[0] <= self.ttl:
+                    self._entries.move_to_end(fingerprint)
+                    self.hits += 1
+                    return entry[1], copy.deepcopy(entry[2])
+                if entry is not None:
+                    del self._entries[fingerprint]
+                event = self._in_flight.get(fingerprint)
+                if event is None:
+                    self._in_flight[fingerprint] = threading.Event()
+                    self.misses += 1
+                    return None
+            # the owner stores a success before waking us, a failure lets one waiter try again
+            event.wait()
+
+    def release(self, fingerprint: str, status_code: Optional[int] = None, result: Optional[OrderedDict] = None):
+        """
+        Ends the request claimed for fingerprint, storing its result when one is given.
+        """
+        with self._lock:
+            if result is not None:
+                self._entries[fingerprint] = (time.time(), status_code, copy.deepcopy(result))
+                self._entries.move_to_end(fingerprint)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            event = self._in_flight.pop(fingerprint, None)
+        if event is not None:
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 class BaseNCBIQuery(ABC):
     """
     Base class for Entries object.
@@ -20,6 +101,18 @@ class BaseNCBIQuery(ABC):
         2) NCBI DataSet REST API search
     """
 
+    # Called before every request, QueryDriver installs its rate limiter here
+    throttle: Optional[Callable[[], None]] = None
+    # NCBI API key sent with every request, raises the rate limit from 3 to 10 requests per second
+    api_key: Optional[str] = os.environ.get('NCBI_API_KEY')
+    # Responses shared between identical queries, None sends every query
+    cache: Optional[ResponseCache] = ResponseCache()
+    # Given (query, seconds taken, bytes received) after every request sent, the query factory sizes its batches with it
+    observe: Optional[Callable[["BaseNCBIQuery", float, int], None]] = None
+    timeout: float = 120.0  # seconds before a request counts as the server being unavailable
+    # attribute holding the ids of queries about a list of ids, lets split copy the query with fewer ids
+    ids_attribute: Optional[str] = None
+
     def __init__(self, *args, **kwargs):
         self.status_code: Optional[int] = 0
         self.cmd: Callable[[], Response] = get
@@ -72,22 +165,127 @@ class BaseNCBIQuery(ABC):
         """
         pass
 
+    def _get_request_kwargs(self) -> dict:
+        """
+        Extra keyword arguments for self.cmd, e.g. the json body of a post.
+        """
+        return dict()
+
+    def endpoint(self) -> str:
+        """
+        Name of the server operation, batches are sized per endpoint.
+        """
+        return self.__class__.__name__
+
+    def id_list(self) -> Optional[list[str]]:
+        """
+        :return: ids the query asks about, None for queries that are not about a list of ids
+        """
+        return None
+
+    def oversized(self) -> bool:
+        """
+        :return: True when the last request failed in a way a request for fewer ids may not:
+                 a timeout or dropped connection, a 414 or a 5xx
+        """
+        return not self.success and (self.status_code is None or self.status_code == 414 or self.status_code >= 500)
+
+    def _resized(self):
+        """
+        Called on the copies made by split once their ids are set, e.g. to choose between get and post again.
+        """
+        pass
+
+    def split(self, size: int) -> list["BaseNCBIQuery"]:
+        """
+        :return: copies of the query asking for at most size of its ids each, [] when there is nothing to split
+        """
+        ids, size = self.id_list(), max(1, size)
+        if self.ids_attribute is None or ids is None or len(ids) <= size:
+            return []
+        outp = []
+        for start in range(0, len(ids), size):
+            query = copy.copy(self)
+            setattr(query, self.ids_attribute, ids[start:start + size])
+            query.status_code, query.success, query.exceed_limit, query.server_unavailable = 0, None, None, None
+            query._resized()
+            outp.append(query)
+        return outp
+
+    def _authenticate(self, query: str, kwargs: dict) -> str:
+        """
+        Adds the api key to a request, the Datasets API takes it as a header.
+
+        :return: the query url to send
+        """
+        if BaseNCBIQuery.api_key:
+            kwargs.setdefault('headers', dict())['api-key'] = BaseNCBIQuery.api_key
+        return query
+
+    def fingerprint(self) -> str:
+        """
+        Identifies what the query asks for: method, endpoint and parameters with the order of
+        parameters and of comma separated ids normalized, plus the request body.
+        """
+        url = urlsplit(self._get_base_api_url() + self._get_cmd_string())
+        params = sorted(
+            (key, ','.join(sorted(value.split(','))) if key == 'id' else value)
+            for key, value in parse_qsl(url.query, keep_blank_values=True)
+        )
+        body = json.dumps(self._get_request_kwargs(), sort_keys=True, default=str)
+        return f"{self.cmd.__name__} {url.netloc}{url.path}?{params} {body}"
+
     def request(self) -> OrderedDict:
         """
         Make request to server.
+        Identical queries share one response through BaseNCBIQuery.cache, which is checked
+        before the rate limit so a shared response costs no request.
         :return: OrderDictionary of the JSON response of search
         """
-        query = self._get_base_api_url() + self._get_cmd_string()  # creates query
-        response = self.cmd(query)  # runs query
-        self.status_code = response.status_code
-        self._determine_success(response)  # checks if query was successful
-        if self.success:  # if successful
-            return self._process_response(response)  # returns json as OrderDict of response
-        return OrderedDict()  # else return empty OrderDict
+        cache = BaseNCBIQuery.cache
+        fingerprint = None
+        if cache is not None:
+            fingerprint = self.fingerprint()
+            cached = cache.claim(fingerprint)
+            if cached is not None:
+                self.status_code = cached[0]
+                self.success, self.exceed_limit, self.server_unavailable = True, False, False
+                return cached[1]
+        result = None
+        try:
+            query = self._get_base_api_url() + self._get_cmd_string()  # creates query
+            kwargs = self._get_request_kwargs()
+            query = self._authenticate(query, kwargs)
+            kwargs.setdefault('timeout', BaseNCBIQuery.timeout)
+            if BaseNCBIQuery.throttle is not None:
+                BaseNCBIQuery.throttle()  # waits for the rate limit
+            start = time.time()
+            try:
+                response = self.cmd(query, **kwargs)  # runs query
+            except RequestException as e:
+                # timeouts and dropped connections are retried like a 503
+                print(f"Request to {self.endpoint()} failed: {e!r}")
+                self.status_code = None
+                self.success, self.exceed_limit, self.server_unavailable = False, False, True
+                if BaseNCBIQuery.observe is not None:
+                    BaseNCBIQuery.observe(self, time.time() - start, 0)
+                return OrderedDict()
+            self.status_code = response.status_code
+            self._determine_success(response)  # checks if query was successful
+            if BaseNCBIQuery.observe is not None:
+                BaseNCBIQuery.observe(self, time.time() - start, len(response.content))
+            if self.success:  # if successful
+                result = self._process_response(response)  # returns json as OrderDict of response
+        finally:
+            if cache is not None:
+                cache.release(fingerprint, self.status_code, result)
+        return result if result is not None else OrderedDict()  # else return empty OrderDict
 
 
 # noinspection SpellCheckingInspection
 class BaseEntrezQuery(BaseNCBIQuery, ABC):
+    url_limit: Final[int] = 2000  # id lists longer than this are posted instead of placed in the url
+
     def __init__(self, *args, **kwargs):
         super(BaseEntrezQuery, self).__init__(*args, **kwargs)
         self.cmd = get
@@ -96,6 +294,32 @@ class BaseEntrezQuery(BaseNCBIQuery, ABC):
     def _get_base_api_url(self) -> str:
         return "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 
+    def endpoint(self) -> str:
+        return getattr(self, 'entrez_cmd', self.__class__.__name__)
+
+    def _resized(self):
+        if getattr(self, 'ids', None) is not None:
+            self.cmd = get
+            self._post_long_ids()
+
+    def _post_long_ids(self):
+        # E-utilities take the ids of a post in the form body, the other parameters stay in the url
+        if self.ids is not None and len(self.ids) and len(join_ids(self.ids)) > self.__class__.url_limit:
+            self.cmd = post
+
+    def _ids_param(self) -> str:
+        return '' if self.cmd is post else f"&id={join_ids(self.ids)}"
+
+    def _get_request_kwargs(self) -> dict:
+        if self.cmd is post and getattr(self, 'ids', None) is not None:
+            return {'data': {'id': join_ids(self.ids)}}
+        return dict()
+
+    def _authenticate(self, query: str, kwargs: dict) -> str:
+        if BaseNCBIQuery.api_key:
+            query += f"{'&' if '?' in query else '?'}api_key={BaseNCBIQuery.api_key}"
+        return query
+
     def _determine_success(self, response: Response):
         if response.status_code != 200:  # check if OKAY
             self.success = False
@@ -126,6 +350,8 @@ class EntrezInfo(BaseEntrezQuery):
 
 class EntrezFetch(BaseEntrezQuery):
     entrez_cmd: Final[str] = 'efetch'
+    ids_attribute: Final[str] = 'ids'
+    max_ids: Final[int] = 500  # ids accepted by one request, long lists are posted
 
     def __init__(self, *args, **kwargs):
         super(EntrezFetch, self).__init__(*args, **kwargs)
@@ -133,11 +359,14 @@ class EntrezFetch(BaseEntrezQuery):
         self.ids = kwargs.get('id')  # TODO can be None!
         if not self._valid_input():
             raise ValueError
+        self._post_long_ids()
 
     def _get_cmd_string(self) -> str:
         db_param = f"?db={self.db}"
-        ids_param = f"&id={','.join(self.ids)}"
-        return f"{self.__class__.entrez_cmd}.fcgi{db_param}{ids_param}{self.html_tags}"
+        return f"{self.__class__.entrez_cmd}.fcgi{db_param}{self._ids_param()}{self.html_tags}"
+
+    def id_list(self) -> Optional[list[str]]:
+        return self.ids
 
     def _process_response(self, response: Response) -> OrderedDict:
         return x2d.parse(response.content.decode(response.apparent_encoding))
@@ -150,10 +379,10 @@ class EntrezFetch(BaseEntrezQuery):
         if self.db is None:  # Check we have a db
             print("EtrezFetch does not have required db parameter")
             flag = False
-        if len(self.ids) >= 200:  # Check we don't ask for too much
+        if self.ids is not None and len(self.ids) > self.__class__.max_ids:  # Check we don't ask for too much
             print("EtrezFetch is too long")
             flag = False
-        if type(self.ids) != list or len(self.ids) < 1:  # Check we have a list of ids
+        if not isinstance(self.ids, (list, NCBIIdBatch)) or len(self.ids) < 1:  # Check we have a list of ids
             print("EtrezFetch was not given the required list of IDs")
             flag = False
         return flag
@@ -162,6 +391,8 @@ class EntrezFetch(BaseEntrezQuery):
 
 class EntrezSummary(BaseEntrezQuery):  # Jordan working here!!
     entrez_cmd: Final[str] = 'esummary'
+    ids_attribute: Final[str] = 'ids'
+    max_ids: Final[int] = 500  # ids accepted by one request, long lists are posted
 
     def __init__(self, *args, **kwargs):
         super(EntrezSummary, self).__init__(*args, **kwargs)
@@ -169,11 +400,14 @@ class EntrezSummary(BaseEntrezQuery):  # Jordan working here!!
         self.ids = kwargs.get('id')  # TODO check this is the input name, is it ever none?
         if not self._valid_input():
             raise ValueError
+        self._post_long_ids()
 
     def _get_cmd_string(self) -> str:
         db_param = f"?db={self.db}"
-        ids_param = f"&id={','.join(self.ids)}"
-        return f"{self.__class__.entrez_cmd}.fcgi{db_param}{ids_param}&retmode=json{self.html_tags}"
+        return f"{self.__class__.entrez_cmd}.fcgi{db_param}{self._ids_param()}&retmode=json{self.html_tags}"
+
+    def id_list(self) -> Optional[list[str]]:
+        return self.ids
 
     def _process_response(self, response: Response) -> OrderedDict:
         return response.json(object_pairs_hook=OrderedDict)
@@ -185,10 +419,10 @@ class EntrezSummary(BaseEntrezQuery):  # Jordan working here!!
         if self.db is None:  # Check we have a db
             print("EtrezSummary does not have required db parameter")
             flag = False
-        if len(self.ids) >= 200:  # Check we don't ask for too much
+        if self.ids is not None and len(self.ids) > self.__class__.max_ids:  # Check we don't ask for too much
             print("EtrezSummary is too long")
             flag = False
-        if not isinstance(self.ids, list) or len(self.ids) < 1:  # Check we have a list of ids
+        if not isinstance(self.ids, (list, NCBIIdBatch)) or len(self.ids) < 1:  # Check we have a list of ids
             print("EtrezSummary was not given the required list of IDs")
             flag = False
         return flag
@@ -197,19 +431,25 @@ class EntrezSummary(BaseEntrezQuery):  # Jordan working here!!
 
 class EntrezLink(BaseEntrezQuery):
     entrez_cmd: Final[str] = 'elink'
+    ids_attribute: Final[str] = 'id'
 
     def __init__(self, *args, **kwargs):
         self.source_db: str = args[0]
         self.foreign_db: str = args[1]
         self.id: list[str] = args[2]
         self.linkname: str = kwargs.get("linkname")
+        # one linkset per id instead of the links of every id merged together
+        self.by_id: bool = kwargs.get("by_id", False)
         super(EntrezLink, self).__init__(args[3:])
 
     def _get_cmd_string(self) -> str:
-        id_arg = ','.join(self.id)
+        id_arg = join_ids(self.id, '&id=' if self.by_id else ',')
         link_param = '' if self.linkname is None else f"&linkname={self.linkname}"
         return f"{self.__class__.entrez_cmd}.fcgi?dbfrom={self.source_db}&db={self.foreign_db}&id={id_arg}{link_param}&retmode=json"
 
+    def id_list(self) -> Optional[list[str]]:
+        return self.id
+
     def _process_response(self, response: Response) -> OrderedDict:
         #return x2d.parse(response.content.decode(response.apparent_encoding))
         return response.json(object_pairs_hook=OrderedDict)
@@ -224,9 +464,13 @@ class EntrezPost(BaseEntrezQuery):
         self.db: str = args[1]
         self.ids: list[str] = args[2]
         self.kwargs = kwargs
+        self._post_long_ids()
 
     def _get_cmd_string(self) -> str:
-        return f"{self.__class__.entrez_cmd}.fcgi?db={self.db}&id={','.join(self.ids)}"
+        return f"{self.__class__.entrez_cmd}.fcgi?db={self.db}{self._ids_param()}"
+
+    def endpoint(self) -> str:
+        return self.__class__.entrez_cmd
 
     def _process_response(self, response: Response) -> OrderedDict:
         results = x2d.parse(response.content.decode(response.apparent_encoding))
@@ -240,13 +484,14 @@ class EntrezReceivePost(BaseEntrezQuery):
         self.query_id: str = args[2]['QueryKey']
         self.web_env: str = args[2]['WebEnv']
         self.kwargs = self.kwargs_to_html(kwargs, start=False)
-        # WARNING jank stuff ahead. Determining how to process the response at runtime
+        # WARNING jank stuff ahead. Determining how to process the response at runtime,
+        # bound to this instance so it is called like a method
         if self.entrez_cmd == EntrezLink.entrez_cmd:
-            setattr(self, "_process_response", getattr(EntrezLink, "_process_response"))
+            setattr(self, "_process_response", EntrezLink._process_response.__get__(self))
         elif self.entrez_cmd == EntrezSummary.entrez_cmd:
-            setattr(self, "_process_response", getattr(EntrezSummary, "_process_response"))
+            setattr(self, "_process_response", EntrezSummary._process_response.__get__(self))
         elif self.entrez_cmd == EntrezFetch.entrez_cmd:
-            setattr(self, "_process_response", getattr(EntrezFetch, "_process_response"))
+            setattr(self, "_process_response", EntrezFetch._process_response.__get__(self))
         else:
             raise ValueError(f"{self.entrez_cmd} is not a valid Entrez Command for a post operation")
         super(EntrezReceivePost, self).__init__(args[3:], **dict())
@@ -292,14 +537,69 @@ class GeneDatasetQuery(BaseNCBIQuery):
 # https://api.ncbi.nlm.nih.gov/datasets/v2alpha/taxonomy/taxon/208964"
 
 class TaxonSummary(BaseNCBIQuery):
-    # TODO
+    max_ids: Final[int] = 1000  # taxa accepted by one taxonomy request
+    url_limit: Final[int] = 2000  # longer id lists are posted instead of placed in the url
+    ids_attribute: Final[str] = 'taxon_id'
+    levels: Final[tuple] = ('phylum', 'class', 'order', 'family', 'genus', 'species')
+
     def __init__(self, *args, **kwargs):
         super(TaxonSummary, self).__init__(*args, **kwargs)
-        self.taxon_id = args[0]
+        taxa = args[0]
+        self.taxon_id: list[str] = taxa.tolist() if isinstance(taxa, NCBIIdBatch) else [str(taxon_id) for taxon_id in taxa]
+        if len(self.taxon_id) > self.__class__.max_ids:
+            raise ValueError(f"TaxonSummary takes at most {self.__class__.max_ids} taxa")
+        self._resized()
+
+    def _resized(self):
+        self.cmd = post if len(','.join(self.taxon_id)) > self.__class__.url_limit else get
 
     def _get_cmd_string(self) -> str:
+        if self.cmd is post:
+            return "/taxonomy"
         return f"/taxonomy/taxon/{','.join(self.taxon_id)}"
 
+    def _get_request_kwargs(self) -> dict:
+        if self.cmd is post:
+            return {'json': {'taxons': self.taxon_id}}
+        return dict()
+
+    def endpoint(self) -> str:
+        return 'taxonomy'
+
+    def id_list(self) -> Optional[list[str]]:
+        return self.taxon_id
+
+    @classmethod
+    def rank_tables(cls, inp: OrderedDict) -> OrderedDict:
+        """
+        Extractor turning a taxonomy response into taxon.csv rows using the classification block of each node,
+        so the ranks need no further requests.
+
+        :return: OrderedDict with
+            'rank_tables': {tax_id: row with name, taxon_id and the <level>/<level>_id columns} \n
+            'lineages': {tax_id: {name, lineage}} for nodes the server returned without a classification
+        """
+        outp = OrderedDict(rank_tables=OrderedDict(), lineages=OrderedDict())
+        for node in inp.get('taxonomy_nodes', []):
+            taxonomy = node.get('taxonomy')
+            if not taxonomy:
+                continue
+            tax_id = str(taxonomy['tax_id'])
+            classification = taxonomy.get('classification')
+            if classification is None:
+                outp['lineages'][tax_id] = OrderedDict(
+                    name=taxonomy.get('organism_name'),
+                    lineage=[str(taxon_id) for taxon_id in taxonomy.get('lineage', [])]
+                )
+                continue
+            row = OrderedDict(name=taxonomy.get('organism_name'), taxon_id=tax_id)
+            for level in cls.levels:
+                rank = classification.get(level, dict())
+                row[level] = rank.get('name')
+                row[level + '_id'] = str(rank['id']) if rank.get('id') is not None else None
+            outp['rank_tables'][tax_id] = row
+        return outp
+
     def _process_response(self, response: Response) -> OrderedDict:
         return response.json(object_pairs_hook=OrderedDict)
 
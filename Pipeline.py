@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+_DONE = object()  # marks the end of the stream between stages
+_POLL = 0.1  # seconds between checks for a failed pipeline while blocked on a queue
+
+
+class StageStats:
+    """
+    Throughput counters of one stage.
+
+    :ivar received: items taken from the input queue
+    :ivar emitted: items put on the output queue
+    :ivar busy: seconds spent inside the stage function summed over workers, waiting on full queues excluded
+    """
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.received: int = 0
+        self.emitted: int = 0
+        self.busy: float = 0.0
+        self.started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record(self, emitted: int, busy: float):
+        with self._lock:
+            self.received += 1
+            self.emitted += emitted
+            self.busy += busy
+
+    def as_dict(self) -> dict:
+        elapsed = time.time() - self.started if self.started else 0.0
+        return {
+            'received': self.received,
+            'emitted': self.emitted,
+            'busy_seconds': round(self.busy, 3),
+            'items_per_second': round(self.received / elapsed, 3) if elapsed else 0.0,
+        }
+
+
+class Stage:
+    """
+    Step of a Pipeline run by its own worker threads.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1, queue_size: int = 2,
+                 fan_out: bool = False):
+        """
+        :param name: name used in the stats
+        :param fn: called on every item. Returns the item passed on, or None to drop it.
+        :param workers: threads running fn. Only a single worker keeps the order of the items.
+        :param queue_size: items that may wait in front of the stage before upstream stages block
+        :param fan_out: fn returns an iterable of items that are passed on one by one
+        """
+        assert workers >= 1, "A stage needs at least one worker"
+        self.name: str = name
+        self.fn: Callable[[Any], Any] = fn
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        self.fan_out: bool = fan_out
+
+
+class Pipeline:
+    """
+    Runs a chain of stages concurrently over a stream of items.
+    Stages are connected by bounded queues so a slow stage holds the ones before it back
+    and at most queue_size items wait between two stages.
+    """
+
+    def __init__(self, stages: list[Stage]):
+        assert stages, "A pipeline needs at least one stage"
+        self.stages: list[Stage] = list(stages)
+        self._stats: dict[str, StageStats] = {stage.name: StageStats(stage.name) for stage in self.stages}
+        self._queues: list[queue.Queue] = []
+        self._failed: Optional[BaseException] = None
+        self._stop = threading.Event()
+
+    def stats(self) -> dict[str, dict]:
+        """
+        :return: counters of every stage along with the current depth of its input queue
+        """
+        outp = dict()
+        for index, stage in enumerate(self.stages):
+            outp[stage.name] = self._stats[stage.name].as_dict()
+            outp[stage.name]['queued'] = self._queues[index].qsize() if self._queues else 0
+        return outp
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=_POLL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        if self._failed is None:
+            self._failed = error
+        self._stop.set()
+
+    def _feed(self, source: Iterable, target: queue.Queue):
+        try:
+            for item in source:
+                if not self._put(target, item):
+                    return
+        except BaseException as e:
+            self._fail(e)
+            return
+        self._put(target, _DONE)
+
+    def _work(self, stage: Stage, source: queue.Queue, target: queue.Queue, remaining: list, lock: threading.Lock):
+        stats = self._stats[stage.name]
+        while True:
+            item = self._get(source)
+            if item is _DONE:
+                # lets the sibling workers see the end too, the last one passes it downstream
+                self._put(source, _DONE)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._put(target, _DONE)
+                return
+            start = time.time()
+            try:
+                result = stage.fn(item)
+                busy = time.time() - start
+                outputs = (result if stage.fan_out else [result]) if result is not None else []
+                emitted = 0
+                for output in outputs:
+                    if output is not None:
+                        if not self._put(target, output):
+                            return
+                        emitted += 1
+            except BaseException as e:
+                self._fail(e)
+                return
+            stats.record(emitted, busy)
+
+    def run(self, source: Iterable) -> Iterator:
+        """
+        Starts every stage and yields the items leaving the last stage.
+
+        :param source: items fed to the first stage, consumed lazily
+        :raises: the first exception raised by a stage, after the other stages were stopped
+        """
+        self._stop.clear()
+        self._failed = None
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        self._queues.append(queue.Queue(maxsize=self.stages[-1].queue_size))
+        threads = [threading.Thread(target=self._feed, args=(source, self._queues[0]), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            self._stats[stage.name].started = time.time()
+            remaining, lock = [stage.workers], threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, self._queues[index], self._queues[index + 1], remaining, lock),
+                    name=f"{stage.name}-worker",
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._failed is not None:
+            raise self._failed
+
+    def __call__(self, source: Iterable) -> int:
+        """
+        Runs the pipeline to completion, discarding the output.
+
+        :return: number of items that left the last stage
+        """
+        return sum(1 for _ in self.run(source))
@@ -3,12 +3,43 @@
 # This code is to create and run a QueryDriver, a singleton that runs all queries to the DB
 
 # Imports
+import threading
 import time
+from concurrent.futures import Future
+from typing import Final, Iterable
 from SearchFactory import NCBIQueryFactory, NCBICompositeJob
-from NCBIQueries import clean_orderdict_to_json
+from NCBIQueries import BaseNCBIQuery, clean_orderdict_to_json
 from collections import *
 
 
+def _summary_of(results, uid):
+    return results.get('result', dict()).get(uid)
+
+
+def _lineage_of(results, uid):
+    return results.get('rank_tables', dict()).get(uid) or results.get('lineages', dict()).get(uid)
+
+
+# Operations that load() batches: the endpoint sizing their batches and how to find the result of one id in a response
+BATCH_OPERATIONS: Final[dict] = {
+    'taxonomy_summary': {
+        'endpoint': 'esummary',
+        'job': lambda uids: (('taxonomy', uids), {'summary': True}),
+        'result': _summary_of,
+    },
+    'protein_summary': {
+        'endpoint': 'esummary',
+        'job': lambda uids: (('protein', uids), {'summary': True}),
+        'result': _summary_of,
+    },
+    'lineage': {
+        'endpoint': 'taxonomy',
+        'job': lambda uids: ((), {'lineage': uids}),
+        'result': _lineage_of,
+    },
+}
+
+
 # Static function to check if our result is valid
 def validate_result(result):
     """
@@ -30,11 +61,20 @@ class QueryDriver:
 
 # Fields
     _instance = None    # Our one instance of the class
-    _job_que = deque()  # Que for storing CompositeJobs
+    _local = threading.local()  # Holds a job que per thread so concurrent callers never run each other's jobs
     _job_times = deque()    # A place to store the jobs
+    _rate_lock = threading.Lock()  # Guards _job_times, shared by every thread
+    _batches = dict()   # operation -> OrderedDict of uid -> futures waiting for the next request
+    _batch_timers = dict()  # operation -> timer sending the pending batch once the window closes
+    _batch_lock = threading.Lock()  # Guards _batches, _batch_timers and _loaded
+    _loaded = OrderedDict()  # (operation, uid) -> recent result of load(), least recently used first
 
 # Constants
     WAIT_TIME = 1.1  # Never send more than 3 jobs in 1.1 sec
+    MAX_REQUESTS = 3
+    KEYED_MAX_REQUESTS = 10  # Limit when an NCBI API key is used
+    BATCH_WINDOW = 0.05  # Seconds load() waits for more ids before sending a batch that is not full
+    LOADED_SIZE = 50000  # Results of load() remembered, so ids asked for again cost no request
 
 # Private Methods
     # Overrode __new__() to support singleton pattern
@@ -53,11 +93,41 @@ class QueryDriver:
             self.factory = NCBIQueryFactory()
         except FileNotFoundError:
             self.factory = NCBIQueryFactory('utils/search_config.json')
+        # every request made from any thread books a slot with the limiter first
+        BaseNCBIQuery.throttle = self._proceed
+        if BaseNCBIQuery.api_key:
+            QueryDriver.MAX_REQUESTS = self.KEYED_MAX_REQUESTS
+
+    def set_budget(self, api_key=None, share=1):
+        """
+        Sets the request budget of this process.
+
+        :param api_key: NCBI API key to send, None keeps the one from the NCBI_API_KEY environment variable
+        :param share: number of processes using the same key (or the same IP without a key).
+                      Each gets 1/share of the rate limit by stretching the window.
+        """
+        assert share >= 1, "The budget must be shared by at least one process"
+        if api_key is not None:
+            BaseNCBIQuery.api_key = api_key
+        with self._rate_lock:
+            QueryDriver.MAX_REQUESTS = self.KEYED_MAX_REQUESTS if BaseNCBIQuery.api_key else 3
+            QueryDriver.WAIT_TIME = 1.1 * share
+
+    # Que for storing CompositeJobs of the calling thread
+    @property
+    def _job_que(self):
+        if not hasattr(self._local, 'job_que'):
+            self._local.job_que = deque()
+        return self._local.job_que
 
     # This is so we can feed jobs into the instance
     def __call__(self, *args, **kwargs):
         self._job_que.append(self.factory(*args, **kwargs))  # TODO Check this call is correct
 
+    # This is so CompositeJobs built elsewhere, e.g. by a QueryPlan, can be fed in
+    def submit(self, job: NCBICompositeJob):
+        self._job_que.append(job)
+
     # Private method to handle the logic of response to returned codes from a job
     def _return_code_logic(self, code):
         """
@@ -104,16 +174,103 @@ class QueryDriver:
 
    # Private Method to keep us from over pinging the server
     def _proceed(self):
-        if len(self._job_times) < 3:
-            return
-        while time.time() - min(self._job_times) < self.WAIT_TIME:
-            pass
-        self._job_times.remove(min(self._job_times))
-        return
+        """
+        Blocks until a request can be sent without exceeding MAX_REQUESTS in WAIT_TIME seconds
+        and books that request. Threads wait in turn.
+        """
+        with self._rate_lock:
+            while len(self._job_times) >= self.MAX_REQUESTS:
+                wait = self.WAIT_TIME - (time.time() - self._job_times[0])
+                if wait <= 0:
+                    self._job_times.popleft()
+                else:
+                    time.sleep(wait)
+            self._job_times.append(time.time())
+
 
 
+    # Private method that sends a batch of load() ids and hands every future its result
+    def _send_batch(self, operation, batch):
+        spec = BATCH_OPERATIONS[operation]
+        uids = list(batch)
+        args, kwargs = spec['job'](uids)
+        found = dict()
+        try:
+            self(*args, **kwargs)
+            for results in self.run_query():
+                for uid in uids:
+                    result = spec['result'](results, uid)
+                    if result is not None:
+                        found[uid] = result
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        with self._batch_lock:
+            for uid, result in found.items():
+                self._loaded[(operation, uid)] = result
+            while len(self._loaded) > self.LOADED_SIZE:
+                self._loaded.popitem(last=False)
+        for uid, futures in batch.items():
+            for future in futures:
+                future.set_result(found.get(uid))
+
+    # Private method to take the pending batch of an operation, called with _batch_lock held
+    def _take_batch(self, operation):
+        timer = self._batch_timers.pop(operation, None)
+        if timer is not None:
+            timer.cancel()
+        return self._batches.pop(operation, None)
+
+    def _flush(self, operation):
+        with self._batch_lock:
+            batch = self._take_batch(operation)
+        if batch:
+            self._send_batch(operation, batch)
 
 # Public Methods
+    def load(self, operation, uid) -> Future:
+        """
+        Queues one id for an operation of BATCH_OPERATIONS. Ids queued by any thread are sent together
+        once they fill the batch size the factory's adaptive batcher gives the endpoint
+        or BATCH_WINDOW passed, whichever comes first.
+        The same id queued twice before its batch is sent is only requested once,
+        and ids answered recently are resolved right away from the last LOADED_SIZE results.
+
+        :param operation: key of BATCH_OPERATIONS
+        :param uid: id to look up
+        :return: Future of the part of the response about uid, None if the response has nothing on it
+        """
+        spec = BATCH_OPERATIONS[operation]
+        uid = str(getattr(uid, 'uid', uid))
+        future = Future()
+        full = None
+        with self._batch_lock:
+            if (operation, uid) in self._loaded:
+                self._loaded.move_to_end((operation, uid))
+                future.set_result(self._loaded[(operation, uid)])
+                return future
+            batch = self._batches.setdefault(operation, OrderedDict())
+            batch.setdefault(uid, []).append(future)
+            if len(batch) >= self.factory.batcher.size(spec['endpoint'], len(uid)):
+                full = self._take_batch(operation)
+            elif operation not in self._batch_timers:
+                timer = threading.Timer(self.BATCH_WINDOW, self._flush, args=(operation,))
+                timer.daemon = True
+                self._batch_timers[operation] = timer
+                timer.start()
+        if full:
+            # the caller that fills a batch sends it
+            self._send_batch(operation, full)
+        return future
+
+    def load_many(self, operation, uids: Iterable) -> list[Future]:
+        """
+        load() for every id, the futures are in the order of uids.
+        """
+        return [self.load(operation, uid) for uid in uids]
+
     # Public Method that yields results to caller as it runs a job and gets them
     def run_query(self):
         """
@@ -129,26 +286,21 @@ class QueryDriver:
         else:
             raise GeneratorExit
 
-        # Make sure we start with ok waiting, aka a do for loop thing
-        if len(self._job_times) >= 3:
-            self._proceed()
-
-        # Run the CompositeJob until done or error
-        results_iter = current_job.get_results()
+        # Run the CompositeJob until done or error, each request waits on _proceed.
+        # Results are streamed so each one is released once the caller got it.
+        current_job.set_streaming()
         for return_code in current_job.run_jobs():
-            self._job_times.append(time.time())
-            self._proceed()
             try:
                 if self._return_code_logic(return_code):
-                    result = next(results_iter)
-                    print(current_job.title)
-                    try:
-                        returnable = self._parse_results(result)
-                        yield returnable
-                    except ValueError:
-                        # We log this error and do nothing right now
-                        print("ERROR: A result value in QueryDriver is corrupt!")
-                        pass
+                    for result in current_job.drain():
+                        print(current_job.title)
+                        try:
+                            returnable = self._parse_results(result)
+                            yield returnable
+                        except ValueError:
+                            # We log this error and do nothing right now
+                            print("ERROR: A result value in QueryDriver is corrupt!")
+                            pass
             except ValueError:
                 # We log this error when it is raised, nothing more
                 pass
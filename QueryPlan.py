@@ -0,0 +1,250 @@
+import math
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Final, Iterable, Optional
+
+import NCBIJobPacket
+import NCBIQueries
+from Model import NCBIIdBatch
+from QueryDriver import QueryDriver
+from SearchFactory import NCBICompositeJob
+
+HISTORY_CHUNK: Final[int] = 500  # ids posted to the history server per epost
+TYPICAL_ID_BYTES: Final[int] = 10  # used to estimate how many ids fit in a url
+
+
+class Hop:
+    """
+    Node of a QueryPlan.
+
+    :ivar kind: 'ids' for given ids, 'link' for elink, 'summary' for esummary, 'filter' for a local predicate
+    :ivar inputs: names of the hops this one reads its ids from
+    :ivar fanout: expected output ids per input id, only used by explain
+    """
+
+    def __init__(self, name: str, kind: str, db: str, inputs: list[str], fanout: float = 1.0, **params):
+        self.name: str = name
+        self.kind: str = kind
+        self.db: str = db
+        self.inputs: list[str] = inputs
+        self.fanout: float = fanout
+        self.params: dict = params
+
+    @property
+    def remote(self) -> bool:
+        return self.kind in ('link', 'summary')
+
+    @property
+    def history(self) -> bool:
+        # by id links need one linkset per id, which the history server does not give
+        return self.remote and not self.params.get('by_id')
+
+
+class HopResult:
+    """
+    Output of a hop.
+
+    :ivar ids: ids the hop produced, in first seen order without repeats
+    :ivar links: input id -> linked ids, only for links run by id
+    :ivar summaries: id -> esummary document, only for summary hops
+    """
+
+    def __init__(self, ids: Iterable[str], links: Optional[dict] = None, summaries: Optional[dict] = None):
+        self.ids: list[str] = list(OrderedDict.fromkeys(str(_id) for _id in ids))
+        self.links: Optional[dict[str, list[str]]] = links
+        self.summaries: Optional[dict[str, OrderedDict]] = summaries
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class QueryPlan:
+    """
+    Declarative multi hop NCBI lookup, e.g. genes -> proteins -> CDD -> summaries.
+
+    Hops are added by name and read the ids of earlier hops, forming a DAG. Running the plan compiles every
+    remote hop into batched job packets: hops that only need the linked ids post them to the Entrez history
+    server and fetch the result by query key, links by id use one elink per batch with a linkset per id.
+    Hops whose inputs are done run concurrently, each batch still waits on the QueryDriver rate limit.
+
+    >>> plan = QueryPlan()
+    >>> plan.ids('genes', 'gene', ['948180'])
+    >>> plan.link('proteins', 'genes', 'protein', linkname='gene_protein_refseq', by_id=True)
+    >>> plan.summary('protein_docs', 'proteins')
+    >>> print(plan.explain())
+    >>> results = plan.run()
+    """
+
+    def __init__(self, driver: Optional[QueryDriver] = None):
+        """
+        :param driver: driver running the jobs, the QueryDriver singleton by default
+        """
+        self.driver: QueryDriver = QueryDriver() if driver is None else driver
+        self.hops: OrderedDict[str, Hop] = OrderedDict()
+        self._given: dict[str, list[str]] = dict()
+
+    def _add(self, hop: Hop):
+        if hop.name in self.hops:
+            raise ValueError(f"The plan already has a hop named {hop.name}")
+        for name in hop.inputs:
+            if name not in self.hops:
+                raise ValueError(f"{hop.name} reads from {name}, which is not a hop of the plan yet")
+        self.hops[hop.name] = hop
+
+    def ids(self, name: str, db: str, ids: Iterable):
+        """
+        Starts the plan from known ids of db.
+        """
+        self._add(Hop(name, 'ids', db, []))
+        self._given[name] = [str(getattr(_id, 'uid', _id)) for _id in ids]
+
+    def link(self, name: str, source: str, db: str, linkname: Optional[str] = None, by_id: bool = False,
+             fanout: float = 1.0):
+        """
+        Links the ids of source to db.
+
+        :param by_id: keep which input id every linked id came from in HopResult.links
+        :param fanout: expected linked ids per input id, for explain
+        """
+        self._add(Hop(name, 'link', db, [source], fanout, linkname=linkname, by_id=by_id))
+
+    def summary(self, name: str, source: str):
+        """
+        Gets the esummary document of every id of source.
+        """
+        self._add(Hop(name, 'summary', self.hops[source].db if source in self.hops else None, [source]))
+
+    def filter(self, name: str, source: str, keep: Callable[[str], bool], fanout: float = 1.0):
+        """
+        Keeps the ids of source for which keep is true, no request is made.
+
+        :param fanout: expected share of the ids kept, for explain
+        """
+        self._add(Hop(name, 'filter', self.hops[source].db if source in self.hops else None, [source], fanout,
+                      keep=keep))
+
+    def _order(self) -> list[Hop]:
+        # hops can only read from hops added before them, so insertion order is topological
+        return list(self.hops.values())
+
+    def _requests(self, hop: Hop, ids: int) -> int:
+        if not hop.remote or not ids:
+            return 0
+        if hop.history:
+            return math.ceil(ids / HISTORY_CHUNK) * 2
+        return math.ceil(ids / self.driver.factory.batcher.size('elink', TYPICAL_ID_BYTES))
+
+    def explain(self) -> str:
+        """
+        :return: table of the hops in run order with the estimated ids and requests of each, before anything is sent
+        """
+        estimates: dict[str, float] = dict()
+        lines = [f"{'hop':<16}{'kind':<9}{'db':<10}{'from':<16}{'est. ids':>10}{'requests':>10}  strategy"]
+        total = 0
+        for hop in self._order():
+            if hop.kind == 'ids':
+                estimates[hop.name] = len(self._given[hop.name])
+                requests = 0
+            else:
+                ids_in = sum(estimates[name] for name in hop.inputs)
+                requests = self._requests(hop, math.ceil(ids_in))
+                estimates[hop.name] = ids_in * hop.fanout
+            total += requests
+            strategy = {'ids': 'given', 'filter': 'local'}.get(
+                hop.kind, f"epost+{hop.kind} by query key" if hop.history else "elink by id, batched")
+            lines.append(f"{hop.name:<16}{hop.kind:<9}{str(hop.db):<10}{','.join(hop.inputs) or '-':<16}"
+                         f"{math.ceil(estimates[hop.name]):>10,}{requests:>10,}  {strategy}")
+        lines.append(f"estimated requests: {total:,}")
+        return '\n'.join(lines)
+
+    def _compile(self, hop: Hop, ids: list[str]) -> Optional[NCBICompositeJob]:
+        """
+        Turns a remote hop over ids into a composite job of one packet per batch.
+        """
+        if not ids:
+            return None
+        source_db = self.hops[hop.inputs[0]].db
+        try:
+            ids = NCBIIdBatch(source_db, ids)
+        except ValueError:
+            pass  # accessions stay strings
+        packets = []
+        if hop.history:
+            for start in range(0, len(ids), HISTORY_CHUNK):
+                chunk = ids[start:start + HISTORY_CHUNK]
+                if hop.kind == 'summary':
+                    def follow_up(query, result, chunk_size=len(chunk), db=source_db):
+                        return NCBIQueries.EntrezReceivePost('esummary', db, result, retmax=chunk_size, retmode='json')
+                else:
+                    def follow_up(query, result, db=hop.db, source=source_db, linkname=hop.params['linkname']):
+                        params = {'dbfrom': source, 'retmode': 'json'}
+                        if linkname is not None:
+                            params['linkname'] = linkname
+                        return NCBIQueries.EntrezReceivePost('elink', db, result, **params)
+                packets.append(NCBIJobPacket.NCBIFollowUpJobPacket(
+                    NCBIQueries.EntrezPost('epost', source_db, chunk), follow_up
+                ))
+        else:
+            for chunk in self.driver.factory.list_chunker(ids, endpoint='elink'):
+                packets.append(NCBIJobPacket.NCBIMonoJobPacket(
+                    NCBIQueries.EntrezLink(source_db, hop.db, chunk, linkname=hop.params['linkname'], by_id=True)
+                ))
+        return NCBICompositeJob(f"plan {hop.name}", packets, streaming=True)
+
+    def _run_hop(self, hop: Hop, done: dict[str, HopResult]) -> HopResult:
+        ids = [_id for name in hop.inputs for _id in done[name].ids] if hop.inputs else self._given[hop.name]
+        ids = list(OrderedDict.fromkeys(ids))
+        if hop.kind == 'ids':
+            return HopResult(ids)
+        if hop.kind == 'filter':
+            return HopResult(_id for _id in ids if hop.params['keep'](_id))
+        job = self._compile(hop, ids)
+        linked, links, summaries = [], (dict() if not hop.history else None), dict()
+        if job is not None:
+            self.driver.submit(job)
+            for results in self.driver.run_query():
+                if hop.kind == 'summary':
+                    for uid, document in results.get('result', dict()).items():
+                        if uid != 'uids':
+                            summaries[uid] = document
+                            linked.append(uid)
+                    continue
+                for linkset in results.get('linksets', []):
+                    found = [str(link) for linksetdb in linkset.get('linksetdbs', [])
+                             for link in linksetdb.get('links', [])]
+                    linked += found
+                    if links is not None:
+                        for _id in linkset.get('ids', []):
+                            links.setdefault(str(_id), []).extend(found)
+        return HopResult(linked, links=links, summaries=summaries if hop.kind == 'summary' else None)
+
+    def run(self, workers: int = 4) -> dict[str, HopResult]:
+        """
+        Runs every hop once all its inputs are done, independent hops at the same time.
+
+        :param workers: hops run at once
+        :return: result of every hop by name
+        """
+        done: dict[str, HopResult] = dict()
+        pending = self._order()
+        running = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for hop in [hop for hop in pending if all(name in done for name in hop.inputs)]:
+                    pending.remove(hop)
+                    running[executor.submit(self._run_hop, hop, dict(done))] = hop
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[running.pop(future).name] = future.result()
+        return done
+
+
+if __name__ == "__main__":
+    plan = QueryPlan()
+    plan.ids('genes', 'gene', ['948180', '944778'])
+    plan.link('proteins', 'genes', 'protein', linkname='gene_protein_refseq', by_id=True)
+    plan.link('cdds', 'proteins', 'cdd', linkname='protein_cdd', fanout=5)
+    plan.summary('protein_docs', 'proteins')
+    print(plan.explain())
+    for name, result in plan.run().items():
+        print(name, result.ids[:10])
@@ -0,0 +1,188 @@
+import glob
+import hashlib
+import os
+from typing import Final, Optional
+
+import numpy
+import pandas
+import scipy.sparse
+
+import handled
+
+CACHE_DIR: Final[str] = "repertoire_cache"
+PSSM_FILE: Final[str] = "pssmids_csv.csv"
+POLY_TYPES: Final[tuple] = ('A', 'B', 'C', 'X', 'Y')
+LEVELS: Final[tuple] = ('phylum', 'class', 'order', 'family', 'genus', 'species')
+KINDS: Final[tuple] = ('poly_type', 'cdd')
+_FORMAT: Final[str] = "1"  # part of the cache key, bumped when the layout of the matrices changes
+
+
+def load_pssm(path: str = PSSM_FILE) -> pandas.DataFrame:
+    """
+    Reads the polymerase domains file, which has no header: poly type, CDD uid, short name.
+    """
+    return pandas.read_csv(path, header=None, names=['Type', 'cdd_uid', 'name'],
+                           dtype={'Type': 'category', 'cdd_uid': 'int64', 'name': 'string'})
+
+
+class Repertoire:
+    """
+    Sparse count matrix of polymerases, rows are organisms (taxon ids) or the clades of a rank
+    and columns are poly types or the CDD domains of the pssm file.
+
+    :ivar matrix: CSR counts, one row per entry of rows
+    :ivar rows: taxon id of each row
+    :ivar names: name of each row, '' when unknown
+    :ivar columns: poly type or CDD uid of each column
+    :ivar rank: 'organism' or the rank rows were rolled up to
+    """
+
+    def __init__(self, matrix: scipy.sparse.csr_matrix, rows: numpy.ndarray, names: numpy.ndarray,
+                 columns: numpy.ndarray, rank: str = 'organism'):
+        self.matrix: scipy.sparse.csr_matrix = matrix
+        self.rows: numpy.ndarray = rows
+        self.names: numpy.ndarray = names
+        self.columns: numpy.ndarray = columns
+        self.rank: str = rank
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def profile(self, taxon_id) -> numpy.ndarray:
+        """
+        :return: dense counts of the row of taxon_id
+        """
+        position = numpy.searchsorted(self.rows, int(taxon_id))
+        if position == len(self.rows) or self.rows[position] != int(taxon_id):
+            raise KeyError(taxon_id)
+        return self.matrix[position].toarray().ravel()
+
+    def totals(self) -> numpy.ndarray:
+        """
+        :return: counts of every column over all rows
+        """
+        return numpy.asarray(self.matrix.sum(axis=0)).ravel()
+
+    def to_frame(self) -> pandas.DataFrame:
+        """
+        :return: dense frame indexed by taxon id, for the notebooks
+        """
+        return pandas.DataFrame(self.matrix.toarray(), index=pandas.Index(self.rows, name='taxon_id'),
+                                columns=self.columns)
+
+    def roll_up(self, rank: str, taxa: pandas.DataFrame) -> "Repertoire":
+        """
+        Sums the organism rows into the clades of rank with one sparse product.
+        Organisms without a value for rank are left out.
+
+        :param rank: one of LEVELS
+        :param taxa: taxon table as given by handled.load_table('taxon')
+        """
+        if rank not in LEVELS:
+            raise ValueError(f"{rank} is not one of {LEVELS}")
+        lineage = taxa.drop_duplicates('taxon_id', keep='last').set_index('taxon_id')
+        clade_ids = lineage[rank + '_id'].reindex(self.rows)
+        known = clade_ids.notna().to_numpy()
+        clade_ids = clade_ids[known].astype('int64').to_numpy()
+        clades, group = numpy.unique(clade_ids, return_inverse=True)
+        indicator = scipy.sparse.csr_matrix(
+            (numpy.ones(len(group), dtype=numpy.int64), (group, numpy.flatnonzero(known))),
+            shape=(len(clades), len(self.rows))
+        )
+        clade_names = lineage.drop_duplicates(rank + '_id').set_index(rank + '_id')[rank]
+        names = clade_names.reindex(clades).astype(object).fillna('').to_numpy(dtype=str)
+        return Repertoire((indicator @ self.matrix).tocsr(), clades, names, self.columns, rank)
+
+    def save(self, path: str):
+        tmp_path = path + '.tmp.npz'
+        numpy.savez_compressed(tmp_path, data=self.matrix.data, indices=self.matrix.indices,
+                               indptr=self.matrix.indptr, shape=numpy.array(self.matrix.shape),
+                               rows=self.rows, names=self.names, columns=self.columns, rank=numpy.array(self.rank))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Repertoire":
+        with numpy.load(path, allow_pickle=False) as stored:
+            matrix = scipy.sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']),
+                                             shape=tuple(stored['shape']))
+            return cls(matrix, stored['rows'], stored['names'], stored['columns'], str(stored['rank']))
+
+
+def table_versions(paths: list[str]) -> str:
+    """
+    :return: digest of the size and modification time of every path, which changes whenever one is rewritten
+    """
+    digest = hashlib.blake2b(_FORMAT.encode('utf-8'), digest_size=8)
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+        except FileNotFoundError:
+            digest.update(f"{path}:missing;".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def organism_matrix(kind: str = 'poly_type', directory: str = '.', pssm_file: str = PSSM_FILE) -> Repertoire:
+    """
+    Counts the proteins of protein.csv per organism and poly type or CDD domain, without caching.
+    Every taxon of taxon.csv gets a row, also the ones without polymerases.
+
+    :param kind: 'poly_type' or 'cdd'
+    """
+    if kind not in KINDS:
+        raise ValueError(f"{kind} is not one of {KINDS}")
+    proteins = handled.load_table('protein', os.path.join(directory, handled.TABLES['protein']['file']))
+    taxa = handled.load_table('taxon', os.path.join(directory, handled.TABLES['taxon']['file']))
+    proteins = proteins[proteins['taxon_id'].notna()]
+    taxon_ids = proteins['taxon_id'].astype('int64').to_numpy()
+    rows = numpy.union1d(taxa['taxon_id'].dropna().astype('int64').to_numpy(), taxon_ids)
+    if kind == 'poly_type':
+        columns = numpy.array(POLY_TYPES)
+        column = pandas.Categorical(proteins['poly_type'].astype(object), categories=POLY_TYPES).codes
+    else:
+        columns = load_pssm(pssm_file)['cdd_uid'].drop_duplicates().to_numpy(dtype=numpy.int64)
+        column = pandas.Index(columns).get_indexer(proteins['cdd_id'].fillna(-1).astype('int64').to_numpy())
+    valid = column >= 0
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.ones(int(valid.sum()), dtype=numpy.int64), (numpy.searchsorted(rows, taxon_ids[valid]), column[valid])),
+        shape=(len(rows), len(columns))
+    ).tocsr()
+    names = taxa.drop_duplicates('taxon_id', keep='last').set_index('taxon_id')['name'].reindex(rows)
+    return Repertoire(matrix, rows, names.astype(object).fillna('').to_numpy(dtype=str), columns)
+
+
+def repertoire(kind: str = 'poly_type', rank: Optional[str] = None, directory: str = '.',
+               cache_dir: Optional[str] = CACHE_DIR, pssm_file: str = PSSM_FILE) -> Repertoire:
+    """
+    Organism or clade x poly type / CDD domain counts, read from the cache when the tables did not change.
+
+    repertoire('poly_type', 'phylum').to_frame()
+
+    :param kind: 'poly_type' or 'cdd'
+    :param rank: one of LEVELS to roll the organisms up to, None for one row per organism
+    :param directory: directory holding the csv tables
+    :param cache_dir: directory of the cached matrices, None to always build them
+    """
+    paths = [os.path.join(directory, handled.TABLES[table]['file']) for table in ('protein', 'taxon')]
+    if kind == 'cdd':
+        paths.append(pssm_file)
+    stem = f"{kind}-{rank or 'organism'}"
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"{stem}-{table_versions(paths)}.npz")
+        if os.path.exists(path):
+            return Repertoire.load(path)
+    outp = organism_matrix(kind, directory, pssm_file)
+    if rank is not None:
+        outp = outp.roll_up(rank, handled.load_table('taxon', paths[1]))
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(cache_dir, f"{stem}-*.npz")):
+            os.remove(stale)
+        outp.save(path)
+    return outp
+
+
+if __name__ == "__main__":
+    import sys
+    print(repertoire('poly_type', *sys.argv[1:2]).to_frame())
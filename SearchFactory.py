@@ -1,48 +1,219 @@
 import collections
 import json
+import math
+import threading
 from collections import OrderedDict
 from functools import lru_cache, partial
-from typing import Iterable, Sequence, Optional, TextIO, List, Final
+from itertools import islice
+from typing import Iterable, Iterator, Sequence, Optional, TextIO, List, Final
+
+import numpy
 
 import NCBIQueries
 from datetime import datetime, timezone
 
 import NCBIJobPacket
-from Model import NCBIId
+from Model import NCBIId, NCBIIdBatch
 from NCBIJobPacket import NCBIBaseJobPacket
 
 NCBI_CONFIG: Final[str] = "search_config.json"
 
+# Server limits of each endpoint: most ids per request, and for endpoints that only take ids in the url
+# the url bytes ids may use along with the bytes separating two ids
+ENDPOINT_LIMITS: Final[dict] = {
+    'esummary': {'max_ids': NCBIQueries.EntrezSummary.max_ids, 'url_bytes': None, 'separator_bytes': 1},
+    'efetch': {'max_ids': NCBIQueries.EntrezFetch.max_ids, 'url_bytes': None, 'separator_bytes': 1},
+    'elink': {'max_ids': 500, 'url_bytes': 4000, 'separator_bytes': 4},
+    'taxonomy': {'max_ids': NCBIQueries.TaxonSummary.max_ids, 'url_bytes': None, 'separator_bytes': 1},
+}
+DEFAULT_LIMITS: Final[dict] = {'max_ids': 200, 'url_bytes': 4000, 'separator_bytes': 1}
+MAX_RETRIES: Final[int] = 5  # failed requests in a row a job retries before giving up
+
+
+def _db_of(ids) -> str:
+    return ids.db if isinstance(ids, NCBIIdBatch) else ids[0].db
+
+
+def _uids_of(ids):
+    # batches go to the queries as they are, lists of NCBIId as their uid strings
+    return ids if isinstance(ids, NCBIIdBatch) else [ncbi_id.uid for ncbi_id in ids]
+
+
+def _describe(ids):
+    return repr(ids) if isinstance(ids, NCBIIdBatch) else [ncbi_id.uid for ncbi_id in ids]
+
+
+class AdaptiveBatcher:
+    """
+    Sizes id batches per endpoint from how the server handles them.
+
+    Every endpoint starts at a quarter of its id limit. The size grows by a quarter after each full batch
+    answered within target_latency and below max_bytes, shrinks by a quarter when a batch was slow or large,
+    and is halved on timeouts, 5xx and 414 responses. A 414 also lowers the url budget of the endpoint.
+    Rate limit responses leave the size alone.
+    """
+
+    def __init__(self, limits: Optional[dict] = None, target_latency: float = 2.0, max_bytes: int = 8 * 2 ** 20):
+        """
+        :param limits: ENDPOINT_LIMITS style limits, endpoints missing from it use DEFAULT_LIMITS
+        :param target_latency: seconds a batch may take before the batches of its endpoint get smaller
+        :param max_bytes: response size above which the batches of its endpoint get smaller
+        """
+        self.limits: dict = ENDPOINT_LIMITS if limits is None else limits
+        self.target_latency: float = target_latency
+        self.max_bytes: int = max_bytes
+        self._state: dict[str, dict] = dict()
+        self._lock = threading.Lock()
+
+    def _endpoint_state(self, endpoint: str) -> dict:
+        # called with _lock held
+        if endpoint not in self._state:
+            limits = dict(DEFAULT_LIMITS, **self.limits.get(endpoint, dict()))
+            limits['size'] = max(1, limits['max_ids'] // 4)
+            self._state[endpoint] = limits
+        return self._state[endpoint]
+
+    def size(self, endpoint: str, id_bytes: Optional[int] = None) -> int:
+        """
+        :param id_bytes: length of a typical id, bounds the size by the url budget of the endpoint
+        :return: ids to send in the next request to endpoint
+        """
+        with self._lock:
+            state = self._endpoint_state(endpoint)
+            size = state['size']
+            if id_bytes and state['url_bytes']:
+                size = min(size, state['url_bytes'] // (id_bytes + state['separator_bytes']))
+            return max(1, size)
+
+    def chunks(self, endpoint: str, ids: Iterable) -> Iterator[list]:
+        """
+        Lazily splits ids into batches, each sized when it is taken so feedback from
+        the requests of earlier batches is used.
+        """
+        if isinstance(ids, NCBIIdBatch):
+            yield from self._batch_chunks(endpoint, ids)
+            return
+        ids = iter(ids)
+        while True:
+            size = self.size(endpoint)
+            with self._lock:
+                state = self._endpoint_state(endpoint)
+                url_bytes, separator_bytes = state['url_bytes'], state['separator_bytes']
+            chunk, used = [], 0
+            for _id in ids:
+                chunk.append(_id)
+                used += len(str(getattr(_id, 'uid', _id))) + separator_bytes
+                if len(chunk) >= size or (url_bytes and used >= url_bytes):
+                    break
+            if not chunk:
+                return
+            yield chunk
+
+    def _batch_chunks(self, endpoint: str, ids: NCBIIdBatch) -> Iterator[NCBIIdBatch]:
+        # same as chunks, the url budget is applied on the digit counts of the whole batch at once
+        start = 0
+        lengths = None
+        while start < len(ids):
+            size = self.size(endpoint)
+            with self._lock:
+                state = self._endpoint_state(endpoint)
+                url_bytes, separator_bytes = state['url_bytes'], state['separator_bytes']
+            end = min(len(ids), start + size)
+            if url_bytes:
+                if lengths is None:
+                    lengths = numpy.cumsum(ids.encoded_lengths() + separator_bytes)
+                offset = lengths[start - 1] if start else 0
+                end = min(end, max(start + 1, int(numpy.searchsorted(lengths, offset + url_bytes)) + 1))
+            yield ids[start:end]
+            start = end
+
+    def observe(self, query: NCBIQueries.BaseNCBIQuery, latency: float, response_bytes: int):
+        """
+        Feedback from a sent request, matches the BaseNCBIQuery.observe signature.
+        """
+        ids = query.id_list()
+        if not ids:
+            return
+        with self._lock:
+            state = self._endpoint_state(query.endpoint())
+            if query.success:
+                if latency > self.target_latency or response_bytes > self.max_bytes:
+                    state['size'] = max(1, math.floor(min(state['size'], len(ids)) * 0.75))
+                elif len(ids) >= state['size']:
+                    state['size'] = min(state['max_ids'], math.ceil(state['size'] * 1.25))
+            elif query.status_code == 414:
+                state['size'] = max(1, len(ids) // 2)
+                used = len(query._get_cmd_string())
+                state['url_bytes'] = int(min(state['url_bytes'] or used, used) * 0.8)
+            elif not query.exceed_limit:
+                state['size'] = max(1, min(state['size'], len(ids)) // 2)
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: current batch size of every endpoint seen
+        """
+        with self._lock:
+            return {endpoint: state['size'] for endpoint, state in self._state.items()}
+
 
 class NCBICompositeJob:
     """
     Collection NCBI Queries that must be run to get the finish some task.
 
+    In streaming mode every packet result is handed out once and then released,
+    so a job holds at most the results that were not consumed yet.
+
     :ivar title: Name of collection. Should indicate its goal of task
     :ivar run_date: Date at which the job was run. Set to None before instance is run.
-    :ivar results: Collection of results from Jobs. Set to None before instance is run.
+    :ivar results: Merged results of all Jobs. Set to None before instance is run and when not merged.
     :ivar finished: True if job has been run to completion successfully else False.
     """
 
-    def __init__(self, title: str, jobs: list[NCBIBaseJobPacket]):
+    def __init__(self, title: str, jobs: list[NCBIBaseJobPacket], streaming: bool = False,
+                 merged: Optional[bool] = None):
         """
         :param title: title of this job collection.
         :param jobs: list of Queries that Inherit BaseNCBIQuery to be run.
+        :param streaming: release every result once it was consumed
+        :param merged: build the merged results view, defaults to True unless streaming
         """
         self.title: str = title
-        self._jobs: Sequence[NCBIBaseJobPacket] = tuple(jobs)
+        self._jobs: list[NCBIBaseJobPacket] = list(jobs)
         self._complete: int = 0
         self.finished: bool = False
         self.run_date: Optional[datetime] = None
         self.last_request_time: Optional[datetime] = None
         self.results_yielded: int = 0
         self.results_produced: int = 0
-        self._results: list[OrderedDict] = []
-        self.results: Optional[list[OrderedDict]] = None
+        self._results: collections.deque = collections.deque()
+        self.results: Optional[OrderedDict] = None
+        self.streaming: bool = streaming
+        self.merged: bool = not streaming if merged is None else merged
+        self._merged: Optional[OrderedDict] = None
+        self._closed: bool = False
+        self._ready = threading.Condition()
 
     def __len__(self):
         return len(self._jobs)
 
+    def set_streaming(self, merged: bool = False):
+        """
+        Switches a job that was not run yet to streaming mode.
+
+        :param merged: still build the merged results view
+        """
+        assert self.run_date is None, "A job can only be switched to streaming before it runs"
+        self.streaming = True
+        self.merged = merged
+
+    def _publish(self, result: OrderedDict):
+        if self.merged:
+            self._merged.update(result['results'])
+        with self._ready:
+            self._results.append(result)
+            self.results_produced += 1
+            self._ready.notify_all()
+
     def run_jobs(self) -> Iterable[int]:
         """
         Produces generator that yields:
@@ -50,59 +221,111 @@ class NCBICompositeJob:
             1 if result was unsuccessful due to server being down \n
             2 if result was unsuccessful due to exceed API ratelimit \n
         Only proceeds to next job if success.
+        A packet whose request timed out or got a 414 or 5xx is replaced by packets asking for its ids
+        in batches of the size the adaptive batcher shrank the endpoint to. A request that cannot be split
+        is retried, at most MAX_RETRIES times in a row.
 
         :return: A int corresponding to if computing the results was successful.
         :raises: RuntimeError when a request is sent that cause the server to HTTP status other
-                 than 200, 438, and 503
+                 than 200, 429, 414 and 5xx, or after MAX_RETRIES failed requests in a row
         """
-        self._results = list()
         self.run_date = datetime.now(timezone.utc)
-        self.results_yielded: int = 0
-        self.results_produced: int = 0
+        with self._ready:
+            self.results_yielded: int = 0
+            self.results_produced: int = 0
+            self._results.clear()
+            self._closed = False
         self._complete: int = 0
-        self._results: list[OrderedDict] = []
         self.finished: bool = False
-        while self._complete < len(self):
-            runner = self._jobs[self._complete]
-            for query in runner.run():
-                self.last_request_time = runner.get_last_request_time()
-                if not query.success \
-                        and not query.exceed_limit \
-                        and not query.server_unavailable:
-                    raise RuntimeError(f"Bad Server request with https-code {query.status_code}")
-                elif not query.success \
-                        and query.exceed_limit:
-                    yield 2
-                elif not query.success:
-                    yield 1
-                else:
-                    runner.progress()
-                    if runner.is_finished():
-                        self._results.append(
-                            self.__format_result(
-                                runner.generate_results(),
-                                time_of_request=self.last_request_time
+        self._merged = OrderedDict() if self.merged else None
+        failures = 0
+        try:
+            while self._complete < len(self):
+                runner = self._jobs[self._complete]
+                parts = []
+                for query in runner.run():
+                    self.last_request_time = runner.get_last_request_time()
+                    if not query.success \
+                            and not query.exceed_limit \
+                            and not query.server_unavailable \
+                            and not query.oversized():
+                        raise RuntimeError(f"Bad Server request with https-code {query.status_code}")
+                    elif not query.success \
+                            and query.exceed_limit:
+                        yield 2
+                    elif not query.success:
+                        ids = query.id_list() or ()
+                        if query.oversized():
+                            # observe already shrank the batch size of the endpoint
+                            size = min(NCBIQueryFactory.batcher.size(query.endpoint()), (len(ids) + 1) // 2)
+                            parts = runner.split(size)
+                        if parts:
+                            print(f"Splitting {len(ids)} ids of {query.endpoint()} in {len(parts)} requests "
+                                  f"after https-code {query.status_code}")
+                            self._jobs[self._complete:self._complete + 1] = parts
+                            yield 1
+                            break
+                        failures += 1
+                        if failures > MAX_RETRIES:
+                            raise RuntimeError(f"Gave up after {failures} failed requests, "
+                                               f"last with https-code {query.status_code}")
+                        yield 1
+                    else:
+                        failures = 0
+                        runner.progress()
+                        if runner.is_finished():
+                            self._publish(
+                                self.__format_result(
+                                    runner.generate_results(),
+                                    time_of_request=self.last_request_time
+                                )
                             )
-                        )
-                        self.results_produced += 1
-                    yield 0
-            self._complete += 1
-        self.results = OrderedDict()
-        for result in self._results:
-            self.results.update(result['results'])
-        self.results = self.__format_result(
-            self.results,
-            time_of_request=self.last_request_time
-        )
-        self.finished = True
+                        yield 0
+                if not parts:
+                    self._complete += 1
+            if self.merged:
+                self.results = self.__format_result(
+                    self._merged,
+                    time_of_request=self.last_request_time
+                )
+                self._merged = None
+            self.finished = True
+        finally:
+            with self._ready:
+                self._closed = True
+                self._ready.notify_all()
 
-    def get_results(self) -> Iterable[Optional[OrderedDict]]:
-        while self.results_yielded < len(self._jobs):
-            if self.results_yielded < self.results_produced:
-                yield self._results[self.results_yielded]
-                self.results_yielded += 1
-            else:
-                yield None
+    def _take(self) -> OrderedDict:
+        # called with _ready held and a result waiting
+        if self.streaming:
+            result = self._results.popleft()
+        else:
+            result = self._results[self.results_yielded]
+        self.results_yielded += 1
+        return result
+
+    def drain(self) -> list[OrderedDict]:
+        """
+        Takes the results produced so far without waiting, for consumers running the job in their own thread.
+        """
+        outp = []
+        with self._ready:
+            while self.results_yielded < self.results_produced:
+                outp.append(self._take())
+        return outp
+
+    def get_results(self) -> Iterable[OrderedDict]:
+        """
+        Yields every result as soon as its packet finished, waiting until one is ready.
+        Must be consumed from another thread than the one running run_jobs, which may use drain instead.
+        """
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self.results_yielded < self.results_produced or self._closed)
+                if self.results_yielded >= self.results_produced:
+                    return
+                result = self._take()
+            yield result
 
     def __format_result(self, result, time_of_request=None):
         outp = OrderedDict()
@@ -114,12 +337,14 @@ class NCBICompositeJob:
 
 
 class NCBIQueryFactory:
+    batcher: AdaptiveBatcher = AdaptiveBatcher()  # shared by every factory so feedback is not lost
 
     def __init__(self, config=NCBI_CONFIG):
         self.config_file: str = config
         f: TextIO
         with open(self.config_file, 'r') as f:
             self.config: dict = json.load(f)
+        NCBIQueries.BaseNCBIQuery.observe = self.batcher.observe
 
     def __call__(self, *args, **kwargs) -> NCBICompositeJob:
         """
@@ -133,6 +358,7 @@ class NCBIQueryFactory:
             self(arg0: str, arg1: str) gets link info db args0 to db args1 \n
             self(arg0: str, arg1: Sequence[str]) get info on all ids in arg1 in database arg0 \n
             self(arg0: str, arg1: Sequence[NCBIId]) gets all link data from an NCBIId \n
+        Numeric ids are carried as an NCBIIdBatch, which may be passed wherever a Sequence[NCBIId] is taken \n
         3 Argument Calls
             self(arg0: str, arg1: str, arg2: Sequence[str])
                 arg0: db you are linking from \n
@@ -160,10 +386,8 @@ class NCBIQueryFactory:
             if isinstance(search_obj, str):
                 return self.get_links_info(*args)
             elif isinstance(search_obj, Sequence):
-                if isinstance(search_obj[0], str):
-                    new_input: list[NCBIId] = []
-                    for _id in search_obj:
-                        new_input.append(NCBIId(args[0], _id))
+                if not isinstance(search_obj, NCBIIdBatch) and isinstance(search_obj[0], str):
+                    new_input = NCBIIdBatch.coerce(args[0], search_obj)
                     if kwargs.get('summary'):
                         return self.get_Summary(new_input)
                     return self.get_data(new_input)
@@ -172,10 +396,7 @@ class NCBIQueryFactory:
             assert isinstance(args[0], str), "First argument must be string when 3 arguments are given"
             assert isinstance(args[1], str), "Second argument must be string when 3 arguments are given"
             assert isinstance(args[2], Sequence), "Third argument must be a Sequence when 3 arguments are given"
-            new_input: list[NCBIId] = []
-            for _id in args[2]:
-                new_input.append(NCBIId(args[0], _id))
-            return self(args[1], new_input, **kwargs)
+            return self(args[1], NCBIIdBatch.coerce(args[0], args[2]), **kwargs)
         else:
             raise ValueError('To many arguments!')
 
@@ -208,62 +429,62 @@ class NCBIQueryFactory:
         _title = f"LinkInfo {args[0]} {args[1]}"
         return NCBICompositeJob(title=_title, jobs=[value])
 
-    def get_link(self, param: str, param1: Sequence[NCBIId], linkname: Optional[str] = None):
+    def get_link(self, param: str, param1: Sequence[NCBIId], linkname: Optional[str] = None, by_id: bool = False):
         _jobs = [NCBIJobPacket.NCBIMonoJobPacket(
-                NCBIQueries.EntrezLink(param1[0].db, param, [ncbi_id.uid for ncbi_id in param1], linkname=linkname)
+                NCBIQueries.EntrezLink(_db_of(param1), param, _uids_of(param1), linkname=linkname, by_id=by_id)
             )
         ]
-        _title = f"link {param1[0].db} {param} {[ncbi_id.uid for ncbi_id in param1]}"
+        _title = f"link {_db_of(param1)} {param} {_describe(param1)}"
         return NCBICompositeJob(_title, _jobs)
        # raise NotImplementedError('Post Link not implement yet')
 
     def get_data(self, *param, **kwargs):
-        if len(param[0]) <= 150:
+        if len(param[0]) <= NCBIQueries.EntrezFetch.max_ids:
             _jobs = [NCBIJobPacket.NCBIMonoJobPacket(
-                    NCBIQueries.EntrezFetch(db=param[0][0].db, id=[ncbi_id.uid for ncbi_id in param[0]],
-                                            html_tags=self.config["tags"][param[0][0].db])
+                    NCBIQueries.EntrezFetch(db=_db_of(param[0]), id=_uids_of(param[0]),
+                                            html_tags=self.config["tags"][_db_of(param[0])])
                 )
             ]
-            _title = f"Fetch Data {param[0][0].db} {[ncbi_id.uid for ncbi_id in param[0]]}"
+            _title = f"Fetch Data {_db_of(param[0])} {_describe(param[0])}"
             return NCBICompositeJob(_title, _jobs)
         raise ValueError("To many values")
 
 
     def get_Summary(self, *param, **kwargs):
-        if len(param[0]) <= 150:
+        if len(param[0]) <= NCBIQueries.EntrezSummary.max_ids:
             _jobs = [NCBIJobPacket.NCBIMonoJobPacket(
-                    NCBIQueries.EntrezSummary(db=param[0][0].db, id=[ncbi_id.uid for ncbi_id in param[0]])
+                    NCBIQueries.EntrezSummary(db=_db_of(param[0]), id=_uids_of(param[0]))
                 )
             ]
-            _title = f"Summary {param[0][0].db} {[ncbi_id.uid for ncbi_id in param[0]]}"
+            _title = f"Summary {_db_of(param[0])} {_describe(param[0])}"
             return NCBICompositeJob(_title, _jobs)
         raise ValueError("To many values")
 
 
-    def list_chunker(self, input_list: Sequence[NCBIId], chunk_size=None) -> List[List[NCBIId]]:
+    def list_chunker(self, input_list: Iterable, chunk_size=None, endpoint: Optional[str] = None) -> Iterator[list]:
         """
-        Returns a list of list of NCBI such that each list in the output is
-        no larger than the chunk_size. \n
-        If chunk_size is not set then we have chunk_size is set to the chunk value of the config file. \n
-        Base on the grouper method in the itertools recipes. \n
-        See: https://docs.python.org/3/library/itertools.html#itertools-recipes \n
-
+        Lazily splits input_list into lists no larger than the chunk size. \n
+        With an endpoint and no chunk_size the chunks are sized by the adaptive batcher of that endpoint. \n
+        If neither is set then chunk_size is set to the chunk value of the config file. \n
 
-        :param input_list:
-        :param chunk_size:
-        :return: List of List of NCBI such that each list less than chunk_size.
+        :param input_list: ids, consumed as the chunks are taken
+        :param chunk_size: fixed size of every chunk
+        :param endpoint: endpoint the chunks are sent to, e.g. 'esummary' or 'elink'
+        :return: generator of lists of ids, of NCBIIdBatch views when input_list is an NCBIIdBatch
         """
+        if endpoint is not None and chunk_size is None:
+            yield from self.batcher.chunks(endpoint, input_list)
+            return
         chunk_size = self.config['chunk'] if chunk_size is None else chunk_size
-        _iter = [iter(input_list)] * chunk_size
-        output = []
+        if isinstance(input_list, NCBIIdBatch):
+            yield from input_list.chunks(chunk_size)
+            return
+        _iter = iter(input_list)
         while True:
-            pack = [next(_iter_item, None) for _iter_item in _iter]
-            pack = list(filter(lambda x: x is not None, pack))
-            if pack:
-                output.append(pack)
-            else:
+            pack = list(islice(_iter, chunk_size))
+            if not pack:
                 break
-        return output
+            yield pack
 
     def taxon_query(self, taxon, page_token=None):
         if page_token:
@@ -281,7 +502,8 @@ class NCBIQueryFactory:
 
     def lineage_query(self, param):
         _jobs = [NCBIJobPacket.NCBIMonoJobPacket(
-            NCBIQueries.TaxonSummary(param)
+            NCBIQueries.TaxonSummary(param),
+            extractor=NCBIQueries.TaxonSummary.rank_tables
         )
         ]
         _title = f"getting taxons"
@@ -346,7 +568,7 @@ if __name__ == "__main__":
               '167532179', '167529623', '167514896', '167514205', '167511999',
               ]
     id_values = [NCBIId('protein', _id) for _id in _ptest2]
-    chunks = f.list_chunker(id_values, 5)
+    chunks = list(f.list_chunker(id_values, 5))
     test_comp = NCBICompositeJob('title',
                      [
                          NCBIJobPacket.NCBIMonoJobPacket(
@@ -0,0 +1,222 @@
+import os
+import threading
+from typing import Final, Iterable, Optional
+
+import numpy
+import pandas
+import pyarrow
+import pyarrow.compute as pc
+
+import handled
+
+SYMBOL_DIR: Final[str] = "symbols"
+NULL_CODE: Final[int] = -1
+
+# Columns sharing one dictionary, so e.g. a genus code in taxon.csv means the same name in taxonomy_node.csv.
+# Category columns not listed here get a dictionary named after the column.
+DOMAINS: Final[dict[str, str]] = {
+    'name': 'taxon_name', 'species': 'taxon_name', 'genus': 'taxon_name', 'family': 'taxon_name',
+    'order': 'taxon_name', 'class': 'taxon_name', 'phylum': 'taxon_name',
+    'organism': 'taxon_name',
+}
+
+_directory: str = SYMBOL_DIR
+_tables: dict[str, "SymbolTable"] = dict()
+_tables_lock = threading.Lock()
+
+
+class SymbolTable:
+    """
+    Append only dictionary of the repeated strings of one domain, e.g. taxon names or poly types.
+
+    Every value gets the next free int code the first time it is seen and keeps it for good:
+    the values are persisted one per line in code order, so codes are stable between runs
+    and frames or arrow tables encoded with the same table can be joined and grouped on their codes.
+    None is NULL_CODE. Only one process should add to a symbol directory, see set_directory.
+
+    :ivar name: domain of the table, also the stem of its file
+    :ivar values: value of every code, the canonical copy of each string
+    """
+
+    def __init__(self, name: str, directory: Optional[str] = None):
+        """
+        :param name: domain of the table
+        :param directory: directory of the symbol files, defaults to the current symbol directory
+        """
+        self.name: str = name
+        self.path: str = os.path.join(_directory if directory is None else directory, f"{name}.txt")
+        self.values: list[str] = []
+        self._codes: dict[str, int] = dict()
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    self._add(line.rstrip('\n'))
+        except FileNotFoundError:
+            pass
+        self._saved: int = len(self.values)
+
+    def _add(self, value: str) -> int:
+        code = len(self.values)
+        self.values.append(value)
+        self._codes[value] = code
+        return code
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __contains__(self, value) -> bool:
+        return value in self._codes
+
+    def code(self, value) -> int:
+        """
+        :return: code of value, added to the table when new
+        """
+        if value is None:
+            return NULL_CODE
+        value = str(value)
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = self._add(value)
+        return code
+
+    def intern(self, value) -> Optional[str]:
+        """
+        :return: the shared copy of value, so repeated values are stored once
+        """
+        if value is None:
+            return None
+        return self.values[self.code(value)]
+
+    def value(self, code: int) -> Optional[str]:
+        return None if code == NULL_CODE else self.values[code]
+
+    def encode(self, values: Iterable) -> numpy.ndarray:
+        """
+        :return: int32 codes of values, NULL_CODE for missing ones. Only distinct values are looked up.
+        """
+        local, uniques = pandas.factorize(pandas.Series(values, dtype=object), use_na_sentinel=True)
+        mapping = numpy.array([self.code(value) for value in uniques] + [NULL_CODE], dtype=numpy.int32)
+        return mapping[local]
+
+    def decode(self, codes: numpy.ndarray) -> numpy.ndarray:
+        """
+        :return: object array of the values of codes, None for NULL_CODE
+        """
+        return numpy.array(self.values + [None], dtype=object)[codes]
+
+    def categories(self) -> pandas.Index:
+        """
+        :return: every value in code order, for pandas categoricals whose codes are the codes of the table
+        """
+        return pandas.Index(self.values, dtype=object)
+
+    def save(self):
+        """
+        Appends the values added since the last save to the symbol file.
+        """
+        with self._lock:
+            new_values = self.values[self._saved:]
+            if not new_values:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.writelines(f"{value}\n" for value in new_values)
+            self._saved += len(new_values)
+
+
+def set_directory(directory: str):
+    """
+    Makes this process use its own symbol files, e.g. one directory per shard.
+    Must be called before any table is opened.
+    """
+    global _directory
+    _directory = directory
+    with _tables_lock:
+        _tables.clear()
+
+
+def domain_of(column: str) -> str:
+    return DOMAINS.get(column, column)
+
+
+def symbols(domain: str) -> SymbolTable:
+    """
+    :return: the shared symbol table of a domain, loaded on first use
+    """
+    table = _tables.get(domain)
+    if table is None:
+        with _tables_lock:
+            table = _tables.setdefault(domain, SymbolTable(domain))
+    return table
+
+
+def symbols_of(column: str) -> SymbolTable:
+    """
+    :return: the symbol table of a category column of handled.TABLES
+    """
+    return symbols(domain_of(column))
+
+
+def category_columns(table: str) -> list[str]:
+    return [column for column, kind in handled.TABLES[table]['columns'].items() if kind == 'category']
+
+
+def encode_frame(table: str, frame: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Replaces the category columns of a frame of handled.TABLES by categoricals over the stable dictionaries,
+    so two frames sharing a domain have the same categories and codes.
+    """
+    for column in category_columns(table):
+        if column in frame.columns:
+            table_symbols = symbols_of(column)
+            codes = table_symbols.encode(frame[column].astype(object).where(frame[column].notna(), None))
+            frame[column] = pandas.Categorical.from_codes(codes, categories=table_symbols.categories())
+    return frame
+
+
+def encode_arrow(table: str, arrow_table: pyarrow.Table) -> pyarrow.Table:
+    """
+    Rebuilds the dictionary columns of an arrow table of handled.TABLES on the stable dictionaries.
+    """
+    for column in category_columns(table):
+        if column not in arrow_table.column_names:
+            continue
+        table_symbols = symbols_of(column)
+        chunks = []
+        # csv chunks each come with their own dictionary, so they are mapped one at a time
+        for chunk in arrow_table[column].chunks:
+            if not pyarrow.types.is_dictionary(chunk.type):
+                chunk = pc.dictionary_encode(chunk)
+            mapping = numpy.array([table_symbols.code(value) for value in chunk.dictionary.to_pylist()] + [0],
+                                  dtype=numpy.int32)
+            local = chunk.indices.fill_null(len(mapping) - 1).to_numpy(zero_copy_only=False)
+            codes = pyarrow.array(mapping[local], mask=chunk.indices.is_null().to_numpy(zero_copy_only=False))
+            chunks.append(codes)
+        # the dictionary is taken once every chunk added its new values
+        dictionary = pyarrow.array(table_symbols.values, pyarrow.string())
+        encoded = pyarrow.chunked_array([pyarrow.DictionaryArray.from_arrays(codes, dictionary) for codes in chunks],
+                                        pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+        arrow_table = arrow_table.set_column(arrow_table.column_names.index(column), column, encoded)
+    return arrow_table
+
+
+def save_all():
+    """
+    Persists every symbol table opened by this process.
+    """
+    with _tables_lock:
+        tables = list(_tables.values())
+    for table in tables:
+        table.save()
+
+
+if __name__ == "__main__":
+    for _table in ('taxon', 'gene', 'protein'):
+        _frame = encode_frame(_table, handled.load_table(_table))
+        for _column in category_columns(_table):
+            print(f"{_table}.{_column}: {_frame[_column].nunique()} distinct of {len(symbols_of(_column))} symbols")
+    save_all()
@@ -0,0 +1,197 @@
+import os
+import struct
+from typing import Final, Iterable, Optional
+
+import numpy
+
+INDEX_PATH: Final[str] = "taxonomy.idx"
+LEVELS: Final[tuple] = ('phylum', 'class', 'order', 'family', 'genus', 'species')
+
+_MAGIC: Final[bytes] = b"PCTAXv1\0"
+# magic, node count, size of the id -> row table, bytes of names, bytes of rank names
+_HEADER: Final[struct.Struct] = struct.Struct("<8sQQQQ")
+
+
+def _split_dmp(line: str) -> list[str]:
+    return line.rstrip('\n').rstrip('|').rstrip('\t').split('\t|\t')
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+class TaxonomyIndex:
+    """
+    Offline taxonomy built from the nodes.dmp and names.dmp files of an NCBI taxdump
+    (https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz).
+
+    The tree is kept as flat arrays memory mapped from a single binary file:
+    a dense tax_id -> row table, then parent row, tax_id and rank code per row,
+    then the scientific names as one utf-8 blob with offsets.
+    Every lookup is an array access so no request is sent to NCBI.
+    """
+
+    def __init__(self, path: str = INDEX_PATH):
+        """
+        :param path: file written by TaxonomyIndex.build
+        """
+        self.path: str = path
+        with open(path, 'rb') as f:
+            magic, size, id_space, name_bytes, rank_bytes = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a taxonomy index")
+        offset = _HEADER.size
+
+        def section(dtype, count):
+            nonlocal offset
+            offset = _align(offset)
+            if not count:
+                return numpy.empty(0, dtype=dtype)
+            # plain ndarray views skip the memmap subclass overhead on every element access
+            array = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)).view(numpy.ndarray)
+            offset += numpy.dtype(dtype).itemsize * count
+            return array
+
+        self._rows = section(numpy.int32, id_space)
+        self._parents = section(numpy.int32, size)
+        self._tax_ids = section(numpy.int32, size)
+        self._ranks = section(numpy.uint8, size)
+        self._name_offsets = section(numpy.int64, size + 1)
+        self._names = section(numpy.uint8, name_bytes)
+        self.rank_names: list[str] = bytes(section(numpy.uint8, rank_bytes)).decode('utf-8').split('\n')
+
+    @classmethod
+    def build(cls, dump_dir: str, path: str = INDEX_PATH) -> "TaxonomyIndex":
+        """
+        Parses a taxdump directory and writes the binary index.
+
+        :param dump_dir: directory holding nodes.dmp and names.dmp
+        :param path: file to write the index to
+        :return: the opened index
+        """
+        tax_ids, parents, ranks = [], [], []
+        rank_codes: dict[str, int] = dict()
+        with open(os.path.join(dump_dir, 'nodes.dmp'), 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = _split_dmp(line)
+                tax_ids.append(int(fields[0]))
+                parents.append(int(fields[1]))
+                ranks.append(rank_codes.setdefault(fields[2], len(rank_codes)))
+        if len(rank_codes) > 255:
+            raise ValueError("Too many distinct ranks for the index")
+        tax_ids = numpy.array(tax_ids, dtype=numpy.int32)
+        rows = numpy.full(int(tax_ids.max()) + 1 if len(tax_ids) else 0, -1, dtype=numpy.int32)
+        rows[tax_ids] = numpy.arange(len(tax_ids), dtype=numpy.int32)
+        parents = rows[numpy.array(parents, dtype=numpy.int32)]
+
+        names: list[bytes] = [b''] * len(tax_ids)
+        with open(os.path.join(dump_dir, 'names.dmp'), 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = _split_dmp(line)
+                if fields[3] == 'scientific name':
+                    names[rows[int(fields[0])]] = fields[1].encode('utf-8')
+        name_offsets = numpy.zeros(len(names) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(name) for name in names], out=name_offsets[1:])
+        name_blob = b''.join(names)
+        rank_blob = '\n'.join(sorted(rank_codes, key=rank_codes.get)).encode('utf-8')
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as out:
+            out.write(_HEADER.pack(_MAGIC, len(tax_ids), len(rows), len(name_blob), len(rank_blob)))
+            for data in (rows, parents, tax_ids, numpy.array(ranks, dtype=numpy.uint8), name_offsets,
+                         name_blob, rank_blob):
+                out.write(b'\0' * (_align(out.tell()) - out.tell()))
+                out.write(data if isinstance(data, bytes) else data.tobytes())
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def _row(self, tax_id) -> int:
+        tax_id = int(tax_id)
+        row = int(self._rows[tax_id]) if 0 <= tax_id < len(self._rows) else -1
+        if row < 0:
+            raise KeyError(tax_id)
+        return row
+
+    def _name(self, row: int) -> str:
+        return bytes(self._names[self._name_offsets[row]:self._name_offsets[row + 1]]).decode('utf-8')
+
+    def __contains__(self, tax_id) -> bool:
+        try:
+            self._row(tax_id)
+        except (KeyError, ValueError):
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._tax_ids)
+
+    def name(self, tax_id) -> str:
+        return self._name(self._row(tax_id))
+
+    def rank(self, tax_id) -> str:
+        return self.rank_names[self._ranks[self._row(tax_id)]]
+
+    def parent(self, tax_id) -> int:
+        return int(self._tax_ids[self._parents[self._row(tax_id)]])
+
+    def lineage(self, tax_id) -> list[int]:
+        """
+        :return: tax_ids of the ancestors of tax_id ordered from the root, tax_id itself excluded
+        """
+        row = self._row(tax_id)
+        outp = []
+        while self._parents[row] != row:
+            row = int(self._parents[row])
+            outp.append(int(self._tax_ids[row]))
+        outp.reverse()
+        return outp
+
+    def rank_table(self, tax_id) -> dict:
+        """
+        Resolves tax_id to the same row main.get_Taxonomy builds for taxon.csv.
+        Ranks missing from the lineage are None.
+        """
+        outp = {'name': self.name(tax_id), 'taxon_id': str(tax_id)}
+        outp.update({level: None for level in LEVELS})
+        outp.update({level + '_id': None for level in LEVELS})
+        row = self._row(tax_id)
+        while True:
+            rank = self.rank_names[self._ranks[row]]
+            if rank in LEVELS:
+                outp[rank] = self._name(row)
+                outp[rank + '_id'] = str(int(self._tax_ids[row]))
+            if self._parents[row] == row:
+                break
+            row = int(self._parents[row])
+        return outp
+
+
+def open_index(path: str = INDEX_PATH) -> Optional[TaxonomyIndex]:
+    """
+    :return: the taxonomy index at path or None when no index was built
+    """
+    if not os.path.exists(path):
+        return None
+    return TaxonomyIndex(path)
+
+
+def resolve(index: TaxonomyIndex, taxon_ids: Iterable) -> tuple[list[dict], list]:
+    """
+    Splits taxon_ids into rows resolved from the index and the ids the index does not know.
+    """
+    found, missing = [], []
+    for taxon_id in taxon_ids:
+        if taxon_id in index:
+            found.append(index.rank_table(taxon_id))
+        else:
+            missing.append(taxon_id)
+    return found, missing
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("usage: python TaxDump.py <taxdump directory> [index file]")
+    else:
+        built = TaxonomyIndex.build(*sys.argv[1:3])
+        print(f"indexed {len(built):,} taxa into {built.path}")
@@ -0,0 +1,289 @@
+from typing import Final, Iterable, Optional
+
+import numpy
+import pandas
+
+import handled
+
+POLY_TYPES: Final[tuple] = ('A', 'B', 'C', 'X', 'Y')
+LEVELS: Final[tuple] = ('phylum', 'class', 'order', 'family', 'genus', 'species')
+ROOT: Final[int] = 0  # tax id of the virtual root above every phylum
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over positions 0..size-1 holding one count per poly type,
+    so point additions and range sums are O(log n) for all types at once.
+    """
+
+    def __init__(self, size: int, width: int = len(POLY_TYPES)):
+        self.size: int = size
+        self.tree: numpy.ndarray = numpy.zeros((size + 1, width), dtype=numpy.int64)
+
+    @classmethod
+    def from_counts(cls, counts: numpy.ndarray) -> "FenwickTree":
+        """
+        Builds the tree of a (size, width) count array in O(n).
+        """
+        tree = cls(counts.shape[0], counts.shape[1])
+        tree.tree[1:] = counts
+        for i in range(1, tree.size + 1):
+            parent = i + (i & -i)
+            if parent <= tree.size:
+                tree.tree[parent] += tree.tree[i]
+        return tree
+
+    def add(self, position: int, values):
+        i = position + 1
+        while i <= self.size:
+            self.tree[i] += values
+            i += i & -i
+
+    def prefix(self, position: int) -> numpy.ndarray:
+        """
+        :return: sum of positions 0..position-1
+        """
+        outp = numpy.zeros(self.tree.shape[1], dtype=numpy.int64)
+        i = position
+        while i > 0:
+            outp += self.tree[i]
+            i -= i & -i
+        return outp
+
+    def range(self, start: int, stop: int) -> numpy.ndarray:
+        """
+        :return: sum of positions start..stop-1
+        """
+        return self.prefix(stop) - self.prefix(start)
+
+
+class TaxonTree:
+    """
+    In memory tree of the collected taxa, phylum ... species then the taxon of each assembly,
+    with the polymerase repertoire of every clade.
+
+    The tree is stored as parent pointer arrays numbered by an Euler tour:
+    every node gets the preorder interval [start, stop) of its subtree, so subtree tests are O(1),
+    lowest common ancestors are O(1) range minimum queries over the tour through a sparse table,
+    and per type protein counts are a Fenwick tree over preorder positions, so clade totals are O(log n).
+
+    attach keeps it current with handled.write_*: new proteins are O(log n) updates,
+    a new taxon only marks the numbering stale and the tree is rebuilt on the next query.
+
+    >>> tree = TaxonTree.load()
+    >>> tree.counts(1224)  # Proteobacteria
+    >>> tree.lca(208964, 511145)
+    """
+
+    def __init__(self, taxa: Iterable[dict] = (), proteins: Optional[dict[int, numpy.ndarray]] = None):
+        """
+        :param taxa: rows in the taxon.csv format
+        :param proteins: taxon id -> proteins of each type of POLY_TYPES found in that taxon
+        """
+        self._parents: dict[int, int] = {ROOT: ROOT}
+        self._ranks: dict[int, str] = {ROOT: 'root'}
+        self._names: dict[int, Optional[str]] = {ROOT: None}
+        self._proteins: dict[int, numpy.ndarray] = dict() if proteins is None else dict(proteins)
+        for row in taxa:
+            self._add_lineage(row)
+        self._stale: bool = True
+
+    @classmethod
+    def load(cls) -> "TaxonTree":
+        """
+        Builds the tree of taxon.csv with the proteins of protein.csv.
+        """
+        taxa = handled.load_view('taxon').rows()
+        frame = handled.load_table('protein')[['taxon_id', 'poly_type']].dropna()
+        frame = frame[frame['poly_type'].isin(POLY_TYPES)]
+        table = pandas.crosstab(frame['taxon_id'].astype('int64'), frame['poly_type'].astype(str))
+        table = table.reindex(columns=list(POLY_TYPES), fill_value=0)
+        proteins = {int(taxon_id): counts for taxon_id, counts in zip(table.index, table.to_numpy(dtype=numpy.int64))}
+        return cls(taxa, proteins)
+
+    def _add_lineage(self, row: dict) -> bool:
+        """
+        :return: True when the row added a node
+        """
+        parent, added = ROOT, False
+        lineage = [(row.get(level + '_id'), level, row.get(level)) for level in LEVELS]
+        lineage.append((row.get('taxon_id'), 'taxon', row.get('name')))
+        for tax_id, rank, name in lineage:
+            if tax_id is None or str(tax_id) in handled.NULL_VALUES:
+                continue
+            tax_id = int(tax_id)
+            if tax_id == parent:
+                continue  # the taxon of an assembly can be its species
+            if tax_id not in self._parents:
+                self._parents[tax_id] = parent
+                self._ranks[tax_id] = rank
+                self._names[tax_id] = name
+                added = True
+            parent = tax_id
+        return added
+
+    def _build(self):
+        ids = numpy.fromiter(self._parents.keys(), dtype=numpy.int64, count=len(self._parents))
+        parents = numpy.fromiter(self._parents.values(), dtype=numpy.int64, count=len(self._parents))
+        index = {int(tax_id): i for i, tax_id in enumerate(ids)}
+        parent_index = numpy.array([index[int(parent)] for parent in parents], dtype=numpy.int64)
+        children: list[list[int]] = [[] for _ in ids]
+        for child in numpy.argsort(parent_index, kind='stable'):
+            if child != parent_index[child]:
+                children[parent_index[child]].append(int(child))
+        count = len(ids)
+        start = numpy.zeros(count, dtype=numpy.int64)
+        stop = numpy.zeros(count, dtype=numpy.int64)
+        depth = numpy.zeros(count, dtype=numpy.int64)
+        first = numpy.zeros(count, dtype=numpy.int64)
+        tour: list[int] = []
+        order = 0
+        stack = [(index[ROOT], 0)]
+        while stack:
+            node, child = stack.pop()
+            if child == 0:
+                start[node] = order
+                order += 1
+                first[node] = len(tour)
+            tour.append(node)
+            if child < len(children[node]):
+                stack.append((node, child + 1))
+                nxt = children[node][child]
+                depth[nxt] = depth[node] + 1
+                stack.append((nxt, 0))
+            else:
+                stop[node] = order
+        self._ids, self._index, self._parent = ids, index, parent_index
+        self._start, self._stop, self._depth, self._first = start, stop, depth, first
+        self._tour = numpy.array(tour, dtype=numpy.int64)
+        # sparse table: level k holds the node of least depth in tour[i:i + 2**k]
+        levels = [self._tour]
+        span = 1
+        while span * 2 <= len(self._tour):
+            previous = levels[-1]
+            left, right = previous[:len(previous) - span], previous[span:]
+            levels.append(numpy.where(depth[left] <= depth[right], left, right))
+            span *= 2
+        self._sparse = levels
+        counts = numpy.zeros((count, len(POLY_TYPES)), dtype=numpy.int64)
+        for tax_id, values in self._proteins.items():
+            if tax_id in index:
+                counts[start[index[tax_id]]] += values
+        self._counts = FenwickTree.from_counts(counts)
+        self._stale = False
+
+    def _node(self, tax_id) -> int:
+        if self._stale:
+            self._build()
+        try:
+            return self._index[int(tax_id)]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(tax_id)
+
+    def __contains__(self, tax_id) -> bool:
+        try:
+            return int(tax_id) in self._parents
+        except (TypeError, ValueError):
+            return False
+
+    def __len__(self) -> int:
+        return len(self._parents) - 1
+
+    def add_taxon(self, row: dict):
+        """
+        Adds the lineage of a row in the taxon.csv format, the numbering is redone on the next query if it is new.
+        """
+        if self._add_lineage(row):
+            self._stale = True
+
+    def add_protein(self, taxon_id, poly_type: str, count: int = 1):
+        """
+        Counts proteins of poly_type in taxon_id and in every clade above it.
+        Proteins of taxa not in the tree yet are kept until their taxon is added.
+        """
+        if poly_type not in POLY_TYPES or taxon_id is None:
+            return
+        taxon_id = int(taxon_id)
+        values = numpy.zeros(len(POLY_TYPES), dtype=numpy.int64)
+        values[POLY_TYPES.index(poly_type)] = count
+        self._proteins[taxon_id] = self._proteins.get(taxon_id, 0) + values
+        if not self._stale and taxon_id in self._index:
+            self._counts.add(int(self._start[self._index[taxon_id]]), values)
+
+    def add(self, table: str, row: dict):
+        """
+        Matches the handled.add_write_listener signature.
+        """
+        if table == 'taxon':
+            self.add_taxon(row)
+        elif table == 'protein':
+            self.add_protein(row.get('taxon_id') if row.get('taxon_id') not in handled.NULL_VALUES else None,
+                             row.get('poly_type'))
+
+    def attach(self):
+        """
+        Keeps the tree updated from now on by listening to handled.write_*
+        """
+        handled.add_write_listener(self.add)
+
+    def detach(self):
+        handled.remove_write_listener(self.add)
+
+    def counts(self, clade) -> dict[str, int]:
+        """
+        :param clade: tax id of any node of the tree, e.g. a phylum
+        :return: proteins of each poly type in the clade
+        """
+        node = self._node(clade)
+        totals = self._counts.range(int(self._start[node]), int(self._stop[node]))
+        return dict(zip(POLY_TYPES, totals.tolist()))
+
+    def count(self, clade, poly_type: str) -> int:
+        return self.counts(clade)[poly_type]
+
+    def is_ancestor(self, ancestor, tax_id) -> bool:
+        """
+        :return: True when tax_id is in the clade of ancestor, including ancestor itself
+        """
+        a, b = self._node(ancestor), self._node(tax_id)
+        return self._start[a] <= self._start[b] < self._stop[a]
+
+    def lca(self, a, b) -> int:
+        """
+        :return: tax id of the lowest common ancestor of a and b, ROOT when they share no phylum
+        """
+        a, b = self._node(a), self._node(b)
+        left, right = sorted((int(self._first[a]), int(self._first[b])))
+        level = (right - left + 1).bit_length() - 1
+        table = self._sparse[level]
+        x, y = table[left], table[right - (1 << level) + 1]
+        return int(self._ids[x if self._depth[x] <= self._depth[y] else y])
+
+    def lineage(self, tax_id) -> list[int]:
+        """
+        :return: tax ids from tax_id up to, not including, the root
+        """
+        outp = []
+        tax_id = int(tax_id)
+        while tax_id != ROOT:
+            outp.append(tax_id)
+            tax_id = self._parents[tax_id]
+        return outp
+
+    def rank(self, tax_id) -> str:
+        return self._ranks[int(tax_id)]
+
+    def name(self, tax_id) -> Optional[str]:
+        return self._names[int(tax_id)]
+
+    def clades(self, rank: str) -> list[int]:
+        """
+        :return: tax ids of every node of rank, e.g. every phylum
+        """
+        return [tax_id for tax_id, node_rank in self._ranks.items() if node_rank == rank]
+
+
+if __name__ == "__main__":
+    _tree = TaxonTree.load()
+    for _phylum in _tree.clades('phylum'):
+        print(_tree.name(_phylum), _tree.counts(_phylum))
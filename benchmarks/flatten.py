@@ -0,0 +1,65 @@
+"""
+Compares per record Model.NCBIData.flatten_results against the column wise NCBIData.flatten_batch.
+
+Run from the repository root:
+    python -m benchmarks.flatten [records]
+
+Synthetic Assembly and Protein records are built (100000 of each by default) and both outputs are checked to agree.
+"""
+import gc
+import sys
+import time
+
+from Model import Assembly, AssemblyGeneData, Domain, NCBIId, Protein
+
+
+def build_assemblies(count: int) -> list[Assembly]:
+    return [
+        Assembly(NCBIId('genome', str(1000 + i)), f"organism {i % 97}", f"ASM{i}v1", 2_000_000 + i, 4_500_000 + i,
+                 1 + i % 3, AssemblyGeneData(4000 + i % 50, 3800, 150, 40 + i % 10), NCBIId('taxon', str(562 + i)))
+        for i in range(count)
+    ]
+
+
+def build_proteins(count: int) -> list[Protein]:
+    return [
+        Protein(NCBIId('protein', str(16130000 + i)), f"DNA polymerase {i}",
+                Domain(NCBIId('cdd', str(100000 + i % 40)), f"pol domain {i % 40}", 'ABCXY'[i % 5]))
+        for i in range(count)
+    ]
+
+
+def per_record(records):
+    return [record.flatten_results() for record in records]
+
+
+def batched(records):
+    return type(records[0]).flatten_batch(records)
+
+
+def check(rows: list[dict], columns: dict):
+    assert list(rows[0]) == list(columns), f"{list(rows[0])} != {list(columns)}"
+    for i in (0, len(rows) // 2, len(rows) - 1):
+        assert {column: str(value) for column, value in rows[i].items()} == \
+               {column: str(values[i]) for column, values in columns.items()}, i
+
+
+def measure(fn, records):
+    gc.collect()
+    start = time.perf_counter()
+    result = fn(records)
+    return time.perf_counter() - start, result
+
+
+def main(count: int = 100000):
+    print(f"{'records':<12}{'method':<16}{'seconds':>10}{'speedup':>10}")
+    for name, records in (('Assembly', build_assemblies(count)), ('Protein', build_proteins(count))):
+        slow, rows = min((measure(per_record, records) for _ in range(3)), key=lambda result: result[0])
+        fast, columns = min((measure(batched, records) for _ in range(3)), key=lambda result: result[0])
+        check(rows, columns)
+        print(f"{name:<12}{'flatten_results':<16}{slow:>10.3f}")
+        print(f"{name:<12}{'flatten_batch':<16}{fast:>10.3f}{slow / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,56 @@
+"""
+Compares handled.load_to_dict against the typed handled.load_view on an assembly table.
+
+Run from the repository root:
+    python -m benchmarks.load_table [rows]
+
+The committed assembly.csv is repeated until it holds the requested number of rows (30000 by default).
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import handled
+
+
+def build_input(rows: int, path: str):
+    with open(handled.TABLES['assembly']['file'], 'r') as f:
+        header, *lines = f.readlines()
+    with open(path, 'w') as out:
+        out.write(header)
+        for i in range(rows):
+            out.write(lines[i % len(lines)])
+
+
+def measure(loader, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = loader(*args)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, retained, peak
+
+
+def main(rows: int = 30000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'assembly.csv')
+        build_input(rows, path)
+        cases = {
+            'load_to_dict': (handled.load_to_dict, path),
+            'load_view': (handled.load_view, 'assembly', path),
+        }
+        print(f"{rows:,} rows, {os.path.getsize(path) / 2 ** 20:.1f} MiB on disk")
+        print(f"{'loader':<14}{'seconds':>10}{'retained MiB':>15}{'peak MiB':>11}")
+        for name, (loader, *args) in cases.items():
+            elapsed, retained, peak = min(measure(loader, *args) for _ in range(3))
+            print(f"{name:<14}{elapsed:>10.3f}{retained / 2 ** 20:>15.1f}{peak / 2 ** 20:>11.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
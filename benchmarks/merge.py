@@ -0,0 +1,51 @@
+"""
+Times MergeTables.TableMerger on generated gene fragments with duplicated keys, then checks the merged table
+is sorted and deduplicated and that no temporary run is left behind.
+
+Run from the repository root:
+    python -m benchmarks.merge [rows] [run_rows] [fan_in]
+
+The defaults (200000 rows in runs of 1000, merged 8 at a time) make a merge of three levels.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+import handled
+from MergeTables import TableMerger
+
+
+def build_fragments(rows: int, directory: str, count: int = 4) -> list[str]:
+    columns = list(handled.TABLES['gene']['columns'])
+    rng = random.Random(1)
+    paths = []
+    for fragment in range(count):
+        path = os.path.join(directory, f"gene.shard-{fragment}-of-{count}.csv")
+        with open(path, 'w') as out:
+            out.write(f"{','.join(columns)}\n")
+            for _ in range(rows // count):
+                gene_id = rng.randrange(rows // 2)
+                out.write(f"{gene_id},G{gene_id},1,GCF_{fragment},{rng.randrange(1000)},fragment {fragment}\n")
+        paths.append(path)
+    return paths
+
+
+def main(rows: int = 200000, run_rows: int = 1000, fan_in: int = 8):
+    with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as tmp_dir:
+        fragments = build_fragments(rows, directory)
+        out_file = os.path.join(directory, 'gene.csv')
+        merger = TableMerger('gene', run_rows=run_rows, tmp_dir=tmp_dir, fan_in=fan_in)
+        start = time.perf_counter()
+        written = merger.merge(fragments, out_file)
+        elapsed = time.perf_counter() - start
+        print(f"{merger.rows_read:,} rows in {len(fragments)} fragments -> {written:,} rows in {elapsed:.3f} s")
+        leftover = os.listdir(tmp_dir)
+        assert not leftover, f"temporary runs left behind: {leftover}"
+        keys = [int(row['gene_id']) for row in handled.load_view('gene', out_file).rows()]
+        assert keys == sorted(set(keys)), "merged table is not sorted by unique gene_id"
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
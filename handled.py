@@ -1,5 +1,106 @@
+import hashlib
 import os
-from typing import Optional
+from collections.abc import Mapping
+from typing import Callable, Iterator, Optional
+
+import numpy
+import pandas
+
+# Declared layout of every output table: file name, primary key and the type of each column.
+# 'int' columns hold NCBI uids or counts, 'category' columns are strings that repeat heavily
+# between rows and 'str' columns are free text. Every value of a 'category' column is interned for good
+# in its SymbolTable, so nearly unique text like gene symbols and descriptions must stay 'str'.
+TABLES = {
+    'assembly': {
+        'file': 'assembly.csv',
+        'primary_key': 'accession',
+        'columns': {'taxon_id': 'int', 'organism': 'category', 'accession': 'str', 'gc_count': 'int',
+                    'seq_length': 'int', 'chromosomes': 'int', 'gene_total': 'int',
+                    'gene_num_protein_coding': 'int', 'gene_num_non_coding': 'int',
+                    'gene_num_pseudogene': 'int'},
+    },
+    'gene': {
+        'file': 'gene.csv',
+        'primary_key': 'gene_id',
+        'columns': {'gene_id': 'int', 'gene_symbol': 'str', 'proteins_for_gene': 'int',
+                    'assembly': 'category', 'taxon_id': 'int', 'description': 'str'},
+    },
+    'protein': {
+        'file': 'protein.csv',
+        'primary_key': 'protein_id',
+        'columns': {'protein_id': 'int', 'protein_title': 'str', 'cdd_id': 'int', 'gene_id': 'int',
+                    'taxon_id': 'int', 'poly_type': 'category'},
+    },
+    'taxon': {
+        'file': 'taxon.csv',
+        'primary_key': 'taxon_id',
+        'columns': {'taxon_id': 'int', 'name': 'category',
+                    'species_id': 'int', 'species': 'category',
+                    'genus_id': 'int', 'genus': 'category',
+                    'family_id': 'int', 'family': 'category',
+                    'order_id': 'int', 'order': 'category',
+                    'class_id': 'int', 'class': 'category',
+                    'phylum_id': 'int', 'phylum': 'category'},
+    },
+    # rank and name of every taxonomy node seen in a lineage, shared between organisms
+    'node': {
+        'file': 'taxonomy_node.csv',
+        'primary_key': 'tax_id',
+        'columns': {'tax_id': 'int', 'rank': 'category', 'name': 'category'},
+    },
+    # sequence cluster of every downloaded protein, rewritten as a whole by KmerCluster
+    'protein_cluster': {
+        'file': 'protein_cluster.csv',
+        'primary_key': 'protein_id',
+        'columns': {'protein_id': 'int', 'poly_type': 'category', 'cluster_id': 'str', 'representative': 'int'},
+    },
+}
+
+# Values write_to_table leaves behind for missing data
+NULL_VALUES = ['', 'None']
+
+# Tables written by run(), these get a file per shard when run is sharded. assembly.csv is shared input.
+SHARDED_TABLES = ('gene', 'protein', 'taxon', 'node')
+
+# (index, count) of the shard this process writes, see set_shard
+_shard: Optional[tuple[int, int]] = None
+
+# pandas dtype used to load each declared column type
+PANDAS_DTYPES = {'int': 'Int64', 'str': 'string', 'category': 'category'}
+
+# Callables notified with (table, row) after write_to_table adds a row, see add_write_listener
+_write_listeners: list[Callable[[str, dict], None]] = []
+
+
+def shard_of(key: str, count: int) -> int:
+    """
+    Deterministic shard of a key, e.g. an assembly accession.
+    Stable between processes and machines unlike hash().
+    """
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def set_shard(index: int, count: int):
+    """
+    Makes this process write its own copy of SHARDED_TABLES, e.g. gene.shard-2-of-8.csv.
+    Must be called before anything is written or memoized.
+    """
+    global _shard
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {index} does not exist in {count} shards")
+    _shard = (index, count)
+
+
+def table_file(table: str) -> str:
+    """
+    :return: the file this process reads and writes the table to
+    """
+    out_file = TABLES[table]['file']
+    if _shard is None or table not in SHARDED_TABLES:
+        return out_file
+    stem, ext = os.path.splitext(out_file)
+    return f"{stem}.shard-{_shard[0]}-of-{_shard[1]}{ext}"
 
 
 def enforce_str_dict(inp):
@@ -12,38 +113,43 @@ def enforce_str_dict(inp):
 
 
 def check_memo_asm(inp_key, store=[]):
-    out_file = 'assembly.csv'
     primary_key = 'accession'
     if not store:
-        saved = load_to_dict(out_file)
-        saved_dict = dict()
-        for entry in saved:
-            saved_dict[entry[primary_key]] = entry
-        store.append(saved_dict)
+        store.append(load_view('assembly', primary_key=primary_key))
     return store[0].get(inp_key)
 
 
 def check_memo_gene(inp_key, store=[]):
-    out_file = 'protein.csv'
     primary_key = 'gene_id'
     if not store:
-        saved = load_to_dict(out_file)
-        saved_dict = dict()
-        for entry in saved:
-            saved_dict[entry[primary_key]] = entry
-        store.append(saved_dict)
+        store.append(load_view('protein', primary_key=primary_key))
     return store[0].get(inp_key)
 
 
+def check_memo_taxon(inp_key, store=[]):
+    if not store:
+        store.append(load_view('taxon'))
+    return store[0].get(inp_key)
+
+
+def _node_memo(store=[]) -> dict:
+    if not store:
+        store.append({row['tax_id']: row for row in load_view('node').rows()})
+    return store[0]
+
+
+def check_memo_node(inp_key):
+    """
+    Looks up the cached rank and name of a taxonomy node.
+    Unlike the other memos the cache grows as write_node adds nodes during a run.
+    """
+    return _node_memo().get(str(inp_key))
+
+
 def check_memo_protein(inp_key, store=[]):
-    out_file = 'protein.csv'
     primary_key = 'protein_id'
     if not store:
-        saved = load_to_dict(out_file)
-        saved_dict = dict()
-        for entry in saved:
-            saved_dict[entry[primary_key]] = entry
-        store.append(saved_dict)
+        store.append(load_view('protein', primary_key=primary_key))
     return store[0].get(inp_key)
 
 
@@ -91,73 +197,248 @@ def load_to_dict(inpfile: str):
     return outp
 
 
-def write_asm(inp, store=[]):
-    out_file = 'assembly.csv'
-    primary_key = 'accession'
-    if not store:
-        extract_primary(store, out_file, primary_key)
-    colm = ['taxon_id', 'organism', 'accession', 'gc_count', 'seq_length', 'chromosomes',
-            'gene_total', 'gene_num_protein_coding', 'gene_num_non_coding', 'gene_num_pseudogene']
-    return write_to_table(inp, out_file, columns=colm, store=store, primary_key=primary_key)
+def load_table(table: str, inpfile: Optional[str] = None, symbols: bool = False) -> pandas.DataFrame:
+    """
+    Loads one of the tables of TABLES into a frame typed by its declared schema.
+    Parsing is done by the multithreaded arrow csv reader, ints become nullable Int64 and repeated strings categoricals.
 
+    :param table: key of the table in TABLES
+    :param inpfile: csv to read, defaults to the file of the table
+    :param symbols: give the categoricals the stable categories of SymbolTable, so frames of different tables
+                    share codes for the same value and can be joined or grouped on them
+    :return: typed DataFrame, empty with the declared columns when the file is missing or empty
+    """
+    columns = TABLES[table]['columns']
+    dtypes = {column: PANDAS_DTYPES[kind] for column, kind in columns.items()}
+    inpfile = table_file(table) if inpfile is None else inpfile
+    if not os.path.exists(inpfile) or os.path.getsize(inpfile) == 0:
+        frame = pandas.DataFrame({column: pandas.Series(dtype=dtype) for column, dtype in dtypes.items()})
+    else:
+        frame = pandas.read_csv(inpfile, dtype=dtypes, na_values=NULL_VALUES, keep_default_na=False, engine='pyarrow')
+    if symbols:
+        import SymbolTable  # SymbolTable reads the schemas of this module
+        frame = SymbolTable.encode_frame(table, frame)
+    return frame
 
-def write_gene(inp, store=[]):
-    out_file = 'gene.csv'
-    primary_key = 'gene_id'
-    if not store:
-        extract_primary(store, out_file, primary_key)
-    colm = ['gene_id', 'gene_symbol', 'proteins_for_gene', 'assembly', 'taxon_id', 'description']
-    return write_to_table(inp, out_file, columns=colm, store=store, primary_key=primary_key)
 
+class TableView(Mapping):
+    """
+    Read only mapping of primary key to row over a typed frame.
+    Rows are produced on access in the load_to_dict format, a dict of str or None per column,
+    so only the frame is kept in memory.
+    """
 
-def write_protein(inp, store=[]):
-    out_file = 'protein.csv'
-    primary_key = 'protein_id'
-    if not store:
-        extract_primary(store, out_file, primary_key)
-    colm = ['protein_id', 'protein_title', 'cdd_id', 'gene_id', 'taxon_id', 'poly_type']
-    return write_to_table(inp, out_file, columns=colm, store=store, primary_key=primary_key)
-
-
-def write_taxon(inp, store=[]):
-    out_file = 'taxon.csv'
-    primary_key = 'taxon_id'
-    colm = ['taxon_id', 'name',
-            'species_id', 'species',
-            'genus_id', 'genus',
-            'family_id', 'family',
-            'order_id', 'order',
-            'class_id', 'class',
-            'phylum_id', 'phylum']
-    if not store:
-        extract_primary(store, out_file, primary_key)
-    return write_to_table(inp, out_file, columns=colm, store=store, primary_key=primary_key)
+    def __init__(self, frame: pandas.DataFrame, primary_key: str):
+        """
+        :param frame: frame returned by load_table
+        :param primary_key: column to look rows up by. When a key repeats the last row wins.
+        """
+        self.frame: pandas.DataFrame = frame
+        self.primary_key: str = primary_key
+        self._integer_keys: bool = pandas.api.types.is_integer_dtype(frame[primary_key].dtype)
+        keys = frame[primary_key]
+        positions = pandas.Series(numpy.arange(len(frame)), index=keys)
+        self._positions: pandas.Series = positions[~positions.index.duplicated(keep='last')]
+        self._columns: list = [(column, frame[column].array) for column in frame.columns]
 
+    def _key(self, key):
+        if self._integer_keys:
+            try:
+                return int(key)
+            except (TypeError, ValueError):
+                raise KeyError(key)
+        return key
 
-def write_to_table(inp, out_file, columns, store: Optional[list] = None, primary_key: Optional[str] = None):
-    assert (store is None) == (primary_key is None)
-    try:
-        if os.path.getsize(out_file) == 0:
-            with open(out_file, 'w') as out:
-                out.write(f"{','.join(columns)}\n")
-                new_line = [str(inp[column]).replace(',', ' ') for column in columns]
-                out.write(f"{','.join(new_line)}\n")
-        else:
-            with open(out_file, 'a') as out:
-                if primary_key:
-                    if inp[primary_key] not in store:
-                        new_line = [str(inp[column]).replace(',', ' ') for column in columns]
-                        out.write(f"{','.join(new_line)}\n")
-                        store.append(primary_key)
-                else:
-                    new_line = [str(inp[column]).replace(',', ' ') for column in columns]
-                    out.write(f"{','.join(new_line)}\n")
+    def _row(self, position: int) -> dict:
+        return {column: None if pandas.isna(values[position]) else str(values[position])
+                for column, values in self._columns}
+
+    def __getitem__(self, key) -> dict:
+        try:
+            position = self._positions[self._key(key)]
+        except (KeyError, TypeError):
+            raise KeyError(key)
+        return self._row(int(position))
+
+    def __contains__(self, key) -> bool:
+        try:
+            return self._key(key) in self._positions.index
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(key) for key in self._positions.index)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def rows(self) -> Iterator[dict]:
+        """
+        Every row of the frame in file order in the load_to_dict format, including repeated keys.
+        """
+        columns = list(self.frame.columns)
+        for values in self.frame.itertuples(index=False, name=None):
+            yield {column: None if pandas.isna(value) else str(value) for column, value in zip(columns, values)}
 
+
+def load_view(table: str, inpfile: Optional[str] = None, primary_key: Optional[str] = None,
+              symbols: bool = True) -> TableView:
+    """
+    Typed replacement for load_to_dict, see load_table and TableView.
+
+    :param primary_key: column to index the view on, defaults to the primary key of the table
+    :param symbols: share the strings of the category columns through SymbolTable, see load_table
+    """
+    primary_key = TABLES[table]['primary_key'] if primary_key is None else primary_key
+    return TableView(load_table(table, inpfile, symbols=symbols), primary_key)
+
+
+def _written_keys(table: str, stores={}) -> set:
+    """
+    Primary keys already in the file of a table, read once per file and kept up to date by the writers.
+    """
+    out_file = table_file(table)
+    if out_file not in stores:
+        keys = []
+        extract_primary(keys, out_file, TABLES[table]['primary_key'])
+        stores[out_file] = set(keys)
+    return stores[out_file]
+
+
+def _write_row(table: str, inp, store: Optional[set] = None):
+    store = _written_keys(table) if store is None else store
+    colm = list(TABLES[table]['columns'])
+    return write_to_table(inp, table_file(table), columns=colm, store=store, primary_key=TABLES[table]['primary_key'])
+
+
+def write_asm(inp, store: Optional[set] = None):
+    return _write_row('assembly', inp, store)
+
+
+def write_gene(inp, store: Optional[set] = None):
+    return _write_row('gene', inp, store)
+
+
+def write_protein(inp, store: Optional[set] = None):
+    return _write_row('protein', inp, store)
+
+
+def write_taxon(inp, store: Optional[set] = None):
+    return _write_row('taxon', inp, store)
+
+
+def write_node(inp, store: Optional[set] = None):
+    inp = enforce_str_dict(dict(inp))
+    _node_memo().setdefault(inp[TABLES['node']['primary_key']], inp)
+    return _write_row('node', inp, store)
+
+
+def write_records(records: list) -> int:
+    """
+    Appends typed records of one table (see Model.TableRecord) in a single write.
+    Records whose primary key is already in the file, or earlier in records, are skipped.
+
+    :return: number of rows written
+    """
+    if not records:
+        return 0
+    record_type = type(records[0])
+    table = record_type.table
+    primary_key = TABLES[table]['primary_key']
+    store = _written_keys(table)
+    fresh = []
+    for record in records:
+        key = str(getattr(record, primary_key))
+        if key not in store:
+            store.add(key)
+            fresh.append(record)
+    if not fresh:
+        return 0
+    out_file = table_file(table)
+    columns = list(TABLES[table]['columns'])
+    cells = record_type.columns(fresh)
+    lines = [f"{','.join(row)}\n" for row in zip(*(cells[column] for column in columns))]
+    new_file = not os.path.exists(out_file) or os.path.getsize(out_file) == 0
+    with open(out_file, 'w' if new_file else 'a') as out:
+        if new_file:
+            out.write(f"{','.join(columns)}\n")
+        out.writelines(lines)
+    if _write_listeners:
+        for record in fresh:
+            _notify_write(out_file, record.to_row())
+    return len(fresh)
+
+
+def sync_tables(tables=SHARDED_TABLES):
+    """
+    Flushes the appended rows of the files of tables from the OS cache to disk.
+    """
+    for table in tables:
+        try:
+            with open(table_file(table), 'rb') as f:
+                os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+
+def repair_table(out_file):
+    """
+    Cuts off a row left half written by a crash so the next append starts on a new line.
+    """
+    try:
+        with open(out_file, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            content = f.read()
+            f.truncate(content.rfind(b'\n') + 1)
     except FileNotFoundError:
+        pass
+
+
+def add_write_listener(listener: Callable[[str, dict], None]):
+    """
+    Registers a callable that is given (table, row) every time write_to_table adds a new row.
+    Lets derived stores stay up to date without re-reading the csv files.
+    """
+    if listener not in _write_listeners:
+        _write_listeners.append(listener)
+
+
+def remove_write_listener(listener: Callable[[str, dict], None]):
+    if listener in _write_listeners:
+        _write_listeners.remove(listener)
+
+
+def _notify_write(out_file, inp):
+    table = next((name for name in TABLES if table_file(name) == out_file), out_file)
+    for listener in _write_listeners:
+        listener(table, inp)
+
+
+def write_to_table(inp, out_file, columns, store: Optional[set] = None, primary_key: Optional[str] = None):
+    assert (store is None) == (primary_key is None)
+    if hasattr(inp, 'to_row'):
+        inp = inp.to_row()
+    if primary_key:
+        if str(inp[primary_key]) in store:
+            return
+        store.add(str(inp[primary_key]))
+    new_line = [str(inp[column]).replace(',', ' ') for column in columns]
+    if not os.path.exists(out_file) or os.path.getsize(out_file) == 0:
         with open(out_file, 'w') as out:
             out.write(f"{','.join(columns)}\n")
-            new_line = [str(inp[column]).replace(',', ' ') for column in columns]
             out.write(f"{','.join(new_line)}\n")
+    else:
+        with open(out_file, 'a') as out:
+            out.write(f"{','.join(new_line)}\n")
+    _notify_write(out_file, inp)
+
 
 if __name__ == "__main__":
     pass
@@ -1,21 +1,35 @@
 import json
 import os
+import shutil
 from collections import OrderedDict
+from functools import partial
+from typing import Optional
 
 import pandas
 from requests import post, get
 from othermain import *
 
+import Checkpoint
+import JoinedView
+import Model
 import NCBIQueries
+import Pipeline
 import QueryDriver
+import QueryPlan
+import SymbolTable
+import TaxDump
 from pandas import DataFrame
 import handled
 
 
 qd = QueryDriver.QueryDriver()
+taxonomy_index = TaxDump.open_index()
 
 Error_file_path = 'ErrorFile.txt'
 
+# taxa per Datasets taxonomy request
+TAXONOMY_CHUNK = NCBIQueries.TaxonSummary.max_ids
+
 polymerasesTable = pandas.read_csv('pssmIds_csv.csv')
 polymerases = {str(row.cdd_uid): row.Type for row in polymerasesTable.itertuples()}
 accepted_domains = [str(row.cdd_uid) for row in polymerasesTable.itertuples()]
@@ -37,75 +51,69 @@ def store_bad(results):
 
 
 def get_Taxonomy(taxon_ids):
-    chunks = qd.factory.list_chunker(taxon_ids, chunk_size=20)
     output = []
-    for chunk in chunks:
-        qd(lineage=chunk)
-        for results in qd.run_query():
-            for ind, taxon_id in enumerate(chunk):
-                try:
-                    result = dict()
-                    lineage = results['taxonomy_nodes'][ind]['taxonomy']['lineage']
-                    result['name'] = results['taxonomy_nodes'][ind]['taxonomy']['organism_name']
-                    result['taxon_id'] = results['taxonomy_nodes'][ind]['taxonomy']['tax_id']
-                    lineage = [str(taxon_id) for taxon_id in lineage]
-                    result.update(get_name_rank(lineage))
-                    output.append(result)
-                except (ValueError,  KeyError):
-                    print(f"Missing value or server response was bad - skipping {taxon_id=}")
-                    store_bad(results)
+    if taxonomy_index is not None:
+        output, taxon_ids = TaxDump.resolve(taxonomy_index, taxon_ids)
+    lineages = dict()
+    for taxon_id, future in zip(taxon_ids, qd.load_many('lineage', taxon_ids)):
+        result = future.result()
+        if result is None:
+            print(f"Missing value or server response was bad - skipping {taxon_id=}")
+        elif 'lineage' in result:
+            # nodes without a classification block fall back on the node cache and esummary
+            lineages[str(taxon_id)] = result
+        else:
+            # ranks in the classification block also fill the node cache
+            for level in NCBIQueries.TaxonSummary.levels:
+                if result[level + '_id'] is not None and handled.check_memo_node(result[level + '_id']) is None:
+                    handled.write_node({'tax_id': result[level + '_id'], 'rank': level, 'name': result[level]})
+            output.append(dict(result))
+    rank_tables = get_name_ranks([node['lineage'] for node in lineages.values()])
+    for taxon_id, rank_table in zip(lineages, rank_tables):
+        result = {'name': lineages[taxon_id]['name'], 'taxon_id': taxon_id}
+        result.update(rank_table)
+        output.append(result)
     return output
 
 
 def get_name_rank(taxon_ids):
-    _levels = ['phylum', 'class', 'order', 'family', 'genus', 'species']
-    qd('taxonomy', taxon_ids, summary=True)
-    outp = {lvl: None for lvl in _levels}
-    outp.update({lvl + '_id': None for lvl in _levels})
-    for result in qd.run_query():
-        for taxon_id in taxon_ids:
-            if result['result'][taxon_id]['rank'] in _levels:
-                outp[result['result'][taxon_id]['rank']] = result['result'][taxon_id]['scientificname']
-                outp[result['result'][taxon_id]['rank'] + '_id'] = str(result['result'][taxon_id]['uid'])
-    return outp
+    return get_name_ranks([taxon_ids])[0]
 
 
-def gene_to_protein(genes: list) -> list[str]:
-    chunks = qd.factory.list_chunker(genes, chunk_size=125)
+def get_name_ranks(lineages: list[list[str]]) -> list[dict]:
+    """
+    Resolves the phylum ... species columns of each lineage.
+    Nodes are looked up in the persistent node cache and only unseen nodes are summarized,
+    batched by the query driver.
+    """
+    _levels = ['phylum', 'class', 'order', 'family', 'genus', 'species']
+    missing = sorted({taxon_id for lineage in lineages for taxon_id in lineage
+                      if handled.check_memo_node(taxon_id) is None})
+    for taxon_id, future in zip(missing, qd.load_many('taxonomy_summary', missing)):
+        result = future.result()
+        try:
+            handled.write_node({
+                'tax_id': taxon_id,
+                'rank': result['rank'],
+                'name': result['scientificname']
+            })
+        except (ValueError, KeyError, TypeError):
+            print(f"Missing value or server response was bad - skipping {taxon_id=}")
+            store_bad(result)
     outp = []
-    for chunk in chunks:
-        qd('gene', 'protein', chunk, linkname="gene_protein_refseq")
-        for results in qd.run_query():
-            try:
-                for linksetdbs in iterate_if_list(results['linksets'], None):
-                    for link in iterate_if_list(linksetdbs['linksetdbs'], None):
-                        for protein_id in iterate_if_list(link['links'], None):
-                            outp.append(str(protein_id))
-            except (ValueError,  KeyError):
-                print(f"Missing value or server response was bad - skipping {chunk=}")
-                store_bad(results)
+    for lineage in lineages:
+        rank_table = {lvl: None for lvl in _levels}
+        rank_table.update({lvl + '_id': None for lvl in _levels})
+        for taxon_id in lineage:
+            node = handled.check_memo_node(taxon_id)
+            if node is not None and node['rank'] in _levels:
+                rank_table[node['rank']] = node['name']
+                rank_table[node['rank'] + '_id'] = str(taxon_id)
+        outp.append(rank_table)
     return outp
 
 
-def protein_to_cdd(genes: list) -> list[str]:
-    chunks = qd.factory.list_chunker(genes, chunk_size=125)
-    outp = []
-    for chunk in chunks:
-        qd('protein', 'cdd', chunk, linkname="protein_cdd")
-        for results in qd.run_query():
-            try:
-                # list_paths(results)
-                for cdd_id in results['linksets'][0]['linksetdbs'][0]['links']:
-                    # print(type(cdd_id), f"{cdd_id=}")
-                    if polymerases.get(cdd_id):
-                        outp.append(str(cdd_id))
-            except (ValueError, KeyError):
-                print(f"Missing value or server response was bad - skipping {chunk=}")
-                store_bad(results)
-    return outp
-
-
-def taxon_to_genes(taxon, reference) -> list[dict]:
+def taxon_to_genes(taxon, reference) -> list[Model.GeneRecord]:
     qd(taxon=taxon)
     outp = []
     while True:
@@ -117,20 +125,16 @@ def taxon_to_genes(taxon, reference) -> list[dict]:
                     try:
                         for accession in iterate_if_list(gene['gene']['annotations'], 'assembly_accession'):
                             if accession == reference:
-                                gene_data = dict()
-                                gene_data['assembly'] = accession
-                                gene_data['gene_id'] = gene['gene']['gene_id']
-                                gene_data['taxon_id'] = gene['gene']['tax_id']
-                                gene_data['gene_symbol'] = gene['gene'].get('symbol', None)
-                                gene_data['proteins_for_gene'] = gene['gene'].get('protein_count', 0)
                                 desc = gene['gene'].get('description', 'No description')[:100].replace(',', ' ')
-                                gene_data['description'] = desc
-                                outp.append(
-                                    handled.enforce_str_dict(
-                                        gene_data
-                                    )
-                                )
-                    except (ValueError,  KeyError):
+                                outp.append(Model.GeneRecord(
+                                    gene_id=int(gene['gene']['gene_id']),
+                                    taxon_id=int(gene['gene']['tax_id']),
+                                    assembly=accession,
+                                    gene_symbol=gene['gene'].get('symbol', None),
+                                    proteins_for_gene=int(gene['gene'].get('protein_count', 0)),
+                                    description=desc
+                                ))
+                    except (ValueError,  KeyError, AssertionError):
                         print(f"Missing value or server response was bad - skipping this {gene}")
                         store_bad(results)
             except (ValueError,  KeyError):
@@ -144,107 +148,40 @@ def taxon_to_genes(taxon, reference) -> list[dict]:
     return outp
 
 
-def match_protein_cdd(proteins: list[dict]) -> list[dict]:
-    def match_helper(helper_proteins: list):
-        if not helper_proteins:
-            return ()
-        output = []
-        cdds = protein_to_cdd(
-            helper_proteins
-        )
-        if cdds:
-            if len(helper_proteins) == 1:
-                for cdd in cdds:
-                    entry = dict()
-                    entry['protein_id'] = helper_proteins[0]
-                    entry['cdd_id'] = cdd
-                    output.append(handled.enforce_str_dict(entry))
-                return tuple(output)
-            else:
-                even_results = match_helper(helper_proteins[::2])
-                odd_results = match_helper(helper_proteins[1::2])
-                output += list(even_results)
-                output += list(odd_results)
-                return tuple(output)
-        else:
-            return tuple[output]
-    return match_helper(proteins)
-
-
-def match_gene_to_cdd(genes: list[dict]) -> list[dict]:
-    def match_helper(helper_genes: list):
-        if not helper_genes:
-            return ()
-        output = []
-        gproteins = gene_to_protein(
-            helper_genes
-        )
-        cdds = protein_to_cdd(
-            gproteins
-        )
-        if cdds:
-            if len(helper_genes) == 1:
-                matches = match_protein_cdd(gproteins)
-                for match in matches:
-                    entry = match.copy()
-                    entry['gene_id'] = helper_genes[0]
-                    output.append(
-                        handled.enforce_str_dict(
-                            entry
-                        )
-                    )
-                return tuple(output)
-            else:
-                even_results = match_helper(helper_genes[::2])
-                odd_results = match_helper(helper_genes[1::2])
-                output += list(even_results)
-                output += list(odd_results)
-                return tuple(output)
-        else:
-            return tuple(output)
+def match_gene_to_cdd(genes: list[Model.GeneRecord]) -> list[Model.ProteinRecord]:
     output = []
-    genes_ids = [gene['gene_id'] for gene in genes]
+    genes_ids = [gene.gene_id for gene in genes]
     for key in genes_ids:
-        if handled.check_memo_gene(key):
-            value = handled.check_memo_gene(key)
-            entry = dict()
-            entry['gene_id'] = key
-            entry['protein_id'] = value['protein_id']
-            entry['cdd_id'] = value['cdd_id']
-            output.append(handled.enforce_str_dict(entry))
-    chunks = qd.factory.list_chunker(genes_ids, chunk_size=250)
-    for chunk in chunks:
-        output += list(match_helper(chunk))
+        value = handled.check_memo_gene(key)
+        if value:
+            output.append(Model.ProteinRecord.from_row({**value, 'gene_id': key}))
+    # links by id keep which gene each protein and which protein each domain came from
+    plan = QueryPlan.QueryPlan(qd)
+    plan.ids('genes', 'gene', genes_ids)
+    plan.link('proteins', 'genes', 'protein', linkname="gene_protein_refseq", by_id=True)
+    plan.link('cdds', 'proteins', 'cdd', linkname="protein_cdd", by_id=True)
+    results = plan.run()
+    for gene_id in genes_ids:
+        for protein_id in results['proteins'].links.get(str(gene_id), []):
+            for cdd_id in results['cdds'].links.get(protein_id, []):
+                if polymerases.get(cdd_id):
+                    output.append(Model.ProteinRecord(protein_id=int(protein_id), cdd_id=int(cdd_id), gene_id=gene_id))
     return output
 
 
-def get_protein(proteins) -> list[dict]:
-    chunks = qd.factory.list_chunker(proteins, chunk_size=75)
+def get_protein(proteins: list[Model.ProteinRecord]) -> list[Model.ProteinRecord]:
     new_data = dict()
-    for chunk in chunks:
-        protein_ids = [protein['protein_id'] for protein in chunk]
-        qd('protein', protein_ids, summary='True')
-        for results in qd.run_query():
-            try:
-                for protein_id in results['result']:
-                    if protein_id == 'uids':
-                        continue
-                    try:
-                        new_data[protein_id] = dict()
-                        new_data[protein_id]['taxon_id'] = results['result'][protein_id]['taxid']
-                        new_data[protein_id]['protein_title'] = results['result'][protein_id]['title'].replace(',', ' ')
-                    except (ValueError,  KeyError):
-                        print(f"Missing value or server response was bad - skipping {chunk=}")
-                        store_bad(results)
-            except (ValueError,  KeyError):
-                print(f"Missing value or server response was bad - skipping {chunk=}")
-                store_bad(results)
-    for value in proteins:
-        value.update(new_data[value['protein_id']])
-        value['poly_type'] = polymerases[value['cdd_id']]
-        handled.enforce_str_dict(
-            value
-        )
+    protein_ids = list(dict.fromkeys(protein.protein_id for protein in proteins))
+    for protein_id, future in zip(protein_ids, qd.load_many('protein_summary', protein_ids)):
+        result = future.result()
+        try:
+            new_data[protein_id] = (int(result['taxid']), result['title'].replace(',', ' '))
+        except (ValueError,  KeyError, TypeError):
+            print(f"Missing value or server response was bad - skipping {protein_id=}")
+            store_bad(result)
+    for protein in proteins:
+        protein.taxon_id, protein.protein_title = new_data.get(protein.protein_id, (None, None))
+        protein.poly_type = polymerases[str(protein.cdd_id)]
     return proteins
 
 
@@ -303,44 +240,184 @@ def get_assembly_data():
         if os.path.getsize('assembly.csv') == 0:
             return build_assembly_data()
         else:
-            return handled.load_to_dict('assembly.csv')
+            return handled.load_view('assembly').rows()
     except FileNotFoundError:
         return build_assembly_data()
 
 
-def run(id=None):
-    assemblies = get_assembly_data()
-    _values = [(asm['taxon_id'], asm['accession']) for asm in assemblies]
-    sleep(.36)
+def stage_taxonomy(block, checkpoint: Optional[Checkpoint.Checkpoint] = None) -> list[dict]:
+    """
+    Resolves the taxonomy of a block of (taxon_id, accession) in shared requests
+    and starts one work item per assembly.
+    With a checkpoint finished assemblies are dropped and interrupted ones continue from their saved item.
+    """
+    items, new_block = [], []
+    for taxon in block:
+        if checkpoint is None:
+            new_block.append(taxon)
+        elif taxon[1] not in checkpoint.committed:
+            saved = checkpoint.resume(taxon[1])
+            if saved is None:
+                new_block.append(taxon)
+            else:
+                items.append(saved)
+    pending = sorted({str(taxon[0]) for taxon in new_block if handled.check_memo_taxon(taxon[0]) is None})
+    full_taxa = {str(item['taxon_id']): item for item in get_Taxonomy(pending)}
+    for taxon in new_block:
+        full_taxon = full_taxa.get(str(taxon[0]))
+        item = {'taxon': taxon, 'full_taxon': None if full_taxon is None else Model.TaxonRecord.from_row(full_taxon)}
+        if checkpoint is not None:
+            checkpoint.complete(taxon[1], 'taxonomy', item)
+        items.append(item)
+    return items
+
+
+def stage_genes(item: dict) -> dict:
+    item['genes'] = taxon_to_genes(*item['taxon'])
+    print(f"final_genes_all={item['genes']}")
+    return item
+
+
+def stage_cdd(item: dict) -> dict:
+    # get proteins that are polymerases
+    item['proteins'] = match_gene_to_cdd(item['genes'])
+    print(f"final_proteins={item['proteins']}")
+    # only the genes of those proteins are kept for writing
+    gids = {protein.gene_id for protein in item['proteins']}
+    item['genes'] = [gene for gene in item['genes'] if gene.gene_id in gids]
+    return item
+
+
+def stage_proteins(item: dict) -> dict:
+    # finish protein entries
+    item['proteins'] = get_protein(item['proteins'])
+    return item
+
+
+def stage_write(item: dict) -> dict:
+    if item['full_taxon'] is not None:
+        handled.write_taxon(item['full_taxon'])
+    print(f"full_taxon={item['full_taxon']}")
+    handled.write_records(item['proteins'])
+    # write relevent genes to file
+    handled.write_records(item['genes'])
+    # the checkpoint marks the assembly done once this returns, its rows must survive a crash from then on
+    handled.sync_tables()
+    return item
+
+
+def checkpointed(checkpoint: Optional[Checkpoint.Checkpoint], stage: str, fn):
+    """
+    Wraps a stage so items that already went through it pass untouched
+    and items that finish it are saved to the checkpoint.
+    """
+    if checkpoint is None:
+        return fn
+
+    def run_stage(item: dict) -> dict:
+        if checkpoint.reached(item, stage):
+            return item
+        item = fn(item)
+        checkpoint.complete(item['taxon'][1], stage, item)
+        return item
+    return run_stage
+
+
+def build_stages(checkpoint: Optional[Checkpoint.Checkpoint] = None) -> list[tuple]:
+    """
+    :return: (name, function) of each stage of run() after taxonomy, the last one writes the rows
+    """
+    def commit(item: dict) -> dict:
+        if checkpoint is None:
+            return stage_write(item)
+        checkpoint.commit(item['taxon'][1], item, stage_write)
+        return item
+    return [
+        ('genes', checkpointed(checkpoint, 'genes', stage_genes)),
+        ('cdd', checkpointed(checkpoint, 'cdd', stage_cdd)),
+        ('proteins', checkpointed(checkpoint, 'proteins', stage_proteins)),
+        ('write', commit),
+    ]
+
+
+def build_pipeline(queue_size=2, checkpoint: Optional[Checkpoint.Checkpoint] = None) -> Pipeline.Pipeline:
+    """
+    Pipeline running the stages of run() concurrently: while assembly N is being written,
+    N+1 gets its protein summaries, N+2 its CDD matches and so on.
+    Writes stay in a single worker as handled is not thread safe.
+    """
+    return Pipeline.Pipeline([
+        Pipeline.Stage('taxonomy', partial(stage_taxonomy, checkpoint=checkpoint), queue_size=1, fan_out=True),
+        *(Pipeline.Stage(name, fn, queue_size=queue_size) for name, fn in build_stages(checkpoint))
+    ])
+
+
+def run(id=None, view_path=JoinedView.VIEW_PATH, pipelined=False, shard=None,
+        checkpoint_dir=Checkpoint.CHECKPOINT_DIR, reset_checkpoint=False):
+    """
+    Collects the polymerases of every assembly in assembly.csv.
+
+    :param id: only run the assemblies of these taxon ids
+    :param view_path: sqlite file of the JoinedView kept up to date, None for no view
+    :param pipelined: overlap the stages of consecutive assemblies, see build_pipeline
+    :param shard: (index, count) runs only the assemblies whose accession hashes to shard index
+                  and writes gene/protein/taxon rows to files of that shard. No view is kept for a shard.
+                  assembly.csv must be complete before shards are started on the same machine.
+    :param checkpoint_dir: directory of the checkpoint a restarted run resumes from, None to run without one
+    :param reset_checkpoint: delete the checkpoint first, so every assembly is collected again
+    """
+    if shard is not None:
+        handled.set_shard(*shard)
+        view_path = None
+        if checkpoint_dir is not None:
+            checkpoint_dir = f"{checkpoint_dir}.shard-{shard[0]}-of-{shard[1]}"
+        SymbolTable.set_directory(f"{SymbolTable.SYMBOL_DIR}.shard-{shard[0]}-of-{shard[1]}")
+    checkpoint = None
+    if checkpoint_dir is not None:
+        if reset_checkpoint:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        for table in handled.SHARDED_TABLES:
+            handled.repair_table(handled.table_file(table))
+        checkpoint = Checkpoint.Checkpoint(['taxonomy', 'genes', 'cdd', 'proteins', 'write'], checkpoint_dir,
+                                           encode=Model.encode_record, decode=Model.decode_record)
+    view = None
+    try:
+        if view_path is not None:
+            view = JoinedView.JoinedView(view_path)
+            if view.stale():
+                view.rebuild()
+            view.attach()
+        if checkpoint is not None:
+            recovered = checkpoint.recover(stage_write)
+            if recovered:
+                print(f"Finished the interrupted writes of {recovered=}")
+        assemblies = get_assembly_data()
+        _values = [(asm['taxon_id'], asm['accession']) for asm in assemblies]
+        sleep(.36)
 
-    for taxon in _values:
         if id is not None:
-            if taxon[0] not in id:
-                continue
-        full_taxon = get_Taxonomy([str(taxon[0])])
-        for item in iterate_if_list(full_taxon, None):
-            handled.write_taxon(item)
-        print(f"{full_taxon=}")
-        final_genes_all = taxon_to_genes(*taxon)
-        print(f"{final_genes_all=}")
-        # get proteins that are polymerases
-        final_proteins = match_gene_to_cdd(final_genes_all)
-        print(f"{final_proteins=}")
-        # finish protein entries
-        final_proteins = get_protein(final_proteins)
-        for item in iterate_if_list(final_proteins, None):
-            handled.write_protein(item)
-        # extract gids that correspond to final protein
-        gids = [item['gene_id'] for item in final_proteins]
-        genes_with_poly = []
-        # write relevent genes to file
-        for gene in final_genes_all:
-            if gene["gene_id"] in gids:
-                genes_with_poly.append(gene)
-                handled.write_gene(
-                    handled.enforce_str_dict(gene)
-                )
-
+            _values = [taxon for taxon in _values if taxon[0] in id]
+        if shard is not None:
+            _values = [taxon for taxon in _values if handled.shard_of(taxon[1], shard[1]) == shard[0]]
+        blocks = qd.factory.list_chunker(_values, chunk_size=TAXONOMY_CHUNK)
+
+        if pipelined:
+            pipeline = build_pipeline(checkpoint=checkpoint)
+            pipeline(blocks)
+            print(f"{pipeline.stats()=}")
+        else:
+            stages = build_stages(checkpoint)
+            for block in blocks:
+                for item in stage_taxonomy(block, checkpoint=checkpoint):
+                    for _, stage in stages:
+                        item = stage(item)
+    finally:
+        # symbols interned by rows already written must be kept even when a stage failed
+        SymbolTable.save_all()
+        if checkpoint is not None:
+            checkpoint.close()
+        if view is not None:
+            view.close()
 
 
 if __name__ == "__main__":
@@ -353,12 +430,26 @@ if __name__ == "__main__":
     # test_genes = ['883126', '883094', '882789', '882652', '882473', '882393',
     #                '882249', '882125', '882038', '881987','880683']
     # test_value3 = ['15595867']
-    # t2 = gene_to_protein(test_genes)
-    # t4 = protein_to_cdd(t2)
     #
     # t5 = match_gene_to_cdd(genes=test_genes)
     # t6 = get_protein(t5)
-    run(test=True)
+    import argparse
+    parser = argparse.ArgumentParser(description="Collect the polymerases of complete bacterial reference genomes")
+    parser.add_argument('--ids', nargs='*', help="only run the assemblies of these taxon ids")
+    parser.add_argument('--pipelined', action='store_true', help="overlap the stages of consecutive assemblies")
+    parser.add_argument('--shard', help="i/N, run the i-th (0 based) of N deterministic shards of assembly.csv")
+    parser.add_argument('--api-key', help="NCBI API key, defaults to the NCBI_API_KEY environment variable")
+    parser.add_argument('--workers-per-key', type=int, default=1,
+                        help="processes sharing the same API key, each gets an equal part of the rate limit")
+    parser.add_argument('--checkpoint', action=argparse.BooleanOptionalAction, default=True,
+                        help="resume from and record progress in the checkpoint directory")
+    parser.add_argument('--reset-checkpoint', action='store_true',
+                        help="forget the progress of earlier runs and collect every assembly again")
+    args = parser.parse_args()
+    qd.set_budget(api_key=args.api_key, share=args.workers_per_key)
+    run_shard = tuple(int(part) for part in args.shard.split('/')) if args.shard else None
+    run(id=args.ids, pipelined=args.pipelined, shard=run_shard,
+        checkpoint_dir=Checkpoint.CHECKPOINT_DIR if args.checkpoint else None, reset_checkpoint=args.reset_checkpoint)
 
 # for taxon_id in values:
 #     if taxon_id[0] in result_df[['TaxonID']].values:
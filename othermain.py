@@ -95,26 +95,21 @@ def run_taxon_assembly(taxon_id):
 
 
 def run_gene_protein(gene_ids: list[str]):
-    chunks = qd.factory.list_chunker(gene_ids, chunk_size=149)
-    qd('gene', 'protein', chunks.pop(), linkname="gene_protein_refseq")
     outp = []
-    while True:
+    # each chunk is sized when it is taken, after the requests of the previous ones were observed
+    for chunk in qd.factory.list_chunker(gene_ids, endpoint='elink'):
+        qd('gene', 'protein', chunk, linkname="gene_protein_refseq")
         for results in qd.run_query():
             for _id in iterate_if_list(results['eLinkResult']['LinkSet']['LinkSetDb']['Link'], 'Id'):
                 outp.append(_id)
-        if chunks:
-            qd('gene', 'protein', chunks.pop(), linkname="gene_protein_refseq")
-        else:
-            break
     return outp
 
 
 def run_protein_cdd(gene_ids: list[str]):
-    chunks = qd.factory.list_chunker(gene_ids, chunk_size=149)
-    qd('protein', 'cdd', chunks.pop(), linkname="protein_cdd" )
     outp = []
     assm = {'A': 0, 'Y': 0, 'B': 0, 'C': 0, 'X': 0}
-    while True:
+    for chunk in qd.factory.list_chunker(gene_ids, endpoint='elink'):
+        qd('protein', 'cdd', chunk, linkname="protein_cdd")
         for results in qd.run_query():
             if 'LinkSetDb' in results['eLinkResult']['LinkSet']:
                 for _id in iterate_if_list(results['eLinkResult']['LinkSet']['LinkSetDb']['Link'], 'Id'):
@@ -123,10 +118,6 @@ def run_protein_cdd(gene_ids: list[str]):
                         assm[polymerases[_id]] += 1
             else:
                 print(results)
-        if chunks:
-            qd('protein', 'cdd', chunks.pop(), linkname="protein_cdd")
-        else:
-            break
     return assm, outp
 
 